@@ -43,6 +43,7 @@ from utils.dtproject_utils import DTProject
 from utils.exceptions import InvalidUserInput
 from utils.misc_utils import sanitize_hostname, indent_block, get_user_login
 from utils.networking_utils import get_duckiebot_ip
+from utils.sync_utils import TransferSet, rsync_project
 from utils.yaml_utils import load_yaml
 
 usage = """
@@ -510,15 +511,11 @@ class DTCommand(DTCommandAbs):
             if parsed.sync:
                 # let's set some things up to run on the Duckiebot
                 check_program_dependency("rsync")
-                remote_base_path = f"{DEFAULT_REMOTE_USER}@{duckiebot_hostname}:/code/{exercise_name}"
                 dtslogger.info(f"Syncing your local folder with {duckiebot}")
-                rsync_cmd = "rsync -a "
-                for d in settings.rsync_exclude:
-                    rsync_cmd += f"--exclude {project.path}/{d} "
-                # TODO: no need to sync the recipe, just the meat
-                rsync_cmd += f"{project.path}/* {remote_base_path}"
-                dtslogger.info(f"rsync command: {rsync_cmd}")
-                _run_cmd(rsync_cmd, shell=True)
+                # only the code is mounted from /code/<project>, launchers come from the recipe
+                tset = TransferSet(project, launchers=False, exclude=settings.rsync_exclude)
+                nfiles = rsync_project(tset, duckiebot_hostname)
+                dtslogger.debug(f"Synced {nfiles} file(s) to {tset.remote_path}")
             # the agent runs on the duckiebot client
             agent_client = duckiebot_client
 
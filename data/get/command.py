@@ -1,9 +1,11 @@
 import argparse
 import os
 import signal
+import time
 
-from dt_data_api import DataClient, TransferStatus
+from dt_data_api import DataClient, TransferError, APIError
 from dt_shell import DTCommandAbs, dtslogger
+from utils.download_utils import DEFAULT_DOWNLOAD_WORKERS, RangedDownload, TransferAborted
 from utils.misc_utils import human_size
 from utils.progress_bar import ProgressBar
 
@@ -45,6 +47,18 @@ Where <space> can be one of {str(VALID_SPACES)}.
         parser.add_argument(
             "-f", "--force", default=False, action="store_true", help="Overwrites local file if it exists"
         )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            default=DEFAULT_DOWNLOAD_WORKERS,
+            type=int,
+            help="Number of byte ranges to download in parallel",
+        )
+        parser.add_argument(
+            "--sha256",
+            default=None,
+            help="(Optional) Expected SHA256 checksum of the object",
+        )
         parser.add_argument("object", nargs=1, help="Destination path of the object")
         parser.add_argument("file", nargs=1, help="File to download")
         parsed, _ = parser.parse_known_args(args=args)
@@ -116,40 +130,43 @@ Where <space> can be one of {str(VALID_SPACES)}.
         storage = client.storage(parsed.space)
         # prepare progress bar
         pbar = ProgressBar()
-
-        def check_status(h):
-            if h.status == TransferStatus.STOPPED:
-                print()
-                dtslogger.info("Stopping download...")
-                handler.abort(block=True)
-                dtslogger.info("Download stopped!")
-                exit(6)
-            if h.status == TransferStatus.ERROR:
-                dtslogger.error(h.reason)
-                exit(7)
-
-        def cb(h):
-            speed = human_size(h.progress.speed)
+        stime = time.time()
+        resumed = [None]
+
+        def cb(downloaded: int, total: int):
+            # the speed only accounts for the bytes downloaded by this session
+            if resumed[0] is None:
+                resumed[0] = downloaded
+            speed = human_size((downloaded - resumed[0]) / max(time.time() - stime, 1e-6))
             header = f"Downloading [{speed}/s] "
             header = header + " " * max(0, 28 - len(header))
             pbar.set_header(header)
-            pbar.update(h.progress.percentage)
-            # check status
-            check_status(h)
+            pbar.update(100 * downloaded / max(total, 1))
 
         # download file
         dtslogger.info(f"Downloading [{parsed.space}]:{parsed.object} -> {parsed.file}")
-        handler = storage.download(parsed.object, parsed.file)
-        handler.register_callback(cb)
+        download = RangedDownload(
+            storage, parsed.object, parsed.file, workers=parsed.workers, sha256=parsed.sha256, on_progress=cb
+        )
 
         # capture SIGINT and abort
-        signal.signal(signal.SIGINT, lambda *_: handler.abort())
-
-        # wait for the download to finish
-        handler.join()
-
-        # check status
-        check_status(handler)
+        signal.signal(signal.SIGINT, lambda *_: download.abort())
+
+        try:
+            download.run()
+        except TransferAborted:
+            print()
+            dtslogger.info("Download stopped! Run the same command again to resume it.")
+            exit(6)
+        except FileNotFoundError as e:
+            print()
+            dtslogger.error(str(e))
+            exit(7)
+        except (TransferError, APIError) as e:
+            print()
+            dtslogger.error(f"{e} Run the same command again to resume the download.")
+            exit(7)
+        pbar.update(100)
 
         # if we got here, the download is completed
         dtslogger.info("Download complete!")
@@ -172,7 +172,8 @@ class DTCommand(DTCommandAbs):
             # try to interpret it as a multi-command
             multi = MultiCommand(DTCommand, shell, [("-H", "--machine")], args)
             if multi.is_multicommand:
-                multi.execute()
+                if not multi.execute():
+                    exit(1)
                 return
         if not parsed:
             parsed = parser.parse_args(args=args)
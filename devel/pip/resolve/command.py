@@ -1,7 +1,7 @@
 import json
 import logging
 import os
-from typing import Optional, List, Union, Dict, Set, Tuple
+from typing import Optional, List, Dict, Set
 
 import argparse
 from dockertown import DockerClient
@@ -16,6 +16,7 @@ from utils.docker_utils import (
 )
 from utils.exceptions import UnpinnedDependenciesError
 from utils.misc_utils import sanitize_hostname, indent_block
+from utils.pip_utils import PipFreezeIndex, PipResolver, is_comment
 
 Raw = RawUnpinned = RawPinned = Comment = str
 
@@ -38,8 +39,9 @@ class DTCommand(DTCommandAbs):
         parser.add_argument(
             "-C",
             "--workdir",
-            default=os.getcwd(),
-            help="Directory containing the project to pip-resolve",
+            nargs="+",
+            default=[os.getcwd()],
+            help="Directory (or directories) containing the project(s) to pip-resolve",
         )
         parser.add_argument(
             "-a",
@@ -86,8 +88,8 @@ class DTCommand(DTCommandAbs):
         if "parsed" in kwargs:
             parsed.__dict__.update(kwargs["parsed"].__dict__)
         # ---
-        parsed.workdir = os.path.abspath(parsed.workdir)
-        project = DTProject(parsed.workdir)
+        workdirs: List[str] = [parsed.workdir] if isinstance(parsed.workdir, str) else parsed.workdir
+        projects: List[DTProject] = [DTProject(os.path.abspath(w)) for w in workdirs]
 
         # dependent options
         if parsed.strict:
@@ -99,16 +101,11 @@ class DTCommand(DTCommandAbs):
                 "The options --check/--strict and -i/--in-place cannot be used together."
             )
 
-        # support both non-dt and dt dependencies lists
-        deps_files = {
-            "dependencies-py3.txt": project.py3_dependencies(comments=True),
-            "dependencies-py3.dt.txt": project.py3_dependencies_dt(comments=True),
-        }
-
         # strict check
         if parsed.check:
-            for deps_file, wanted in deps_files.items():
-                DTCommand._check_pinned(deps_file, wanted, strict=parsed.strict)
+            for project in projects:
+                for deps_file, wanted in DTCommand._deps_files(project).items():
+                    DTCommand._check_pinned(deps_file, wanted, strict=parsed.strict)
             return
 
         # create docker client
@@ -125,37 +122,54 @@ class DTCommand(DTCommandAbs):
             parsed.arch = get_endpoint_architecture(parsed.machine)
             dtslogger.info(f"Target architecture automatically set to {parsed.arch}.")
 
-        # recreate image name
+        # indices are shared among projects (e.g., projects built on the same base image)
         registry_to_use = get_registry_to_use()
-        image: str = project.image(
-            arch=parsed.arch,
-            registry=registry_to_use,
-            owner="duckietown",
-            # extra="pip-resolver",
-            version=project.distro
-        )
+        indices: Dict[str, PipFreezeIndex] = {}
 
-        # run pip freeze
-        dtslogger.info(f"Exporting list of resolved dependencies from image '{image}'...")
-        pinned: List[str] = DTCommand._pip_freeze(docker, image)
+        def _index(img: Optional[str]) -> PipFreezeIndex:
+            if img is None:
+                return PipFreezeIndex([])
+            if img not in indices:
+                dtslogger.info(f"Exporting list of resolved dependencies from image '{img}'...")
+                indices[img] = PipFreezeIndex(DTCommand._pip_freeze(docker, img))
+            return indices[img]
 
-        # get dependencies from the base image
-        base_image: Optional[str] = DTCommand._base_image(project, registry_to_use, parsed.arch)
-        inherited: List[RawPinned] = []
-        if base_image is not None:
-            dtslogger.info(f"Exporting list of resolved dependencies from base image '{base_image}'...")
-            inherited = DTCommand._pip_freeze(docker, base_image)
+        for project in projects:
+            if len(projects) > 1:
+                dtslogger.info(f"Resolving dependencies for project '{project.name}'...")
+            # recreate image name
+            image: str = project.image(
+                arch=parsed.arch,
+                registry=registry_to_use,
+                owner="duckietown",
+                # extra="pip-resolver",
+                version=project.distro
+            )
+            # get dependencies from the image and its base image
+            base_image: Optional[str] = DTCommand._base_image(project, registry_to_use, parsed.arch)
+            resolver: PipResolver = PipResolver(_index(image), _index(base_image))
+            DTCommand._resolve_project(project, resolver, in_place=parsed.in_place)
 
+    @staticmethod
+    def _deps_files(project: DTProject) -> Dict[str, List[str]]:
+        # support both non-dt and dt dependencies lists
+        return {
+            "dependencies-py3.txt": project.py3_dependencies(comments=True),
+            "dependencies-py3.dt.txt": project.py3_dependencies_dt(comments=True),
+        }
+
+    @staticmethod
+    def _resolve_project(project: DTProject, resolver: PipResolver, in_place: bool):
         computed: Set[RawPinned] = set()
-        for deps_file, wanted in deps_files.items():
+        for deps_file, wanted in DTCommand._deps_files(project).items():
             # combine pinned list with dependencies list
             resolved: List[str]
 
-            resolved, others = DTCommand._resolve_deps(wanted, pinned, inherited)
+            resolved, others = resolver.resolve(wanted)
             computed = computed.intersection(others) if len(computed) > 0 else others
 
             # in-place edit
-            if parsed.in_place:
+            if in_place:
                 DTCommand._write_deps_file(project, deps_file, resolved)
                 dtslogger.info(f"File '{deps_file}' modified")
             else:
@@ -165,7 +179,7 @@ class DTCommand(DTCommandAbs):
                 print(f"\n{deps_file}:\n{sep}\n{indent_block(content)}\n{sep}\n")
 
         # print out / save computed dependencies
-        if parsed.in_place:
+        if in_place:
             deps_file = "dependencies-py3.computed.txt"
             DTCommand._write_deps_file(project, deps_file, sorted(computed), must_exist=False)
             dtslogger.info(f"File '{deps_file}' modified")
@@ -207,7 +221,7 @@ class DTCommand(DTCommandAbs):
         deps: Dict[int, Requirement] = {
             i: Requirement.parse(d)
             for i, d in enumerate(wanted)
-            if not DTCommand._is_comment(d)
+            if not is_comment(d)
         }
         # select what specs to use
         specs: Set[str] = STRICT_SPECS if strict else GOOD_SPECS
@@ -223,51 +237,9 @@ class DTCommand(DTCommandAbs):
                     f"the operator(s): {', '.join(specs)} ."
                 )
 
-    @staticmethod
-    def _resolve_deps(wanted: List[str], pinned: List[str], inherited: List[str]) -> Tuple[List[str], Set[str]]:
-        resolved: List[Raw] = []
-        wanted: List[Union[Comment, Requirement]] = [
-            (w if DTCommand._is_comment(w) else Requirement.parse(w)) for w in wanted
-        ]
-        pinned: Dict[Raw, Union[Comment, Requirement]] = {
-            p: (p if DTCommand._is_comment(p) else Requirement.parse(p)) for p in pinned
-        }
-        inherited: Set[RawUnpinned] = {Requirement.parse(p).name.lower().strip() for p in inherited}
-        unmatched: Set[RawPinned] = set(pinned.keys())
-        for dep in wanted:
-            # keep comments
-            if isinstance(dep, Comment):
-                resolved.append(dep)
-                continue
-            rdep: Requirement = dep
-            # match with pinned
-            found: bool = False
-            for dep1, rdep1 in pinned.items():
-                if rdep.name.lower().strip() == rdep1.name.lower().strip():
-                    resolved.append(dep1)
-                    found = True
-                    unmatched.remove(dep1)
-                    break
-            # make sure we always have a match
-            if not found:
-                msg: str = f"Dependency '{dep}' not found in pip freeze."
-                dtslogger.error(msg)
-                dtslogger.debug(f"pip-freeze: {pinned}")
-                raise UserError(msg)
-        # remove unmatched dependencies that are inherited
-        unmatched = {
-            u for u in unmatched if Requirement.parse(u).name.lower().strip() not in inherited
-        }
-        # ---
-        return resolved, unmatched
-
-    @staticmethod
-    def _is_comment(s: str) -> bool:
-        return len(s) <= 0 or s.lstrip().startswith("#")
-
     @staticmethod
     def _count_deps(deps: List[str]) -> int:
-        return len(deps) - len(list(filter(DTCommand._is_comment, deps)))
+        return len(deps) - len(list(filter(is_comment, deps)))
 
     @staticmethod
     def _base_image(project: DTProject, registry: str, arch: str) -> Optional[str]:
@@ -21,11 +21,11 @@ from utils.dtproject_utils import (
 )
 from utils.misc_utils import human_size, sanitize_hostname
 from utils.multi_command_utils import MultiCommand
+from utils.sync_utils import TransferSet, rsync_project
 
 LAUNCHER_FMT = "dt-launcher-%s"
 DEFAULT_MOUNTS = ["/var/run/avahi-daemon/socket", "/data"]
 DEFAULT_NETWORK_MODE = "host"
-DEFAULT_REMOTE_USER = "duckie"
 
 
 class DTCommand(DTCommandAbs):
@@ -168,7 +168,8 @@ class DTCommand(DTCommandAbs):
         # try to interpret it as a multi-command
         multi = MultiCommand(DTCommand, shell, [("-H", "--machine")], args)
         if multi.is_multicommand:
-            multi.execute()
+            if not multi.execute():
+                exit(1)
             return
         # add a fake positional argument to avoid missing the first argument starting with `-`
         try:
@@ -432,7 +433,6 @@ class DTCommand(DTCommandAbs):
             # make sure rsync is installed
             check_program_dependency("rsync")
             dtslogger.info(f"Syncing code with {parsed.machine.replace('.local', '')}...")
-            remote_path = f"{DEFAULT_REMOTE_USER}@{parsed.machine}:/code/"
             # get projects' locations
             projects_to_sync = [parsed.workdir] if parsed.mount is True else []
             # sync secondary projects
@@ -440,10 +440,9 @@ class DTCommand(DTCommandAbs):
                 projects_to_sync.extend(
                     [os.path.abspath(os.path.join(os.getcwd(), p.strip())) for p in parsed.mount.split(",")]
                 )
-            # run rsync
+            # run rsync (only what the container mounts, minus ignored files)
             for project_path in projects_to_sync:
-                cmd = f"rsync --archive {project_path} {remote_path}"
-                _run_cmd(cmd, shell=True)
+                rsync_project(TransferSet.from_path(project_path), parsed.machine)
             dtslogger.info(f"Code synced!")
         # run
         exitcode = _run_cmd(
@@ -1,14 +1,12 @@
 import argparse
 import os
-import subprocess
 
 from dt_shell import DTCommandAbs, dtslogger
 from utils.cli_utils import check_program_dependency
 from utils.docker_utils import DEFAULT_MACHINE
 from utils.misc_utils import sanitize_hostname
-from utils.multi_command_utils import MultiCommand
-
-DEFAULT_REMOTE_USER = "duckie"
+from utils.multi_command_utils import MultiCommand, DEFAULT_MAX_WORKERS
+from utils.sync_utils import SyncWatcher, FleetSync, TransferSet, rsync_project
 
 
 class DTCommand(DTCommandAbs):
@@ -38,14 +36,35 @@ class DTCommand(DTCommandAbs):
             help="Whether to mount the current project into the container. "
             "Pass a comma-separated list of paths to mount multiple projects",
         )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            default=False,
+            action="store_true",
+            help="Keep watching the project(s) for changes and push only the files that changed",
+        )
+        parser.add_argument(
+            "--debounce",
+            default=0.3,
+            type=float,
+            help="Seconds of inactivity to wait for before pushing a batch of changes (with --watch)",
+        )
+        parser.add_argument(
+            "--full",
+            default=False,
+            action="store_true",
+            help="Ignore what was pushed to the robots before and sync everything (with multiple hosts)",
+        )
         # get pre-parsed or parse arguments
         parsed = kwargs.get("parsed", None)
+        fleet = None
+        workers = DEFAULT_MAX_WORKERS
         if not parsed:
             # try to interpret it as a multi-command
             multi = MultiCommand(DTCommand, shell, [("-H", "--machine")], args)
             if multi.is_multicommand:
-                multi.execute()
-                return
+                fleet = [sanitize_hostname(str(v[0])) for v in multi.values]
+                workers = multi.max_workers
         if not parsed:
             parsed, _ = parser.parse_known_args(args=args)
         # ---
@@ -63,8 +82,6 @@ class DTCommand(DTCommandAbs):
             exit(2)
         # make sure rsync is installed
         check_program_dependency("rsync")
-        dtslogger.info(f"Syncing code with {parsed.machine.replace('.local', '')}...")
-        remote_path = f"{DEFAULT_REMOTE_USER}@{parsed.machine}:/code/"
         # get projects' locations
         projects_to_sync = [parsed.workdir] if parsed.mount is True else []
         # sync secondary projects
@@ -72,36 +89,29 @@ class DTCommand(DTCommandAbs):
             projects_to_sync.extend(
                 [os.path.abspath(os.path.join(os.getcwd(), p.strip())) for p in parsed.mount.split(",")]
             )
+        # only what the containers mount (minus ignored files) is transferred
+        projects_to_sync = [TransferSet.from_path(p) for p in projects_to_sync]
+        # fleet mode: the source tree is scanned once and pushed to all the robots
+        if fleet is not None:
+            if parsed.watch:
+                dtslogger.error("The option -w/--watch cannot be used with multiple hosts")
+                exit(2)
+            success = FleetSync(projects_to_sync, fleet, workers=workers, full=parsed.full).run()
+            if not success:
+                exit(1)
+            return
+        dtslogger.info(f"Syncing code with {parsed.machine.replace('.local', '')}...")
+        # watch mode
+        if parsed.watch:
+            watcher = SyncWatcher(projects_to_sync, parsed.machine, debounce=parsed.debounce)
+            watcher.run()
+            return
         # run rsync
-        for project_path in projects_to_sync:
-            cmd = f"rsync --archive {project_path} {remote_path}"
-            _run_cmd(cmd, shell=True)
+        for project in projects_to_sync:
+            nfiles = rsync_project(project, parsed.machine)
+            dtslogger.debug(f"Synced {nfiles} file(s) from '{project.name}'")
         dtslogger.info(f"Code synced!")
 
     @staticmethod
     def complete(shell, word, line):
         return []
-
-
-def _run_cmd(cmd, get_output=False, print_output=False, suppress_errors=False, shell=False):
-    if shell and isinstance(cmd, (list, tuple)):
-        cmd = " ".join([str(s) for s in cmd])
-    dtslogger.debug("$ %s" % cmd)
-    if get_output:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=shell)
-        proc.wait()
-        if proc.returncode != 0:
-            if not suppress_errors:
-                msg = "The command {} returned exit code {}".format(cmd, proc.returncode)
-                dtslogger.error(msg)
-                raise RuntimeError(msg)
-        out = proc.stdout.read().decode("utf-8").rstrip()
-        if print_output:
-            print(out)
-        return out
-    else:
-        try:
-            subprocess.check_call(cmd, shell=shell)
-        except subprocess.CalledProcessError as e:
-            if not suppress_errors:
-                raise e
@@ -119,6 +119,12 @@ class DTCommand(DTCommandAbs):
             default=False,
             help="Do not upload the statistics to the Duckietown server.",
         )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            default=False,
+            help="Ignore the cached discovery data and wait for the device to announce itself",
+        )
         parsed, _ = parser.parse_known_args(args=args)
         # ---
         if parsed.app_id is None:
@@ -161,7 +167,7 @@ class DTCommand(DTCommandAbs):
             # retrieve robot type from device
             dtslogger.info(f'Waiting for device "{fetch_type_from}"...')
             hostname = fetch_type_from.replace(".local", "")
-            _, _, data = wait_for_service("DT::ROBOT_TYPE", hostname)
+            _, _, data = wait_for_service("DT::ROBOT_TYPE", hostname, use_cache=not parsed.no_cache)
             parsed.type = data["type"]
             dtslogger.info(f'Detected device type is "{parsed.type}".')
         else:
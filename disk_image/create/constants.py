@@ -38,8 +38,6 @@ CLI_TOOLS_NEEDED = [
     "unzip",
     "sudo",
     "cp",
-    "sha256sum",
-    "strings",
     "grep",
     "stat",
     "udevadm",
@@ -47,7 +45,7 @@ CLI_TOOLS_NEEDED = [
     "parted",
     "e2fsck",
     "resize2fs",
-    "truncate",
+    "tar",
     "mount",
     "umount",
     "touch",
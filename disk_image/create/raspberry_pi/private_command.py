@@ -1,5 +1,3 @@
-from types import SimpleNamespace
-
 from dt_shell import DTCommandAbs, dtslogger, DTShell, __version__ as shell_version
 
 import argparse
@@ -13,6 +11,7 @@ import docker
 import socket
 import getpass
 from datetime import datetime
+from typing import Optional
 
 from utils.cli_utils import ask_confirmation
 from utils.duckietown_utils import get_distro_version
@@ -22,9 +21,6 @@ from disk_image.create.constants import (
     FILE_PLACEHOLDER_SIGNATURE,
     TMP_WORKDIR,
     DISK_IMAGE_STATS_LOCATION,
-    DOCKER_IMAGE_TEMPLATE,
-    MODULES_TO_LOAD,
-    DATA_STORAGE_DISK_IMAGE_DIR,
     DEFAULT_STACK,
     AUTOBOOT_STACKS_DIR,
 )
@@ -32,21 +28,34 @@ from disk_image.create.constants import (
 from disk_image.create.utils import (
     VirtualSDCard,
     check_cli_tools,
-    pull_docker_image,
+    add_build_arguments,
+    module_images,
+    preload_module_images,
     disk_template_partitions,
-    disk_template_objects,
+    disk_template_tree,
     find_placeholders_on_disk,
+    compress_artifacts,
+    push_artifacts,
+    create_disk_image,
+    disk_image_partitions,
     get_file_first_line,
-    get_file_length,
     run_cmd,
     run_cmd_in_partition,
     validator_autoboot_stack,
     validator_yaml_syntax,
     list_files,
-    replace_in_file,
     transfer_file,
     get_validator_fcn,
     copy_file,
+    PartitionWriter,
+    clone_file,
+    template_fingerprint,
+    StepCache,
+    file_sha256,
+    docker_image_digests,
+    apt_release_urls,
+    apt_sources_fingerprint,
+    apt_sources_unchanged,
 )
 
 DISK_IMAGE_PARTITION_TABLE = {"HypriotOS": 1, "root": 2}
@@ -132,6 +141,7 @@ class DTCommand(DTCommandAbs):
             default=None,
             help="Step to cache",
         )
+        add_build_arguments(parser)
         parser.add_argument(
             "--push",
             default=False,
@@ -221,23 +231,43 @@ class DTCommand(DTCommandAbs):
                 "shell_version": shell_version,
                 "commands_version": shell.get_commands_version(),
             },
-            "modules": [
-                DOCKER_IMAGE_TEMPLATE(
-                    owner=module["owner"],
-                    module=module["module"],
-                    version=distro,
-                    tag=module["tag"] if "tag" in module else None,
-                )
-                for module in MODULES_TO_LOAD
-            ],
+            "modules": module_images(distro),
             "template": {"directories": [], "files": []},
             "disk_size_gb": DISK_IMAGE_SIZE_GB,
             "stamp": time.time(),
             "stamp_human": datetime.now().isoformat(),
         }
 
+        # content-addressed cache of the steps, each step declares the inputs its result depends on
+        # (evaluated only when the step cache is used)
+        def load_step_cache() -> StepCache:
+            return StepCache(
+                os.path.join(parsed.output, "cache", "steps"),
+                out_file_name("img"),
+                {
+                    "create": lambda: [file_sha256(in_file_path("img")), DISK_IMAGE_SIZE_GB],
+                    "resize": [DISK_IMAGE_PARTITION_TABLE, ROOT_PARTITION],
+                    "upgrade": lambda: [
+                        APT_PACKAGES_TO_INSTALL,
+                        template_fingerprint(
+                            DISK_TEMPLATE_DIR,
+                            ROOT_PARTITION,
+                            [["etc", "resolv.conf"], ["tmp", "libseccomp2_2.4.3-1+b1_armhf.deb"]],
+                        ),
+                    ],
+                    "docker": lambda: [distro, docker_image_digests(docker.from_env(), stats["modules"])],
+                },
+                parsed.steps if (parsed.step_cache and parsed.cache_target is None) else [],
+                validate=apt_sources_unchanged,
+            )
+
+        step_cache = load_step_cache()
+        # metadata of the snapshots, e.g., the state of the APT sources used by the upgrade
+        snapshot_meta: dict = {}
+
         # create caching function
         def cache_step(step):
+            step_cache.save(step, out_file_path("img"), snapshot_meta)
             if step != parsed.cache_record:
                 return
             # cache step
@@ -247,6 +277,7 @@ class DTCommand(DTCommandAbs):
             dtslogger.info(f"Step '{step}' cached.")
 
         # use cached step
+        cached_step: Optional[str] = step_cache.lookup()
         if parsed.cache_target is not None:
             disk_image_origin = cached_step_file_path(parsed.cache_target, "img")
             if not os.path.isfile(disk_image_origin):
@@ -257,6 +288,15 @@ class DTCommand(DTCommandAbs):
                     continue
                 parsed.steps.remove(step)
             using_cached_step = True
+        elif cached_step is not None:
+            dtslogger.info(f"Inputs unchanged up to step '{cached_step}', reusing its cached result.")
+            disk_image_origin = step_cache.path(cached_step)
+            snapshot_meta.update(step_cache.meta(cached_step))
+            for step in SUPPORTED_STEPS[: SUPPORTED_STEPS.index(cached_step) + 1]:
+                if step in MANDATORY_STEPS or step not in parsed.steps:
+                    continue
+                parsed.steps.remove(step)
+            using_cached_step = True
 
         print()
         #
@@ -312,6 +352,9 @@ class DTCommand(DTCommandAbs):
             else:
                 dtslogger.info(f"Reusing cached DISK image file [{in_file_path('img')}].")
             # ---
+            # the keys of the steps that depend on the base disk image are only known once it is here
+            if "create" not in step_cache.keys:
+                step_cache = load_step_cache()
             cache_step("download")
             dtslogger.info("Step END: download\n")
         # Step: download
@@ -332,30 +375,11 @@ class DTCommand(DTCommandAbs):
                 if not granted:
                     dtslogger.info("Aborting.")
                     return
-            # create empty disk image
-            if not using_cached_step:
-                dtslogger.info(f"Creating empty disk image [{out_file_path('img')}]")
-                run_cmd(
-                    [
-                        "dd",
-                        "if=/dev/zero",
-                        f"of={out_file_path('img')}",
-                        f"bs={1024 * 1024}",
-                        f"count={1024 * DISK_IMAGE_SIZE_GB}",
-                    ]
-                )
-                dtslogger.info("Empty disk image created!")
-            # make copy of the disk image
-            dtslogger.info(f"Copying [{disk_image_origin}] -> [{out_file_path('img')}]")
-            run_cmd(
-                [
-                    "dd",
-                    f"if={disk_image_origin}",
-                    f"of={out_file_path('img')}",
-                    f"bs={1024 * 1024}",
-                    "" if using_cached_step else "conv=notrunc",
-                ]
-            )
+            # create a (sparse) copy of the disk image
+            if using_cached_step:
+                clone_file(disk_image_origin, out_file_path("img"))
+            else:
+                create_disk_image(disk_image_origin, out_file_path("img"), DISK_IMAGE_SIZE_GB * 1024**3)
             # flush buffer
             dtslogger.info("Flushing I/O buffer...")
             run_cmd(["sync"])
@@ -509,6 +533,13 @@ class DTCommand(DTCommandAbs):
                                 ' -o Dpkg::Options::="--force-confold"'
                                 " full-upgrade",
                             )
+                            # the result of the upgrade also depends on the state of the APT sources
+                            if "upgrade" in step_cache.keys:
+                                apt_urls = apt_release_urls(ROOT_PARTITION)
+                                snapshot_meta["apt"] = {
+                                    "urls": apt_urls,
+                                    "fingerprint": apt_sources_fingerprint(apt_urls),
+                                }
                             # install packages
                             if APT_PACKAGES_TO_INSTALL:
                                 pkgs = " ".join(APT_PACKAGES_TO_INSTALL)
@@ -568,52 +599,10 @@ class DTCommand(DTCommandAbs):
                     raise ValueError(f"Disk device {partition_disk} not found")
                 # mount device
                 sd_card.mount_partition(ROOT_PARTITION)
-                # get local docker client
-                local_docker = docker.from_env()
-                # pull dind image
-                pull_docker_image(local_docker, "docker:dind")
-                # run auxiliary Docker engine
-                remote_docker_dir = os.path.join(PARTITION_MOUNTPOINT(ROOT_PARTITION), "var", "lib", "docker")
-                remote_docker_engine_container = local_docker.containers.run(
-                    image="docker:dind",
-                    detach=True,
-                    auto_remove=True,
-                    publish_all_ports=True,
-                    privileged=True,
-                    name="dts-disk-image-aux-docker",
-                    volumes={remote_docker_dir: {"bind": "/var/lib/docker", "mode": "rw"}},
-                    entrypoint=["dockerd", "--host=tcp://0.0.0.0:2375", "--bridge=none"],
-                )
-                dtslogger.info("Waiting 20 seconds for DIND to start...")
-                time.sleep(20)
-                # get IP address of the container
-                container_info = local_docker.api.inspect_container("dts-disk-image-aux-docker")
-                container_ip = container_info["NetworkSettings"]["IPAddress"]
-                # create remote docker client
-                endpoint_url = f"tcp://{container_ip}:2375"
-                dtslogger.info(f"DIND should now be up, using endpoint URL `{endpoint_url}`.")
-                remote_docker = docker.DockerClient(base_url=endpoint_url)
-                # from this point on, if anything weird happens, stop container and unmount disk
+                # pull images inside the disk image, through an auxiliary Docker engine
                 try:
-                    dtslogger.info("Transferring Docker images...")
-                    # pull images inside the disk image
-                    for module in MODULES_TO_LOAD:
-                        image = DOCKER_IMAGE_TEMPLATE(
-                            owner=module["owner"],
-                            module=module["module"],
-                            version=distro,
-                            tag=module["tag"] if "tag" in module else None,
-                        )
-                        pull_docker_image(remote_docker, image)
-                    # ---
-                    dtslogger.info("Docker images successfully transferred!")
-                except Exception as e:
-                    # unmount disk
-                    sd_card.umount()
-                    raise e
+                    preload_module_images(ROOT_PARTITION, stats["modules"], parsed)
                 finally:
-                    # stop container
-                    remote_docker_engine_container.stop()
                     # unmount partition
                     sd_card.umount_partition(ROOT_PARTITION)
                 # ---
@@ -639,20 +628,13 @@ class DTCommand(DTCommandAbs):
                     return
                 # find partitions to update
                 partitions = disk_template_partitions(DISK_TEMPLATE_DIR)
+                # walk the disk template once, partition by partition
+                template = {p: disk_template_tree(DISK_TEMPLATE_DIR, p) for p in partitions}
                 # put template objects inside the stats object
                 for partition in partitions:
-                    stats["template"]["directories"] = list(
-                        map(
-                            lambda u: u["relative"],
-                            disk_template_objects(DISK_TEMPLATE_DIR, partition, "directory"),
-                        )
-                    )
-                    stats["template"]["files"] = list(
-                        map(
-                            lambda u: u["relative"],
-                            disk_template_objects(DISK_TEMPLATE_DIR, partition, "file"),
-                        )
-                    )
+                    dirs, files = template[partition]
+                    stats["template"]["directories"] = [u["relative"] for u in dirs]
+                    stats["template"]["files"] = [u["relative"] for u in files]
                 # make sure that all the partitions are there
                 for partition in partitions:
                     # check if the partition defined in the disk_template dir exists
@@ -667,71 +649,76 @@ class DTCommand(DTCommandAbs):
                     # from this point on, if anything weird happens, unmount the disk
                     try:
                         dtslogger.info(f'Updating partition "{partition}":')
-                        # create directory structure from disk template
-                        for update in disk_template_objects(DISK_TEMPLATE_DIR, partition, "directory"):
-                            dtslogger.info(f"- Creating directory [{update['relative']}]")
-                            # create destination
-                            run_cmd(["sudo", "mkdir", "-p", update["destination"]])
-                        # copy stacks (root only)
-                        if partition == ROOT_PARTITION:
-                            for stack in list_files(STACKS_DIR, "yaml"):
-                                origin = os.path.join(STACKS_DIR, stack)
-                                destination = os.path.join(
-                                    PARTITION_MOUNTPOINT(partition), AUTOBOOT_STACKS_DIR.lstrip("/"), stack
-                                )
-                                relative = os.path.join(AUTOBOOT_STACKS_DIR, stack)
+                        dirs, files = template[partition]
+                        # everything goes into the partition through a single tar stream
+                        with PartitionWriter(partition) as writer:
+                            # create directory structure from disk template
+                            for update in dirs:
+                                dtslogger.info(f"- Creating directory [{update['relative']}]")
+                                writer.add_directory(update["relative"])
+                            # copy stacks (root only)
+                            if partition == ROOT_PARTITION:
+                                for stack in list_files(STACKS_DIR, "yaml"):
+                                    origin = os.path.join(STACKS_DIR, stack)
+                                    destination = os.path.join(
+                                        PARTITION_MOUNTPOINT(partition),
+                                        AUTOBOOT_STACKS_DIR.lstrip("/"),
+                                        stack,
+                                    )
+                                    relative = os.path.join(AUTOBOOT_STACKS_DIR, stack)
+                                    # validate file
+                                    validator = _get_validator_fcn(partition, relative)
+                                    if validator:
+                                        dtslogger.debug(f"Validating file {relative}...")
+                                        validator(shell, origin, relative, arch=DEVICE_ARCH)
+                                    # create or modify file
+                                    effect = "MODIFY" if os.path.exists(destination) else "NEW"
+                                    dtslogger.info(f"- Updating file ({effect}) [{relative}]")
+                                    with open(origin, "rt") as fin:
+                                        content = fin.read()
+                                    # add architecture as default value in the stack file
+                                    dtslogger.debug(
+                                        "- Replacing '{ARCH}' with '{ARCH:-%s}' in %s"
+                                        % (DEVICE_ARCH, relative)
+                                    )
+                                    content = content.replace("{ARCH}", "{ARCH:-%s}" % DEVICE_ARCH)
+                                    mode = os.stat(origin).st_mode
+                                    writer.add_file(relative, content.encode("utf-8"), mode)
+                            # apply changes from disk_template
+                            for update in files:
                                 # validate file
-                                validator = _get_validator_fcn(partition, relative)
+                                validator = _get_validator_fcn(partition, update["relative"])
                                 if validator:
-                                    dtslogger.debug(f"Validating file {relative}...")
-                                    validator(shell, origin, relative, arch=DEVICE_ARCH)
+                                    dtslogger.debug(f"Validating file {update['relative']}...")
+                                    validator(shell, update["origin"], update["relative"], arch=DEVICE_ARCH)
                                 # create or modify file
-                                effect = "MODIFY" if os.path.exists(destination) else "NEW"
-                                dtslogger.info(f"- Updating file ({effect}) [{relative}]")
-                                # copy new file
-                                run_cmd(["sudo", "cp", origin, destination])
-                                # add architecture as default value in the stack file
-                                dtslogger.debug(
-                                    "- Replacing '{ARCH}' with '{ARCH:-%s}' in %s"
-                                    % (DEVICE_ARCH, destination)
-                                )
-                                replace_in_file("{ARCH}", "{ARCH:-%s}" % DEVICE_ARCH, destination)
-                        # apply changes from disk_template
-                        for update in disk_template_objects(DISK_TEMPLATE_DIR, partition, "file"):
-                            origin = update["origin"]
-                            destination = update["destination"]
-                            relative = update["relative"]
-                            # validate file
-                            validator = _get_validator_fcn(partition, relative)
-                            if validator:
-                                dtslogger.debug(f"Validating file {relative}...")
-                                validator(shell, origin, relative, arch=DEVICE_ARCH)
-                            # create or modify file
-                            effect = "MODIFY" if os.path.exists(destination) else "NEW"
-                            dtslogger.info(f"- Updating file ({effect}) [{relative}]")
-                            # copy new file
-                            run_cmd(["sudo", "cp", origin, destination])
-                            # get first line of file
-                            file_first_line = get_file_first_line(destination)
-                            # only files containing a known placeholder will be part of the surgery
-                            if file_first_line.startswith(FILE_PLACEHOLDER_SIGNATURE):
-                                placeholder = file_first_line[len(FILE_PLACEHOLDER_SIGNATURE) :]
-                                # get stats about file
-                                real_bytes, max_bytes = get_file_length(destination)
-                                # saturate file so that it occupies the entire pagefile
-                                run_cmd(["sudo", "truncate", f"--size={max_bytes}", destination])
-                                # store preliminary info about the surgery
-                                surgery_plan.append(
-                                    {
-                                        "partition": partition,
-                                        "partition_id": DISK_IMAGE_PARTITION_TABLE[partition],
-                                        "path": relative,
-                                        "placeholder": placeholder,
-                                        "offset_bytes": None,
-                                        "used_bytes": real_bytes,
-                                        "length_bytes": max_bytes,
-                                    }
-                                )
+                                effect = "MODIFY" if os.path.exists(update["destination"]) else "NEW"
+                                dtslogger.info(f"- Updating file ({effect}) [{update['relative']}]")
+                                with open(update["origin"], "rb") as fin:
+                                    content = fin.read()
+                                # get first line of file
+                                file_first_line = get_file_first_line(update["origin"])
+                                # only files containing a known placeholder will be part of the surgery
+                                if file_first_line.startswith(FILE_PLACEHOLDER_SIGNATURE):
+                                    placeholder = file_first_line[len(FILE_PLACEHOLDER_SIGNATURE) :]
+                                    # saturate file so that it occupies all the blocks allocated to it
+                                    real_bytes = len(content)
+                                    max_bytes = writer.allocated_size(real_bytes)
+                                    content = content.ljust(max_bytes, b"\0")
+                                    # store preliminary info about the surgery
+                                    surgery_plan.append(
+                                        {
+                                            "partition": partition,
+                                            "partition_id": DISK_IMAGE_PARTITION_TABLE[partition],
+                                            "path": update["relative"],
+                                            "placeholder": placeholder,
+                                            "offset_bytes": None,
+                                            "used_bytes": real_bytes,
+                                            "length_bytes": max_bytes,
+                                        }
+                                    )
+                                mode = os.stat(update["origin"]).st_mode
+                                writer.add_file(update["relative"], content, mode)
                         # special handling of the ROOT partition
                         if partition == ROOT_PARTITION:
                             # store stats before closing the partition
@@ -765,7 +752,10 @@ class DTCommand(DTCommandAbs):
                 raise e
             # finalize surgery plan
             dtslogger.info("Locating files for surgery in disk image...")
-            placeholders = find_placeholders_on_disk(out_file_path("img"))
+            # only scan the partitions that contain files to operate on
+            partitions = disk_image_partitions(out_file_path("img"))
+            extents = [partitions[pid] for pid in {b["partition_id"] for b in surgery_plan}]
+            placeholders = find_placeholders_on_disk(out_file_path("img"), extents)
             for i in range(len(surgery_plan)):
                 full_placeholder = f"{FILE_PLACEHOLDER_SIGNATURE}{surgery_plan[i]['placeholder']}"
                 # check if the placeholder was found
@@ -789,7 +779,7 @@ class DTCommand(DTCommandAbs):
             dtslogger.info("Step BEGIN: finalize")
             # compute image sha256
             dtslogger.info(f"Computing SHA256 checksum of {out_file_path('img')}...")
-            disk_image_sha256 = sd_card.disk_image_sha()
+            disk_image_sha256, disk_image_map = sd_card.disk_image_hashes()
             dtslogger.info(f"SHA256: {disk_image_sha256}")
             # store surgery plan and other info
             dtslogger.info(f"Storing metadata in {out_file_path('json')}...")
@@ -797,6 +787,7 @@ class DTCommand(DTCommandAbs):
                 "version": DISK_IMAGE_VERSION,
                 "disk_image": os.path.basename(out_file_path("img")),
                 "sha256": disk_image_sha256,
+                "block_map": disk_image_map,
                 "surgery_plan": surgery_plan,
             }
             with open(out_file_path("json"), "wt") as fout:
@@ -822,9 +813,7 @@ class DTCommand(DTCommandAbs):
         # Step: compress
         if "compress" in parsed.steps:
             dtslogger.info("Step BEGIN: compress")
-            dtslogger.info("Compressing disk image...")
-            run_cmd(["zip", "-j", out_file_path("zip"), out_file_path("img"), out_file_path("json")])
-            dtslogger.info("Done!")
+            compress_artifacts(parsed.compression, out_file_path)
             cache_step("compress")
             dtslogger.info("Step END: compress\n")
         # Step: compress
@@ -837,17 +826,7 @@ class DTCommand(DTCommandAbs):
                 dtslogger.warning("The step 'compress' was not performed. No artifacts to push.")
                 return
             dtslogger.info("Step BEGIN: push")
-            dtslogger.info("Pushing disk image...")
-            shell.include.data.push.command(
-                shell,
-                [],
-                parsed=SimpleNamespace(
-                    file=[out_file_path("zip")],
-                    object=[os.path.join(DATA_STORAGE_DISK_IMAGE_DIR, out_file_name("zip"))],
-                    space="public",
-                ),
-            )
-            dtslogger.info("Done!")
+            push_artifacts(shell, parsed.compression, out_file_path, out_file_name)
             dtslogger.info("Step END: push\n")
         # Step: push
         # <------
@@ -1,21 +1,36 @@
+import argparse
 import collections
+import contextlib
+import errno
 import fnmatch
+import functools
 import glob
+import hashlib
+import io
 import itertools
 import json
+import lzma
+import mmap
 import os
 import re
 import shutil
+import stat
 import subprocess
 import sys
+import tarfile
 import time
-from typing import Callable
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
 from typing import List
 
+import docker
 import yaml
 from disk_image.create.constants import (
     DEFAULT_DOCKER_REGISTRY,
     CLI_TOOLS_NEEDED,
+    DATA_STORAGE_DISK_IMAGE_DIR,
     DEFAULT_DEVICE_ARCH,
     DOCKER_IMAGE_TEMPLATE,
     FILE_PLACEHOLDER_SIGNATURE,
@@ -28,6 +43,19 @@ from utils.duckietown_utils import get_distro_version
 from utils.misc_utils import sudo_open, indent_block
 from utils.progress_bar import ProgressBar
 
+PLACEHOLDER_SCAN_CHUNK_SIZE = 64 * 1024**2
+PLACEHOLDER_NAME_RE = re.compile(rb"[\x20-\x7e\t]*")
+# disk images are hashed in segments of this size (aligned to multiples of it), holes are not hashed
+DISK_IMAGE_SEGMENT_SIZE = 32 * 1024**2
+DISK_IMAGE_HASH_ALGORITHM = "sha256"
+# seekable (xz) disk images are made of independent frames of this size
+DISK_IMAGE_FRAME_SIZE = 32 * 1024**2
+# docker images are preloaded into disk images this many at a time
+DOCKER_PRELOAD_WORKERS = 4
+DIND_READY_TIMEOUT = 60
+DIND_IMAGE = "docker:dind"
+DIND_CONTAINER_NAME = "dts-disk-image-aux-docker"
+
 
 class VirtualSDCard:
     def __init__(self, disk_file, partition_table, loopdev=None):
@@ -171,7 +199,10 @@ class VirtualSDCard:
         dtslogger.info("Done!")
 
     def disk_image_sha(self):
-        return run_cmd(["sha256sum", self._disk_file], get_output=True).split(" ")[0]
+        return hash_disk_image(self._disk_file)[0]
+
+    def disk_image_hashes(self) -> Tuple[str, dict]:
+        return hash_disk_image(self._disk_file)
 
     def get_usage_percentage(self, partition):
         if not self.is_mounted():
@@ -217,9 +248,62 @@ def check_cli_tools(*args):
         check_program_dependency(cli_tool)
 
 
-def pull_docker_image(client, image, platform=None):
+def add_build_arguments(parser: argparse.ArgumentParser):
+    # arguments shared by all the disk image builders
+    parser.add_argument(
+        "--step-cache",
+        default=False,
+        action="store_true",
+        help="Cache the result of each step and only run the steps whose inputs changed "
+        "since the last build",
+    )
+    parser.add_argument(
+        "--docker-workers",
+        type=int,
+        default=DOCKER_PRELOAD_WORKERS,
+        help="Number of Docker images to pull into the disk image concurrently",
+    )
+    parser.add_argument(
+        "--docker-seed",
+        default=False,
+        action="store_true",
+        help="Copy the up-to-date Docker images available on this machine instead of pulling them",
+    )
+    parser.add_argument(
+        "--docker-mirror",
+        type=str,
+        default=None,
+        help="Registry mirror (e.g., a local pull-through cache) to pull the Docker images from",
+    )
+    parser.add_argument(
+        "--compression",
+        default="zip",
+        choices=["zip", "xz"],
+        help="Format of the compressed image, xz images are made of frames that can be "
+        "(de)compressed in parallel",
+    )
+
+
+def module_images(
+    distro: str, arch: str = DEFAULT_DEVICE_ARCH, registry: str = DEFAULT_DOCKER_REGISTRY
+) -> List[str]:
+    # the Docker images of the modules that ship with the disk image
+    return [
+        DOCKER_IMAGE_TEMPLATE(
+            owner=module["owner"],
+            module=module["module"],
+            version=distro,
+            tag=module["tag"] if "tag" in module else None,
+            arch=arch,
+            registry=registry,
+        )
+        for module in MODULES_TO_LOAD
+    ]
+
+
+def pull_docker_image(client, image, platform=None, progress=True):
     repository, tag = image.split(":")
-    pbar = ProgressBar()
+    pbar = ProgressBar() if progress else None
     total_layers = set()
     completed_layers = set()
     dtslogger.info(f"Pulling image {image} (platform={platform or 'auto'})...")
@@ -230,76 +314,404 @@ def pull_docker_image(client, image, platform=None):
         if step["status"] in ["Download complete", "Pull complete"]:
             completed_layers.add(step["id"])
         # compute progress
-        if len(total_layers) > 0:
-            progress = int(100 * len(completed_layers) / len(total_layers))
-            pbar.update(progress)
-    pbar.update(100)
+        if pbar is not None and len(total_layers) > 0:
+            pbar.update(int(100 * len(completed_layers) / len(total_layers)))
+    if pbar is not None:
+        pbar.update(100)
     dtslogger.info(f"Image pulled: {image}")
 
 
+def wait_for_docker(endpoint_url: str, timeout: float = DIND_READY_TIMEOUT, interval: float = 0.5) -> bool:
+    # polls the Docker API until the engine answers, False if it does not within `timeout` seconds
+    url = endpoint_url.replace("tcp://", "http://", 1) + "/_ping"
+    stime = time.time()
+    while time.time() - stime < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=max(interval, 1)) as res:
+                if res.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(interval)
+    return False
+
+
+@contextlib.contextmanager
+def dind_engine(
+    local_docker, docker_dir: str, image: str = DIND_IMAGE, mirror: Optional[str] = None
+) -> Iterator[docker.DockerClient]:
+    """
+    Runs an auxiliary Docker engine (DinD) storing its data in `docker_dir`, waits for it to be ready
+    and yields a client for it. The engine is stopped on exit.
+    """
+    pull_docker_image(local_docker, image)
+    container = local_docker.containers.run(
+        image=image,
+        detach=True,
+        auto_remove=True,
+        publish_all_ports=True,
+        privileged=True,
+        name=DIND_CONTAINER_NAME,
+        volumes={docker_dir: {"bind": "/var/lib/docker", "mode": "rw"}},
+        entrypoint=["dockerd", "--host=tcp://0.0.0.0:2375", "--bridge=none"]
+        + ([f"--registry-mirror={mirror}"] if mirror else []),
+    )
+    try:
+        # get IP address of the container
+        container_info = local_docker.api.inspect_container(container.id)
+        endpoint_url = f"tcp://{container_info['NetworkSettings']['IPAddress']}:2375"
+        dtslogger.info(f"Waiting for DIND to start on `{endpoint_url}`...")
+        if not wait_for_docker(endpoint_url):
+            raise RuntimeError(f"DIND did not start on `{endpoint_url}`")
+        yield docker.DockerClient(base_url=endpoint_url)
+    finally:
+        container.stop()
+
+
+def seed_docker_image(source, destination, image: str, platform: Optional[str] = None) -> bool:
+    # copies an image from the `source` engine to the `destination` one, False if `source` does not have
+    # the version of the image the tag currently points to in the registry
+    try:
+        attrs = source.images.get(image).attrs
+    except Exception:
+        return False
+    try:
+        digest = source.images.get_registry_data(image).id
+    except Exception as e:
+        dtslogger.warning(f"Could not resolve the digest of {image}, it will be pulled: {e}")
+        return False
+    # a local tag can be older than the one in the registry
+    if digest not in [d.split("@", 1)[-1] for d in attrs.get("RepoDigests") or []]:
+        dtslogger.info(f"The image {image} on the host is not up to date, it will be pulled.")
+        return False
+    image_platform = "/".join(
+        filter(None, [attrs.get("Os"), attrs.get("Architecture"), attrs.get("Variant")])
+    )
+    # e.g., `linux/arm64` matches `linux/arm64/v8`
+    if platform is not None and image_platform.split("/")[: len(platform.split("/"))] != platform.split("/"):
+        return False
+    dtslogger.info(f"Loading image {image} ({image_platform}) from the host...")
+    # the image is streamed from one engine to the other without touching the disk
+    for status in destination.api.load_image(source.api.get_image(image)) or []:
+        if "error" in status:
+            raise RuntimeError(f"Could not load image {image}: {status['error']}")
+    dtslogger.info(f"Image loaded: {image}")
+    return True
+
+
+def preload_docker_images(
+    client,
+    images: List[str],
+    platform: Optional[str] = None,
+    workers: int = DOCKER_PRELOAD_WORKERS,
+    seed=None,
+):
+    """
+    Makes the given images available on the engine `client` points to, pulling up to `workers` of them
+    at a time. Images already present (and up to date) on the engine `seed` points to are copied from
+    there instead.
+    """
+    # the engine downloads the layers shared by concurrent pulls only once
+    images = list(dict.fromkeys(images))
+
+    def _preload(image: str):
+        if seed is not None and seed_docker_image(seed, client, image, platform):
+            return
+        pull_docker_image(client, image, platform=platform, progress=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(_preload, image): image for image in images}
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except BaseException:
+                for f in futures:
+                    f.cancel()
+                raise
+            dtslogger.info(f"[{i}/{len(images)}] {futures[future]} ready.")
+
+
+def preload_module_images(
+    partition: str,
+    images: List[str],
+    parsed: argparse.Namespace,
+    dind_image: str = DIND_IMAGE,
+    platform: Optional[str] = None,
+):
+    """
+    Preloads the given images into the Docker engine of the (mounted) `partition`, through an auxiliary
+    Docker engine configured by the build arguments in `parsed`.
+    """
+    local_docker = docker.from_env()
+    docker_dir = os.path.join(PARTITION_MOUNTPOINT(partition), "var", "lib", "docker")
+    with dind_engine(local_docker, docker_dir, dind_image, parsed.docker_mirror) as remote_docker:
+        dtslogger.info("Transferring Docker images...")
+        preload_docker_images(
+            remote_docker,
+            images,
+            platform=platform,
+            workers=parsed.docker_workers,
+            seed=local_docker if parsed.docker_seed else None,
+        )
+        dtslogger.info("Docker images successfully transferred!")
+
+
 def disk_template_partitions(disk_template_dir):
     return list(
         filter(lambda d: os.path.isdir(os.path.join(disk_template_dir, d)), os.listdir(disk_template_dir))
     )
 
 
-def disk_template_objects(disk_template_dir, partition, filter_type):
+def disk_template_tree(disk_template_dir, partition) -> Tuple[List[dict], List[dict]]:
     partition_template_dir = os.path.join(disk_template_dir, partition)
     # check if we know about this partition
     if not os.path.isdir(partition_template_dir):
         raise ValueError(f'Partition "{partition}" not found in disk template.')
+    # walk the partition template dir once, hidden objects are skipped (as `glob` does)
+    directories, files = [], []
+
+    def _object(path):
+        relative = os.path.relpath(path, partition_template_dir)
+        return {
+            "origin": path,
+            "destination": os.path.join(PARTITION_MOUNTPOINT(partition), relative),
+            "relative": "/" + relative,
+        }
+
+    for root, dnames, fnames in os.walk(partition_template_dir):
+        dnames[:] = sorted(d for d in dnames if not d.startswith("."))
+        directories.append(_object(root))
+        files.extend(_object(os.path.join(root, f)) for f in sorted(fnames) if not f.startswith("."))
+    return directories, files
+
+
+def disk_template_objects(disk_template_dir, partition, filter_type):
     # define filtering functions
-    filter_lambdas = {"file": os.path.isfile, "directory": os.path.isdir}
-    if filter_type not in filter_lambdas:
+    filter_types = ["directory", "file"]
+    if filter_type not in filter_types:
         raise ValueError('The argument filter_type can have values from ["file", "directory"].')
-    filter_lambda = filter_lambdas[filter_type]
-    # run glob, this returns absolute path of every file and dir under the partition template dir
-    glob_star = glob.glob(os.path.join(partition_template_dir, "**"), recursive=True)
-    return [
-        {
-            "origin": f,
-            "destination": os.path.join(
-                PARTITION_MOUNTPOINT(partition), os.path.relpath(f, partition_template_dir)
-            ),
-            "relative": "/" + os.path.relpath(f, partition_template_dir),
-        }
-        for f in glob_star
-        if filter_lambda(f)
-    ]
+    return disk_template_tree(disk_template_dir, partition)[filter_types.index(filter_type)]
 
 
-def find_placeholders_on_disk(disk_image):
-    matches = run_cmd(
-        ["strings", "-t", "d", disk_image, "|", "grep", f'"{FILE_PLACEHOLDER_SIGNATURE}"'],
-        get_output=True,
-        shell=True,
-    ).splitlines()
-    # parse matches
-    matches = map(lambda m: m.split(" ", maxsplit=1)[::-1], matches)
-    matches = list(map(lambda m: (m[0], int(m[1])), matches))
-    # fix offset for strings attached to content from contiguous page
+def disk_image_partitions(disk_image: str) -> Dict[int, Tuple[int, int]]:
+    """
+    Returns the extents of the partitions in a disk image as a map partition_id -> (start, end) in bytes.
+    """
+    out = run_cmd(["parted", "--machine", "--script", disk_image, "unit", "B", "print"], get_output=True)
+    partitions = {}
+    for line in out.splitlines():
+        fields = line.rstrip(";").split(":")
+        if not fields[0].isdigit():
+            continue
+        start, end = int(fields[1].rstrip("B")), int(fields[2].rstrip("B"))
+        partitions[int(fields[0])] = (start, end + 1)
+    return partitions
+
+
+def _scan_for_placeholders(disk_image: str, start: int, end: int, limit: int) -> List[Tuple[str, int]]:
+    # finds all the placeholders starting within [start, end), a placeholder can extend up to `limit`
+    signature = FILE_PLACEHOLDER_SIGNATURE.encode()
+    matches = []
+    with open(disk_image, "rb") as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # placeholders crossing the end of the chunk belong to this chunk, look a little further
+        stop = min(end + len(signature) - 1, limit)
+        offset = mm.find(signature, start, stop)
+        while offset != -1:
+            # placeholders end with the first non-printable character (same as `strings`)
+            name = PLACEHOLDER_NAME_RE.match(mm, offset + len(signature), limit)
+            matches.append(((signature + name.group(0)).decode(), offset))
+            offset = mm.find(signature, offset + len(signature), stop)
+    return matches
+
+
+def find_placeholders_on_disk(
+    disk_image: str, extents: Optional[Iterable[Tuple[int, int]]] = None, workers: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    Finds the position of all the placeholders in a disk image. The search can be restricted to a list
+    of extents (start, end) in bytes, e.g., the partitions we are interested in.
+    """
+    size = os.path.getsize(disk_image)
+    extents = [(0, size)] if extents is None else [(max(0, s), min(e, size)) for s, e in extents]
+    # split the extents into chunks and scan them in parallel
+    chunks = []
+    for s, e in sorted(extents):
+        for c in range(s, e, PLACEHOLDER_SCAN_CHUNK_SIZE):
+            chunks.append((disk_image, c, min(c + PLACEHOLDER_SCAN_CHUNK_SIZE, e), e))
+    if not chunks:
+        return {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        matches = list(itertools.chain.from_iterable(pool.map(_scan_for_placeholders, *zip(*chunks))))
+    # make sure matches are unique
+    for pholder, count in collections.Counter(m[0] for m in matches).items():
+        if count > 1:
+            raise ValueError(
+                f'The string "{pholder}" is not unique in the disk image {disk_image}, '
+                f"{count} instances were found!"
+            )
     placeholders = {}
     for string, offset in matches:
-        idx = string.index(FILE_PLACEHOLDER_SIGNATURE)
-        string = string[idx:]
-        placeholders[string] = offset + idx
-        dtslogger.debug(
-            f"Found placeholder {string} at position {placeholders[string]} "
-            f"(match was at {offset} w/ correction of {idx} bytes)."
-        )
-    # make sure matches are unique
-    if len(placeholders) != len(matches):
-        pholders = map(lambda m: m[0], matches)
-        for pholder, count in collections.Counter(pholders).items():
-            if count > 1:
-                raise ValueError(
-                    f'The string "{pholder}" is not unique in the disk image {disk_image}, '
-                    f"{count} instances were found!"
-                )
+        placeholders[string] = offset
+        dtslogger.debug(f"Found placeholder {string} at position {offset}.")
     # ---
     return placeholders
 
 
+def _data_extents(fd: int, size: int) -> List[Tuple[int, int]]:
+    # ranges [start, end) of a (sparse) file that contain data
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, offset))
+    except (OSError, AttributeError):
+        return [(0, size)]
+    return extents
+
+
+def hash_disk_image(disk_image: str, segment_size: int = DISK_IMAGE_SEGMENT_SIZE) -> Tuple[str, dict]:
+    """
+    Computes the SHA256 checksum of a disk image and a map of the hashes of its data segments in a
+    single pass. Holes are not read, they only contribute zeros to the checksum.
+    """
+    fd = os.open(disk_image, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        # segments are aligned to multiples of `segment_size` and never cross a hole
+        ranges = []
+        for start, end in _data_extents(fd, size):
+            while start < end:
+                stop = min(end, (start // segment_size + 1) * segment_size)
+                ranges.append((start, stop - start))
+                start = stop
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        digest = hashlib.new(DISK_IMAGE_HASH_ALGORITHM)
+        zeros = memoryview(bytes(segment_size))
+        segments = []
+        position = 0
+        pbar = ProgressBar(header="Hashing")
+        # read the next segment while the current one is being hashed
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            reads = [pool.submit(os.pread, fd, n, offset) for offset, n in ranges[:1]]
+            for i, (offset, n) in enumerate(ranges):
+                data = reads.pop(0).result()
+                if i + 1 < len(ranges):
+                    reads.append(pool.submit(os.pread, fd, ranges[i + 1][1], ranges[i + 1][0]))
+                if len(data) != n:
+                    raise IOError(f"Short read from {disk_image} at position {offset}.")
+                # holes read as zeros
+                while position < offset:
+                    step = min(offset - position, segment_size)
+                    digest.update(zeros[:step])
+                    position += step
+                digest.update(data)
+                segments.append((offset, n, hashlib.new(DISK_IMAGE_HASH_ALGORITHM, data).hexdigest()))
+                position += n
+                pbar.update(100 * position / max(size, 1))
+        while position < size:
+            step = min(size - position, segment_size)
+            digest.update(zeros[:step])
+            position += step
+        pbar.done()
+    finally:
+        os.close(fd)
+    block_map = {"size": size, "algorithm": DISK_IMAGE_HASH_ALGORITHM, "segments": segments}
+    return digest.hexdigest(), block_map
+
+
+def compress_disk_image(
+    disk_image: str, destination: str, frame_size: int = DISK_IMAGE_FRAME_SIZE, workers: Optional[int] = None
+) -> dict:
+    """
+    Compresses a disk image into a sequence of independent xz streams (frames), in parallel.
+    The result is a regular .xz file, the returned frame index allows consumers to decompress it in
+    parallel as well.
+    """
+    workers = workers or os.cpu_count() or 1
+    fd = os.open(disk_image, os.O_RDONLY)
+    # frames full of zeros (e.g., holes) all compress to the same bytes
+    zeros = {}
+
+    def _compress(offset: int, length: int) -> bytes:
+        data = os.pread(fd, length, offset)
+        if len(data) != length:
+            raise IOError(f"Short read from {disk_image} at position {offset}.")
+        if data.count(0) == length:
+            if length not in zeros:
+                zeros[length] = lzma.compress(data, format=lzma.FORMAT_XZ)
+            return zeros[length]
+        return lzma.compress(data, format=lzma.FORMAT_XZ)
+
+    try:
+        size = os.fstat(fd).st_size
+        offsets = iter(range(0, size, frame_size))
+        frames = []
+        digest = hashlib.sha256()
+        compressed_offset = 0
+        pbar = ProgressBar(header="Compressing")
+        with ThreadPoolExecutor(max_workers=workers) as pool, open(destination, "wb") as fout:
+            # keep a bounded number of frames in memory, written in order
+            pending = collections.deque()
+            for offset in itertools.islice(offsets, workers * 2):
+                pending.append((offset, pool.submit(_compress, offset, min(frame_size, size - offset))))
+            while pending:
+                offset, future = pending.popleft()
+                compressed = future.result()
+                for o in itertools.islice(offsets, 1):
+                    pending.append((o, pool.submit(_compress, o, min(frame_size, size - o))))
+                fout.write(compressed)
+                digest.update(compressed)
+                frames.append([offset, min(frame_size, size - offset), compressed_offset, len(compressed)])
+                compressed_offset += len(compressed)
+                pbar.update(min(100, 100 * (offset + frame_size) / max(size, 1)))
+        pbar.done()
+    finally:
+        os.close(fd)
+    return {"format": "xz", "frame_size": frame_size, "sha256": digest.hexdigest(), "frames": frames}
+
+
+def compress_artifacts(compression: str, out_file_path: Callable[[str], str]):
+    dtslogger.info("Compressing disk image...")
+    if compression == "xz":
+        index = compress_disk_image(out_file_path("img"), out_file_path("img.xz"))
+        # the frame index goes in the metadata, which is published next to the compressed image
+        with open(out_file_path("json"), "rt") as fin:
+            metadata = json.load(fin)
+        metadata["compression"] = index
+        with open(out_file_path("json"), "wt") as fout:
+            json.dump(metadata, fout, indent=4, sort_keys=True)
+    else:
+        run_cmd(["zip", "-j", out_file_path("zip"), out_file_path("img"), out_file_path("json")])
+    dtslogger.info("Done!")
+
+
+def push_artifacts(
+    shell, compression: str, out_file_path: Callable[[str], str], out_file_name: Callable[[str], str]
+):
+    dtslogger.info("Pushing disk image...")
+    artifacts = ["zip"] if compression == "zip" else ["img.xz", "json"]
+    for artifact in artifacts:
+        shell.include.data.push.command(
+            shell,
+            [],
+            parsed=SimpleNamespace(
+                file=[out_file_path(artifact)],
+                object=[os.path.join(DATA_STORAGE_DISK_IMAGE_DIR, out_file_name(artifact))],
+                space="public",
+                token=shell.get_dt1_token(),
+            ),
+        )
+    dtslogger.info("Done!")
+
+
 def get_file_first_line(filepath):
     with open(filepath, "rt") as f:
         try:
@@ -366,17 +778,13 @@ def get_validator_fcn(validators, partition, path):
 def validator_autoboot_stack(shell, local_path, remote_path, **kwargs):
     # get version
     distro = get_distro_version(shell)
-    modules = {
-        DOCKER_IMAGE_TEMPLATE(
-            owner=module["owner"],
-            module=module["module"],
-            version=distro,
-            tag=module["tag"] if "tag" in module else None,
+    modules = set(
+        module_images(
+            distro,
             arch=kwargs.get("arch", DEFAULT_DEVICE_ARCH),
             registry=kwargs.get("registry", DEFAULT_DOCKER_REGISTRY),
         )
-        for module in MODULES_TO_LOAD
-    }
+    )
     # load stack content
     content = yaml.load(open(local_path, "rt"), yaml.SafeLoader)
     for srv_name, srv_info in content["services"].items():
@@ -458,3 +866,270 @@ def transfer_file(disk_template_dir, partition, location):
     _remote_dirpath = os.path.dirname(_remote_filepath)
     run_cmd(["sudo", "mkdir", "-p", _remote_dirpath])
     run_cmd(["sudo", "cp", _local_filepath, _remote_filepath])
+
+
+def clone_file(origin, destination):
+    # create destination directory
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    # copy-on-write copy where the filesystem supports it (e.g., btrfs, xfs), sparse copy otherwise
+    dtslogger.info(f"Cloning [{origin}] -> [{destination}]")
+    run_cmd(["cp", "--reflink=auto", "--sparse=always", origin, destination])
+
+
+def create_disk_image(origin: str, destination: str, size: int):
+    # the disk image is created sparse and only the blocks of `origin` that contain data are written,
+    # zeros take no space and are not read again when the image is hashed or compressed
+    dtslogger.info(f"Creating empty disk image [{destination}]")
+    with open(destination, "wb") as fout:
+        fout.truncate(size)
+    dtslogger.info("Empty disk image created!")
+    dtslogger.info(f"Copying [{origin}] -> [{destination}]")
+    run_cmd(["dd", f"if={origin}", f"of={destination}", f"bs={1024 * 1024}", "conv=sparse,notrunc"])
+
+
+def template_fingerprint(disk_template_dir: str, partition: str, locations: List[List[str]]) -> str:
+    # hash of the content of the given disk template files
+    h = hashlib.sha256()
+    for location in sorted(locations):
+        h.update(json.dumps(location).encode("utf-8"))
+        path = os.path.join(disk_template_dir, partition, *location)
+        # missing files are part of the fingerprint as well
+        if not os.path.isfile(path):
+            h.update(b"\0")
+            continue
+        with open(path, "rb") as fin:
+            for chunk in iter(lambda: fin.read(1024**2), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def file_sha256(path: str) -> Optional[str]:
+    # checksums of (large) files are remembered next to them, for as long as the files do not change
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    memo = f"{path}.sha256.json"
+    try:
+        with open(memo, "rt") as fin:
+            data = json.load(fin)
+        if data["stamp"] == stamp:
+            return data["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+    dtslogger.info(f"Computing the checksum of [{path}]...")
+    sha256 = hash_disk_image(path)[0]
+    try:
+        with open(memo, "wt") as fout:
+            json.dump({"stamp": stamp, "sha256": sha256}, fout)
+    except OSError:
+        pass
+    return sha256
+
+
+def docker_image_digests(client, images: List[str]) -> Optional[Dict[str, str]]:
+    """
+    Resolves the (mutable) tags of the given images to the digests they point to in the registry.
+    Returns None if any of them cannot be resolved (e.g., offline).
+    """
+    images = list(dict.fromkeys(images))
+    try:
+        with ThreadPoolExecutor(max_workers=DOCKER_PRELOAD_WORKERS) as pool:
+            digests = pool.map(lambda image: client.images.get_registry_data(image).id, images)
+            return dict(zip(images, digests))
+    except Exception as e:
+        dtslogger.warning(f"Could not resolve the digests of the Docker images: {e}")
+        return None
+
+
+def apt_release_urls(partition: str) -> List[str]:
+    # the Release files of the APT sources of the mounted partition (runs in a chroot)
+    out = run_cmd_in_partition(partition, "apt-get indextargets --format '\\$(BASE_URI)'", get_output=True)
+    bases = sorted(set(line.strip() for line in out.splitlines() if "://" in line))
+    return [base + "InRelease" for base in bases]
+
+
+@functools.lru_cache(maxsize=None)
+def _fetch_fingerprint(urls: Tuple[str, ...]) -> Optional[str]:
+    h = hashlib.sha256()
+    for url in urls:
+        try:
+            with urllib.request.urlopen(url, timeout=20) as response:
+                data = response.read()
+        except (OSError, ValueError) as e:
+            dtslogger.warning(f"Could not fetch [{url}]: {e}")
+            return None
+        h.update(url.encode("utf-8") + b"\0" + data)
+    return h.hexdigest()
+
+
+def apt_sources_fingerprint(urls: List[str]) -> Optional[str]:
+    """
+    Hash of the current Release files of the given APT sources, they change whenever the content of
+    the sources does. Returns None if any of them cannot be fetched.
+    """
+    return _fetch_fingerprint(tuple(sorted(urls)))
+
+
+def apt_sources_unchanged(meta: dict) -> bool:
+    # snapshots taken after an upgrade are only valid as long as the APT sources did not change
+    apt: Optional[dict] = meta.get("apt", None)
+    if apt is None:
+        return True
+    return apt["fingerprint"] is not None and apt_sources_fingerprint(apt["urls"]) == apt["fingerprint"]
+
+
+class StepCache:
+    """
+    Content-addressed cache of the disk image as it is at the end of each step.
+    Steps are chained in the order their inputs are declared, the key of a step is the hash of the key
+    of the previous step and of the inputs of the step itself, so changing the inputs of a step invalidates
+    the snapshots of that step and of all the steps after it.
+    Inputs can be given as callables, they are only evaluated when the step is cached. Steps with unknown
+    (None) inputs, and the ones after them, are not cached.
+    Snapshots can carry metadata (e.g., the state of external sources they depend on), a snapshot is only
+    used if `validate` (if given) accepts its metadata.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        name: str,
+        inputs: Dict[str, Union[list, Callable[[], list]]],
+        steps: Iterable[str],
+        validate: Optional[Callable[[dict], bool]] = None,
+    ):
+        self._cache_dir = cache_dir
+        self._name = name
+        self._validate = validate
+        self.keys: Dict[str, str] = {}
+        key = ""
+        steps = set(steps)
+        for step, step_inputs in inputs.items():
+            # steps that are not performed do not affect the result
+            if step not in steps:
+                continue
+            step_inputs = step_inputs() if callable(step_inputs) else step_inputs
+            if None in step_inputs:
+                dtslogger.debug(f"Inputs of step '{step}' unknown, it and the steps after it are not cached.")
+                break
+            signature = json.dumps([key, step, step_inputs], sort_keys=True, default=str)
+            key = hashlib.sha256(signature.encode("utf-8")).hexdigest()
+            self.keys[step] = key
+
+    def path(self, step: str) -> str:
+        return os.path.join(self._cache_dir, f"{self._name}.{step}.{self.keys[step][:16]}")
+
+    def meta(self, step: str) -> dict:
+        try:
+            with open(self.path(step) + ".json", "rt") as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self) -> Optional[str]:
+        # the last step of the chain with a valid snapshot, everything up to it can be skipped
+        for step in reversed(list(self.keys)):
+            if not os.path.isfile(self.path(step)):
+                continue
+            if self._validate is None or self._validate(self.meta(step)):
+                return step
+            dtslogger.info(f"The cached result of step '{step}' is out of date.")
+        return None
+
+    def save(self, step: str, disk_image: str, meta: Optional[dict] = None):
+        if step not in self.keys or (os.path.isfile(self.path(step)) and self.meta(step) == (meta or {})):
+            return
+        # snapshots of this step with different inputs are stale
+        for stale in glob.glob(os.path.join(self._cache_dir, f"{self._name}.{step}.*")):
+            os.remove(stale)
+        dtslogger.info(f"Caching step '{step}' [{self.keys[step][:16]}]...")
+        # snapshots are only ever visible when complete, with their metadata
+        tmp = self.path(step) + ".tmp"
+        clone_file(disk_image, tmp)
+        if meta:
+            with open(self.path(step) + ".json", "wt") as fout:
+                json.dump(meta, fout)
+        os.replace(tmp, self.path(step))
+        dtslogger.info(f"Step '{step}' cached.")
+
+
+class PartitionWriter:
+    """
+    Writes directories and files into a mounted partition through a single `sudo tar` process.
+    Existing directories are left untouched, existing files are replaced but keep their mode and owner.
+    """
+
+    # paths are looked up this many at a time
+    METADATA_BATCH_SIZE = 512
+
+    def __init__(self, partition: str):
+        self._mountpoint = PARTITION_MOUNTPOINT(partition)
+        # files are allocated in blocks of this size
+        self.block_size = os.statvfs(self._mountpoint).f_bsize
+        # entries are written on close, once the metadata of the objects they replace is known
+        self._entries: List[Tuple[tarfile.TarInfo, Optional[bytes]]] = []
+
+    def allocated_size(self, size: int) -> int:
+        return -(-size // self.block_size) * self.block_size
+
+    def _path(self, info: tarfile.TarInfo) -> str:
+        return os.path.join(self._mountpoint, "" if info.name == "." else info.name)
+
+    def _metadata(self, paths: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        # the partition belongs to root, its content is not necessarily readable by the current user
+        metadata = {}
+        for i in range(0, len(paths), self.METADATA_BATCH_SIZE):
+            cmd = ["sudo", "find", "-L"] + paths[i : i + self.METADATA_BATCH_SIZE]
+            cmd += ["-maxdepth", "0", "-printf", "%m %U %G %p\\0"]
+            dtslogger.debug("$ %s" % cmd)
+            # paths that do not exist yet are reported on stderr
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+            for line in filter(None, out.decode("utf-8").split("\0")):
+                mode, uid, gid, path = line.split(" ", 3)
+                metadata[path] = (int(mode, 8), int(uid), int(gid))
+        return metadata
+
+    def _info(self, relative: str, mode: int) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(relative.strip("/") or ".")
+        # new objects belong to root
+        info.mode, info.uid, info.gid = stat.S_IMODE(mode), 0, 0
+        return info
+
+    def add_directory(self, relative: str):
+        info = self._info(relative, 0o755)
+        info.type = tarfile.DIRTYPE
+        self._entries.append((info, None))
+
+    def add_file(self, relative: str, data: bytes, mode: int = 0o644):
+        info = self._info(relative, mode)
+        info.size = len(data)
+        self._entries.append((info, data))
+
+    def close(self):
+        if not self._entries:
+            return
+        # replaced objects keep their mode and owner
+        metadata = self._metadata(list(dict.fromkeys(self._path(info) for info, _ in self._entries)))
+        for info, _ in self._entries:
+            if self._path(info) in metadata:
+                info.mode, info.uid, info.gid = metadata[self._path(info)]
+        # modes are applied as they are in the archive, regardless of root's umask
+        cmd = ["sudo", "tar", "-x", "-C", self._mountpoint, "--no-overwrite-dir", "--same-permissions"]
+        dtslogger.debug("$ %s" % cmd)
+        proc = subprocess.Popen(cmd + ["--touch", "-f", "-"], stdin=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for info, data in self._entries:
+                    tar.addfile(info, None if data is None else io.BytesIO(data))
+        finally:
+            self._entries = []
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -116,6 +116,12 @@ class DTCommand(DTCommandAbs):
             default=False,
             help="Run the demo on this machine",
         )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            default=False,
+            help="Ignore the cached discovery data and wait for the device to announce itself",
+        )
 
         parsed = parser.parse_args(args)
 
@@ -175,7 +181,7 @@ class DTCommand(DTCommandAbs):
         if parsed.robot_type == "auto":
             # retrieve robot type from device
             dtslogger.info(f'Waiting for device "{duckiebot_name}"...')
-            _, _, data = wait_for_service("DT::ROBOT_TYPE", duckiebot_name)
+            _, _, data = wait_for_service("DT::ROBOT_TYPE", duckiebot_name, use_cache=not parsed.no_cache)
             parsed.robot_type = data["type"]
             dtslogger.info(f'Detected device type is "{parsed.robot_type}".')
         else:
@@ -185,7 +191,9 @@ class DTCommand(DTCommandAbs):
         if parsed.robot_configuration == "auto":
             # retrieve robot configuration from device
             dtslogger.info(f'Waiting for device "{duckiebot_name}"...')
-            _, _, data = wait_for_service("DT::ROBOT_CONFIGURATION", duckiebot_name)
+            _, _, data = wait_for_service(
+                "DT::ROBOT_CONFIGURATION", duckiebot_name, use_cache=not parsed.no_cache
+            )
             parsed.robot_configuration = data["configuration"]
             dtslogger.info(f'Detected device configuration is "{parsed.robot_configuration}".')
         else:
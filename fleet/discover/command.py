@@ -1,16 +1,19 @@
 import argparse
+import asyncio
+import csv
+import importlib.util
+import io
 import json
 import logging
-import os
-import time
-from collections import defaultdict
-from typing import List, Set
+from typing import List, Dict
 
 from dt_shell import DTCommandAbs, dtslogger
 from utils.duckietown_utils import get_robot_types
-from utils.table_utils import fill_cell, format_matrix
+from utils.table_utils import fill_cell, format_matrix, LiveTable
 
 REFRESH_HZ = 1.0
+DEFAULT_SNAPSHOT_TIMEOUT = 5
+SNAPSHOT_FIELDS = ["hostname", "type", "configuration", "status", "addresses", "port"]
 
 usage = """
 
@@ -22,125 +25,103 @@ usage = """
 
         $ dts fleet discover [options]
 
+    Take a single snapshot and print it in a machine-readable format:
+
+        $ dts fleet discover --once --timeout 5 --format json
+
 """
 
+NOTE = "NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported."
 
-class DiscoverListener:
-    services = defaultdict(dict)
-    supported_services = [
-        "DT::ONLINE",
-        "DT::PRESENCE",
-        "DT::BOOTING",
-        "DT::ROBOT_TYPE",
-        "DT::ROBOT_CONFIGURATION",
+
+def devices_table(devices: Dict[str, dict], filter_type: str = None) -> List[str]:
+    # prepare table
+    columns = [
+        "Status",  # Booting [yellow], Ready [green]
+        # TODO: Internet check is kind of unstable at this time, disabling it
+        # "Internet",  # No [grey], Yes [green]
+        # TODO: People get confused when this is down but the dashboard is up, disabling
+        # "Dashboard",  # Down [grey], Up [green]
+        # TODO: Busy is not used at this time, disabling it
+        # "Busy",  # No [grey], Yes [green]
     ]
+    columns = list(map(lambda c: " %s " % c, columns))
+    header = ["Type", "Model"] + columns + ["Hostname"]
+    data = []
+
+    for device_hostname in sorted(devices):
+        device = devices[device_hostname]
+        # filter by robot type
+        robot_type = device["type"] or "ND"
+        robot_configuration = device["configuration"] or "ND"
+        if filter_type and robot_type != filter_type:
+            continue
+        # prepare status list
+        statuses = []
+        for column in columns:
+            text, color, bg_color = column_to_text_and_color(column, device)
+            column_txt = fill_cell(text, len(column), color, bg_color)
+            statuses.append(column_txt)
+        # prepare row
+        row = [device_hostname, robot_type, robot_configuration] + statuses + [f"{device_hostname}.local"]
+        data.append(row)
+
+    table = format_matrix(header, data, "{:^{}}", "{:<{}}", "{:>{}}", "\n", " | ")
+    return [NOTE, ""] + table.splitlines()
+
+
+async def discover(parsed: argparse.Namespace):
+    # lazy import, zeroconf is only needed here
+    from utils.avahi_utils import AsyncDiscovery
+
+    changed = asyncio.Event()
+    discovery = AsyncDiscovery(on_change=changed.set)
+    renderer = LiveTable()
+    await discovery.start()
+    try:
+        while True:
+            if dtslogger.level > logging.DEBUG:
+                renderer.render(devices_table(discovery.devices(), parsed.filter_type))
+            # wait for something to change (rate-limited)
+            await changed.wait()
+            changed.clear()
+            await asyncio.sleep(1.0 / REFRESH_HZ)
+    finally:
+        await discovery.stop()
+
+
+def snapshot_records(devices: Dict[str, dict], filter_type: str = None) -> List[dict]:
+    records = []
+    for hostname in sorted(devices):
+        device = devices[hostname]
+        if filter_type and device["type"] != filter_type:
+            continue
+        records.append(
+            {
+                "hostname": hostname,
+                "type": device["type"],
+                "configuration": device["configuration"],
+                "status": device["status"],
+                "addresses": device["addresses"],
+                "port": device["port"],
+            }
+        )
+    return records
 
-    def __init__(self, args):
-        self.args = args
-
-    def process_service_name(self, name):
-        name = name.replace("._duckietown._tcp.local.", "")
-        service_parts = name.split("::")
-        if len(service_parts) != 3 or service_parts[0] != "DT":
-            return None, None
-        name = "{}::{}".format(service_parts[0], service_parts[1])
-        server = service_parts[2]
-        return name, server
-
-    def remove_service(self, zeroconf, type, name):
-        dtslogger.debug("SERVICE_REM: %s (%s)" % (str(name), str(type)))
-        name, server = self.process_service_name(name)
-        if not name:
-            return
-        del self.services[name][server]
 
-    def add_service(self, zeroconf, type, sname):
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(sname), str(type)))
-        name, server = self.process_service_name(sname)
-        if not name:
-            return
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(name), str(server)))
-        info = zeroconf.get_service_info(type, sname)
-        if info is None:
-            return
-        dtslogger.debug("SERVICE_ADD: %s" % (str(info)))
-        txt_str: str = list(info.properties.keys())[0].decode("utf-8") if len(info.properties) else "{}"
-        txt: dict = {}
-        if len(txt_str.strip()):
-            try:
-                txt: dict = json.loads(txt_str)
-            except json.JSONDecodeError:
-                dtslogger.error(f"An error occurred while decoding the TXT string '{txt_str}'. A JSON string was "
-                                f"expected.")
-        self.services[name][server] = {"port": info.port, "txt": txt}
-
-    def update_service(self, *args, **kwargs):
-        pass
-
-    def print(self):
-        # clear terminal
-        os.system("cls" if os.name == "nt" else "clear")
-        # get all discovered hostnames
-        hostnames: Set[str] = set()
-
-        for service in self.supported_services:
-            hostnames_for_service: List[str] = list(self.services[service])
-            hostnames.update(hostnames_for_service)
-        # create hostname -> robot_type map
-        hostname_to_type = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_TYPE"]:
-            dev = self.services["DT::ROBOT_TYPE"][device_hostname]
-            if len(dev["txt"]) and "type" in dev["txt"]:
-                try:
-                    hostname_to_type[device_hostname] = dev["txt"]["type"]
-                except:  # XXX: complain a bit
-                    pass
-        # create hostname -> robot_configuration map
-        hostname_to_config = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_CONFIGURATION"]:
-            dev = self.services["DT::ROBOT_CONFIGURATION"][device_hostname]
-            if len(dev["txt"]) and "configuration" in dev["txt"]:
-                try:
-                    hostname_to_config[device_hostname] = dev["txt"]["configuration"]
-                except:
-                    pass
-        # prepare table
-        columns = [
-            "Status",  # Booting [yellow], Ready [green]
-            # TODO: Internet check is kind of unstable at this time, disabling it
-            # "Internet",  # No [grey], Yes [green]
-            # TODO: People get confused when this is down but the dashboard is up, disabling
-            # "Dashboard",  # Down [grey], Up [green]
-            # TODO: Busy is not used at this time, disabling it
-            # "Busy",  # No [grey], Yes [green]
-        ]
-        columns = list(map(lambda c: " %s " % c, columns))
-        header = ["Type", "Model"] + columns + ["Hostname"]
-        data = []
-
-        for device_hostname in list(sorted(hostnames)):
-            # filter by robot type
-            robot_type = hostname_to_type[device_hostname]
-            robot_configuration = hostname_to_config[device_hostname]
-            if self.args.filter_type and robot_type != self.args.filter_type:
-                continue
-            # prepare status list
-            statuses = []
-            for column in columns:
-                text, color, bg_color = column_to_text_and_color(column, device_hostname, self.services)
-                column_txt = fill_cell(text, len(column), color, bg_color)
-                statuses.append(column_txt)
-            # prepare row
-            row = (
-                [device_hostname, robot_type, robot_configuration]
-                + statuses
-                + [str(device_hostname) + ".local"]
-            )
-            data.append(row)
-
-        # print table
-        print("NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported.\n")
-        print(format_matrix(header, data, "{:^{}}", "{:<{}}", "{:>{}}", "\n", " | "))
+def format_snapshot(records: List[dict], fmt: str) -> str:
+    if fmt == "json":
+        return json.dumps(records, indent=4)
+    if fmt == "jsonl":
+        return "\n".join(json.dumps(record) for record in records)
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=SNAPSHOT_FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for record in records:
+            writer.writerow({**record, "addresses": " ".join(record["addresses"])})
+        return buf.getvalue().rstrip("\n")
+    raise ValueError(f"Unknown format '{fmt}'")
 
 
 class DTCommand(DTCommandAbs):
@@ -148,11 +129,13 @@ class DTCommand(DTCommandAbs):
     def command(shell, args):
         prog = "dts fleet discover"
 
-        # try to import zeroconf
+        # make sure zeroconf (and its asyncio API) is available
         try:
-            from zeroconf import ServiceBrowser, Zeroconf
+            has_zeroconf = importlib.util.find_spec("zeroconf.asyncio") is not None
         except ImportError:
-            dtslogger.error("{} requires zeroconf. Use pip to install it.")
+            has_zeroconf = False
+        if not has_zeroconf:
+            dtslogger.error(f"{prog} requires zeroconf. Use pip to install it.")
             return
 
         # parse arguments
@@ -166,39 +149,65 @@ class DTCommand(DTCommandAbs):
             help="Filter devices by type",
         )
 
+        parser.add_argument(
+            "--once",
+            default=False,
+            action="store_true",
+            help="Browse the network for a bounded time, print a snapshot and exit",
+        )
+
+        parser.add_argument(
+            "--timeout",
+            default=DEFAULT_SNAPSHOT_TIMEOUT,
+            type=float,
+            help="How long to browse the network for (in seconds) when taking a snapshot",
+        )
+
+        parser.add_argument(
+            "--format",
+            default="table",
+            choices=["table", "json", "jsonl", "csv"],
+            help="Output format of the snapshot (implies --once when not 'table')",
+        )
+
         parsed = parser.parse_args(args)
 
-        # perform discover
-        zeroconf = Zeroconf()
-        listener = DiscoverListener(args=parsed)
-        # FIXME: @afdaniele - wrong type - listener supposed to be ServiceListener
-        #        should DiscoverListener be a subclass of ServiceListener
-        ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
+        # take a single snapshot
+        if parsed.once or parsed.format != "table":
+            from utils.avahi_utils import discover_devices
 
-        while True:
-            if dtslogger.level > logging.DEBUG:
-                listener.print()
-            time.sleep(1.0 / REFRESH_HZ)
+            devices = discover_devices(timeout=parsed.timeout)
+            if parsed.format == "table":
+                print("\n".join(devices_table(devices, parsed.filter_type)))
+            else:
+                print(format_snapshot(snapshot_records(devices, parsed.filter_type), parsed.format))
+            return
+
+        # perform discover
+        try:
+            asyncio.run(discover(parsed))
+        except KeyboardInterrupt:
+            pass
 
 
-def column_to_text_and_color(column, hostname, services):
+def column_to_text_and_color(column, device):
     column = column.strip()
     text, color, bg_color = "ND", "white", "grey"
     #  -> Status
     if column == "Status":
-        if hostname in services["DT::PRESENCE"]:
+        if device["status"] == "ready":
             text, color, bg_color = "Ready", "white", "green"
-        if hostname in services["DT::BOOTING"]:
+        if device["status"] == "booting":
             text, color, bg_color = "Booting", "white", "yellow"
     #  -> Internet
     if column == "Internet":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::ONLINE"]:
+        if device["online"]:
             text, color, bg_color = "Yes", "white", "green"
     #  -> Busy
     if column == "Busy":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::BUSY"]:
+        if device["busy"]:
             text, color, bg_color = "Yes", "white", "green"
     # ----------
     return text, color, bg_color
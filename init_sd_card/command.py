@@ -1,6 +1,8 @@
 import argparse
+import base64
 import copy
 import getpass
+import itertools
 import json
 import os
 import pathlib
@@ -8,12 +10,12 @@ import re
 import shutil
 import socket
 import subprocess
-import sys
 import time
+import zipfile
 from collections import namedtuple
 from datetime import datetime
 from types import SimpleNamespace
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 
 from math import floor, log2
 
@@ -27,8 +29,6 @@ from utils.duckietown_utils import (
 )
 from utils.exceptions import InvalidUserInput
 from utils.json_schema_form_utils import open_form_from_schema
-from utils.misc_utils import human_time, sudo_open
-from utils.progress_bar import ProgressBar
 from .constants import (
     LIST_DEVICES_CMD,
     TIPS_AND_TRICKS,
@@ -36,19 +36,22 @@ from .constants import (
     WPA_OPEN_NETWORK_CONFIG,
     WPA_PSK_NETWORK_CONFIG,
 )
+from .station import Station
 
 INIT_SD_CARD_VERSION = "2.1.0"  # incremental number, semantic version
 
 Wifi = namedtuple("Wifi", "name ssid psk username password")
 
 TMP_WORKDIR = "/tmp/duckietown/dts/init_sd_card"
-BLOCK_SIZE = 1024**2
+BLOCK_SIZE = 4 * 1024**2
 SAFE_SD_SIZE_MIN = 16
 SAFE_SD_SIZE_MAX = 64
 DEFAULT_ROBOT_TYPE = "duckiebot"
 DEFAULT_WIFI_CONFIG = "duckietown:quackquack"
 COMMAND_DIR = os.path.dirname(os.path.abspath(__file__))
 SUPPORTED_STEPS = ["license", "download", "flash", "setup"]
+# steps that operate on a device
+DEVICE_STEPS = ["flash", "verify", "setup"]
 NVIDIA_LICENSE_FILE = os.path.join(COMMAND_DIR, "nvidia-license.txt")
 ROOT_PARTITIONS = ["root", "APP"]
 
@@ -108,9 +111,9 @@ def BASE_DISK_IMAGE(robot_configuration, experimental=False):
     return board_to_disk_image[board]
 
 
-def DISK_IMAGE_CLOUD_LOCATION(robot_configuration, experimental=False):
+def DISK_IMAGE_CLOUD_LOCATION(robot_configuration, experimental=False, extension="zip"):
     disk_image = BASE_DISK_IMAGE(robot_configuration, experimental)
-    return f"disk_image/{disk_image}.zip"
+    return f"disk_image/{disk_image}.{extension}"
 
 
 class DTCommand(DTCommandAbs):
@@ -120,8 +123,16 @@ class DTCommand(DTCommandAbs):
         # configure parser
         parser.add_argument("--steps", default=",".join(SUPPORTED_STEPS), help="Steps to perform")
         parser.add_argument("--no-steps", default="", help="Steps NOT to perform")
-        parser.add_argument("--hostname", default=None, help="Hostname of the device to flash")
-        parser.add_argument("--device", default=None, help="The SD card device to flash")
+        parser.add_argument(
+            "--hostname",
+            default=None,
+            help="Hostname of the device to flash (comma-separated, one per device)",
+        )
+        parser.add_argument(
+            "--device",
+            default=None,
+            help="The SD card device to flash (comma-separated, flashed concurrently)",
+        )
         parser.add_argument("--country", default="US", help="2-letter country code (US, CA, CH, etc.)")
         parser.add_argument(
             "--wifi",
@@ -194,6 +205,24 @@ class DTCommand(DTCommandAbs):
         parser.add_argument(
             "--workdir", default=TMP_WORKDIR, type=str, help="(Optional) temporary working directory to use"
         )
+        parser.add_argument(
+            "--station",
+            default=False,
+            action="store_true",
+            help="Keep running and initialize every SD card inserted, with the next hostname in --hostname",
+        )
+        parser.add_argument(
+            "--station-match",
+            default=None,
+            type=str,
+            help="(Optional) Only use the devices matching this pattern in station mode (e.g., '/dev/loop*')",
+        )
+        parser.add_argument(
+            "--image-format",
+            default="zip",
+            choices=["zip", "xz"],
+            help="Format of the disk image to download (xz images are decompressed in parallel)",
+        )
         # parse arguments
         parsed = parser.parse_args(args=args)
 
@@ -240,11 +269,25 @@ class DTCommand(DTCommandAbs):
                 steps.remove("license")
         # validate hostname and provide suggestion
         # valid = True, if parsed hostname is valid, or if user accepted the valid suggestion
-        valid, valid_hostname = _validate_hostname(parsed.hostname)
-        if not valid:
-            return
-        else:
-            parsed.hostname = valid_hostname  # gets passed on to other services
+        hostnames = []
+        for hostname in parsed.hostname.split(","):
+            valid, valid_hostname = _validate_hostname(hostname)
+            if not valid:
+                return
+            hostnames.append(valid_hostname)
+        parsed.hostname = ",".join(hostnames)  # gets passed on to other services
+        # many devices can be flashed at once, each one gets its own hostname
+        if len(hostnames) != len(set(hostnames)):
+            dtslogger.error("The same hostname cannot be used for more than one device.")
+            exit(1)
+        num_devices = 1 if parsed.device is None else len(parsed.device.split(","))
+        if parsed.station:
+            if parsed.device is not None or gui:
+                dtslogger.error("The station mode detects the devices, --device and --gui cannot be used.")
+                exit(1)
+        elif len(hostnames) != num_devices:
+            dtslogger.error(f"Expected one hostname per device, got {len(hostnames)} for {num_devices}.")
+            exit(1)
         # default WiFi
         if parsed.wifi is None:
             if parsed.robot_type in WIRED_ROBOT_TYPES:
@@ -340,13 +383,23 @@ class DTCommand(DTCommandAbs):
         data = {
             "robot_configuration": parsed.robot_configuration,
             "disk_zip": in_file("zip"),
+            "disk_xz": in_file("img.xz"),
+            "image_format": parsed.image_format,
             "disk_img": in_file("img"),
             "disk_metadata": in_file("json"),
+            "disk_map": in_file("map.json"),
+            "disk_image_map": in_file("image.map.json"),
             "steps": steps,
         }
         # perform steps
         for step_name in steps:
+            # in station mode, the steps operating on devices are performed for every card inserted
+            if parsed.station and step_name in DEVICE_STEPS:
+                continue
             data.update(step2function[step_name](shell, parsed, data))
+        if parsed.station:
+            _run_station(shell, parsed, data, {s: step2function[s] for s in steps if s in DEVICE_STEPS})
+            return
         # ---
         if "flash" in steps:
             dtslogger.info("Flashing completed successfully!")
@@ -406,9 +459,6 @@ def step_license(_, parsed, __):
 
 
 def step_download(shell, parsed, data):
-    # check if dependencies are met
-    check_program_dependency("unzip")
-
     # clear cache (if requested)
     if parsed.no_cache:
         dtslogger.info("Clearing cache")
@@ -422,8 +472,12 @@ def step_download(shell, parsed, data):
                 shutil.rmtree(parsed.workdir)
     # create temporary dir
     _run_cmd(["mkdir", "-p", parsed.workdir])
+    if parsed.image_format == "xz":
+        _download_xz_disk_image(shell, parsed, data)
+        return {}
     # download zip (if necessary)
     dtslogger.info("Looking for ZIP image file...")
+    downloaded = False
     if not os.path.isfile(data["disk_zip"]):
         dtslogger.info("Downloading ZIP image...")
         # get disk image location on the cloud
@@ -432,16 +486,28 @@ def step_download(shell, parsed, data):
         shell.include.data.get.command(
             shell, [], parsed=SimpleNamespace(object=[disk_image], file=[data["disk_zip"]], space="public")
         )
+        downloaded = True
     else:
         dtslogger.info(f"Reusing cached ZIP image file [{data['disk_zip']}].")
-    # unzip (if necessary)
-    if not os.path.isfile(data["disk_img"]):
-        dtslogger.info("Extracting ZIP image...")
-        _run_cmd(["unzip", data["disk_zip"], "-d", parsed.workdir])
+    # extract the metadata (if necessary), the disk image is streamed out of the ZIP when flashing
+    if downloaded or not os.path.isfile(data["disk_metadata"]):
+        dtslogger.info("Extracting disk image metadata...")
+        with zipfile.ZipFile(data["disk_zip"]) as archive:
+            entry = _find_zip_entry(archive, ".json")
+            with archive.open(entry) as fin, open(data["disk_metadata"], "wb") as fout:
+                shutil.copyfileobj(fin, fout)
     else:
-        dtslogger.info(f"Reusing cached DISK image file [{data['disk_img']}].")
+        dtslogger.info(f"Reusing cached disk image metadata [{data['disk_metadata']}].")
+    # the disk image is checked against the checksum in its metadata while it is flashed (once, right after
+    # downloading it), reading it beforehand would take as long as flashing it
+    if not downloaded:
+        return {}
+    with open(data["disk_metadata"], "rt") as fin:
+        sha256: Optional[str] = json.load(fin).get("sha256", None)
+    if sha256 is None:
+        dtslogger.debug("The disk image metadata does not contain a checksum, skipping verification.")
     # ---
-    return {}
+    return {"disk_image_sha256": sha256}
 
 
 def step_flash(_, parsed, data):
@@ -509,16 +575,21 @@ def step_flash(_, parsed, data):
                 device = txt
         parsed.device = device
 
-    # check if the device exists
-    if parsed.device.startswith("/dev/"):
-        sd_type = "SD"
-        if not os.path.exists(parsed.device):
-            msg = "Device %s was not found on your system. Please, check." % parsed.device
-            raise InvalidUserInput(msg)
-    else:
-        sd_type = "File"
-        if os.path.exists(parsed.device):
-            msg = f"File {parsed.device} already exists, it will be overwritten."
+    # check if the devices exist
+    devices = parsed.device.split(",")
+    if len(devices) != len(parsed.hostname.split(",")):
+        raise InvalidUserInput("Expected one hostname per device.")
+    sd_types = {"SD" if device.startswith("/dev/") else "File" for device in devices}
+    if len(sd_types) > 1:
+        raise InvalidUserInput("You cannot flash SD cards and files at the same time.")
+    sd_type = sd_types.pop()
+    for device in devices:
+        if sd_type == "SD":
+            if not os.path.exists(device):
+                msg = "Device %s was not found on your system. Please, check." % device
+                raise InvalidUserInput(msg)
+        elif os.path.exists(device):
+            msg = f"File {device} already exists, it will be overwritten."
             granted = ask_confirmation(msg)
             if not granted:
                 dtslogger.info("Please retry while specifying a valid device. Bye bye!")
@@ -528,9 +599,10 @@ def step_flash(_, parsed, data):
     if sd_type == "SD":
         # noinspection PyBroadException
         try:
-            dtslogger.info(f"Trying to unmount all partitions from device {parsed.device}")
-            cmd = f"for n in {parsed.device}* ; do umount $n || . ; done"
-            _run_cmd(cmd, shell=True, quiet=True)
+            for device in devices:
+                dtslogger.info(f"Trying to unmount all partitions from device {device}")
+                cmd = f"for n in {device}* ; do umount $n || . ; done"
+                _run_cmd(cmd, shell=True, quiet=True)
             dtslogger.info("All partitions unmounted.")
         except BaseException:
             dtslogger.warn(
@@ -541,19 +613,43 @@ def step_flash(_, parsed, data):
             )
 
     # use dd to flash
-    dtslogger.info("Flashing File[{}] -> {}[{}]:".format(data["disk_img"], sd_type, parsed.device))
+    source = _disk_image_source(data)
+    dtslogger.info("Flashing File[{}] -> {}[{}]:".format(" ".join(source[1:]), sd_type, parsed.device))
     dd_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "dd.py")
     bsize = str(BLOCK_SIZE)
+    # the image is read once and written to all the devices concurrently
     dd_cmd = (["sudo"] if sd_type == "SD" else []) + [
         dd_py,
-        "--input",
-        data["disk_img"],
-        "--output",
-        parsed.device,
+        *source,
+        *itertools.chain.from_iterable(("--output", device) for device in devices),
         "--block-size",
         bsize,
+        "--map",
+        data["disk_map"],
+        "--report",
+        _dd_report(data),
     ]
-    _run_cmd(dd_cmd)
+    # bypass the page cache when writing to a real device, progress then reflects the data on the card
+    if sd_type == "SD":
+        dd_cmd += ["--direct", "--discard"]
+    if data.get("disk_image_sha256", None):
+        dd_cmd += ["--sha256", data["disk_image_sha256"]]
+    if data.get("quiet", False):
+        dd_cmd += ["--quiet"]
+    try:
+        _run_cmd(dd_cmd)
+    except subprocess.CalledProcessError as e:
+        # dd.py exits with 2 when some of the devices failed, the others can still be set up
+        if e.returncode == 2 and _keep_succeeded_devices(parsed, data, "Flashing"):
+            return {"sd_type": sd_type}
+        # dd.py exits with 3 when the image does not match its checksum
+        if e.returncode != 3:
+            raise
+        # do not keep a corrupted image in the cache
+        os.remove(data["disk_zip"])
+        os.remove(data["disk_metadata"])
+        dtslogger.error("The downloaded disk image is corrupted (checksum mismatch). Please, retry.")
+        exit(9)
     # ---
     dtslogger.info("{}[{}] flashed!".format(sd_type, parsed.device))
     return {"sd_type": sd_type}
@@ -561,43 +657,35 @@ def step_flash(_, parsed, data):
 
 def step_verify(_, parsed, data):
     dtslogger.info("Verifying {}[{}]...".format(data.get("sd_type", ""), parsed.device))
-    buf_size = 16 * 1024
-    # create a progress bar to track the progress
-    pbar = ProgressBar(header="Verifying [ETA: ND]")
-    tbytes = os.stat(data["disk_img"]).st_size
-    nbytes = 0
-    stime = time.time()
-    # compare bytes
+    # the flash step stores the hashes of the blocks it writes, the image does not need to be read again
+    dd_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "dd.py")
+    dd_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [
+        dd_py,
+        "--verify",
+        *itertools.chain.from_iterable(("--output", device) for device in parsed.device.split(",")),
+        "--block-size",
+        str(BLOCK_SIZE),
+        "--report",
+        _dd_report(data),
+    ]
+    if os.path.isfile(data["disk_map"]):
+        dd_cmd += ["--map", data["disk_map"]]
+    elif _disk_image_block_map(data):
+        # newer disk images list the hashes of their data segments in the metadata
+        dd_cmd += ["--map", data["disk_image_map"]]
+    else:
+        dtslogger.warning("No map of the flashed blocks was found, the whole image will be verified.")
+        dd_cmd += _disk_image_source(data)
+    if data.get("quiet", False):
+        dd_cmd += ["--quiet"]
     try:
-        with open(data["disk_img"], "rb") as origin:
-            with sudo_open(parsed.device, "rb") as destination:
-                buffer1 = origin.read(buf_size)
-                while buffer1:
-                    buf1_len = len(buffer1)
-                    buffer2 = destination.read(buf1_len)
-                    buf2_len = len(buffer2)
-                    # check lengths, then content
-                    if buf1_len != buf2_len or buffer1 != buffer2:
-                        raise IOError("Mismatch in range position [{}-{}]".format(nbytes, nbytes + buf1_len))
-                    # update progress bar
-                    nbytes += buf1_len
-                    progress = int(100 * (nbytes / tbytes))
-                    pbar.update(progress)
-                    # compute ETA
-                    if progress > 0:
-                        elapsed = time.time() - stime
-                        eta = (100 - progress) * (elapsed / progress)
-                        pbar.set_header("Verifying [ETA: {}]".format(human_time(eta, True)))
-                    # read another chunk
-                    buffer1 = origin.read(buf_size)
-    except IOError as e:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        dtslogger.error(
-            "The verification step failed. Please, try re-flashing.\n" "The error reads:\n\n{}".format(str(e))
-        )
-        exit(5)
-    dtslogger.info("Verified in {}".format(human_time(time.time() - stime)))
+        _run_cmd(dd_cmd)
+    except subprocess.CalledProcessError as e:
+        # dd.py exits with 5 when some of the devices do not match, the others can still be set up
+        if e.returncode != 5 or not _keep_succeeded_devices(parsed, data, "Verification"):
+            dtslogger.error("The verification step failed. Please, try re-flashing.")
+            exit(5)
+        return {}
     # ---
     dtslogger.info("{}[{}] successfully flashed!".format(data.get("sd_type", ""), parsed.device))
     return {}
@@ -605,9 +693,18 @@ def step_verify(_, parsed, data):
 
 def step_setup(shell, parsed, data):
     # check if dependencies are met
-    check_program_dependency("dd")
     check_program_dependency("sudo")
-    check_program_dependency("sync")
+    # each device gets its own hostname
+    for device, hostname in zip(parsed.device.split(","), parsed.hostname.split(",")):
+        device_parsed = copy.copy(parsed)
+        device_parsed.device, device_parsed.hostname = device, hostname
+        if "," in parsed.device:
+            dtslogger.info(f"Setting up {data.get('sd_type', 'SD')}[{device}] as '{hostname}'...")
+        _setup_device(shell, device_parsed, data)
+    return {}
+
+
+def _setup_device(shell, parsed, data):
     # make a copy of the command parameters and remove wifi passwords
     params = copy.deepcopy(parsed.__dict__)
     wfstr = lambda w: w if ":" not in w else (w.split(":")[0] + ":***")
@@ -657,6 +754,7 @@ def step_setup(shell, parsed, data):
     placeholders_dir = os.path.join(COMMAND_DIR, "placeholders", "v" + placeholders_version)
     # perform surgery
     dtslogger.info("Performing surgery on the SD card...")
+    patches = []
     for surgery_bit in surgery_plan:
         dtslogger.info("Performing surgery on [{partition}]:{path}.".format(**surgery_bit))
         # get placeholder info
@@ -691,36 +789,166 @@ def step_setup(shell, parsed, data):
             "Injecting {}/{} bytes ({}%) ".format(used_bytes, block_size, block_usage)
             + "into [{partition}]:{path}.".format(**surgery_bit)
         )
-        # apply change
-        dd_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [
-            "dd",
-            "of={}".format(parsed.device),
-            "bs=1",
-            "count={}".format(block_size),
-            "seek={}".format(block_offset),
-            "conv=notrunc",
-        ]
-        # write twice (found to increase success rate)
-        for wpass in range(2):
-            # launch dd
-            dd = subprocess.Popen(dd_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            dtslogger.debug(f"[{wpass + 1}/2] $ {dd_cmd}")
-            # write
-            dd.stdin.write(masked_content)
-            dd.stdin.flush()
-            dd.stdin.close()
-            dd.wait()
-            # flush I/O buffer
-            _run_cmd(["sync"])
+        patches.append({"offset": block_offset, "data": base64.b64encode(masked_content).decode("ascii")})
+    # apply all changes at once, the patches are passed via stdin as they contain secrets
+    dd_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "dd.py")
+    dd_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [
+        dd_py,
+        "--patch",
+        "--output",
+        parsed.device,
+    ]
+    dtslogger.debug(f"$ {dd_cmd}")
+    dd = subprocess.run(dd_cmd, input=json.dumps(patches).encode())
+    if dd.returncode != 0:
+        dtslogger.error("An error occurred while performing surgery on the SD card. Please, retry.")
+        exit(7)
     dtslogger.info("Surgery went OK!")
-    # flush I/O buffer
-    dtslogger.info("Flushing I/O buffer...")
-    _run_cmd(["sync"])
-    dtslogger.info("Done!")
     # ---
     return {}
 
 
+def _download_xz_disk_image(shell, parsed, data):
+    # the metadata (with the frame index) is published next to the compressed disk image
+    location = lambda ext: DISK_IMAGE_CLOUD_LOCATION(parsed.robot_configuration, parsed.experimental, ext)
+    if not os.path.isfile(data["disk_metadata"]):
+        dtslogger.info("Downloading disk image metadata...")
+        shell.include.data.get.command(
+            shell,
+            [],
+            parsed=SimpleNamespace(object=[location("json")], file=[data["disk_metadata"]], space="public"),
+        )
+    else:
+        dtslogger.info(f"Reusing cached disk image metadata [{data['disk_metadata']}].")
+    with open(data["disk_metadata"], "rt") as fin:
+        compression: Optional[dict] = json.load(fin).get("compression", None)
+    if compression is None or compression.get("format", None) != "xz":
+        os.remove(data["disk_metadata"])
+        dtslogger.error("The disk image is not available in the format 'xz', use '--image-format zip'.")
+        exit(6)
+    if not os.path.isfile(data["disk_xz"]):
+        dtslogger.info("Downloading XZ image...")
+        # the checksum of the compressed image is verified by the download itself
+        shell.include.data.get.command(
+            shell,
+            [],
+            parsed=SimpleNamespace(
+                object=[location("img.xz")],
+                file=[data["disk_xz"]],
+                space="public",
+                sha256=compression.get("sha256", None),
+            ),
+        )
+    else:
+        dtslogger.info(f"Reusing cached XZ image file [{data['disk_xz']}].")
+
+
+def _run_station(shell, parsed, data, steps: Dict[str, Callable]):
+    check_program_dependency("udevadm")
+
+    def _process(device: str, hostname: str) -> int:
+        device_parsed = copy.copy(parsed)
+        device_parsed.device, device_parsed.hostname = device, hostname
+        # cards are processed in parallel, each one keeps its own map of the flashed blocks
+        disk_map = re.sub(r"\.json$", f".{os.path.basename(device)}.json", data["disk_map"])
+        device_data = dict(data, disk_map=disk_map, quiet=True)
+        for step in steps.values():
+            device_data.update(step(shell, device_parsed, device_data))
+        # number of bytes flashed, used to report the throughput of the slot
+        if not os.path.isfile(disk_map):
+            return 0
+        with open(disk_map, "rt") as fin:
+            return sum(length for _, length, digest in json.load(fin)["segments"] if digest is not None)
+
+    # cards are held to the same size window as in the normal flow, around --size if given
+    gb = 1024**3
+    if parsed.size:
+        size_range = (int(0.8 * parsed.size * gb), int(1.2 * parsed.size * gb))
+    else:
+        size_range = (int(0.8 * SAFE_SD_SIZE_MIN * gb), int(1.2 * SAFE_SD_SIZE_MAX * gb))
+
+    def _confirm(device: str, size: int) -> bool:
+        return ask_confirmation(
+            f"The card in {device} ({size / gb:.1f}GB) and every card inserted after it will be erased",
+            default="n",
+            question="Proceed?",
+        )
+
+    # an explicit --station-match is as good as a confirmation
+    station = Station(
+        _process,
+        parsed.hostname.split(","),
+        match=parsed.station_match,
+        size_range=size_range,
+        confirm=None if parsed.station_match else _confirm,
+    )
+    try:
+        station.run()
+    except KeyboardInterrupt:
+        dtslogger.info("Station stopped.")
+    dtslogger.info(f"{len(station.completed)} SD card(s) initialized, {len(station.failed)} failure(s).")
+
+
+def _dd_report(data) -> str:
+    # dd.py writes the outcome of each device here, next to the map of the flashed blocks
+    return re.sub(r"\.json$", ".report.json", data["disk_map"])
+
+
+def _keep_succeeded_devices(parsed, data, action: str) -> bool:
+    """
+    Drops the devices that failed (according to the report of dd.py) from `parsed`, so that the next
+    steps are only performed on the ones that succeeded. Returns False if none did.
+    """
+    if not os.path.isfile(_dd_report(data)):
+        return False
+    with open(_dd_report(data), "rt") as fin:
+        report = json.load(fin)
+    devices, hostnames = [], []
+    for device, hostname in zip(parsed.device.split(","), parsed.hostname.split(",")):
+        if device in report and report[device] is None:
+            devices.append(device)
+            hostnames.append(hostname)
+        else:
+            dtslogger.error(f"[{device}] {action} failed ('{hostname}'): {report.get(device, 'unknown error')}")
+    if not devices:
+        return False
+    parsed.device, parsed.hostname = ",".join(devices), ",".join(hostnames)
+    dtslogger.warning(f"Continuing with the remaining device(s): {parsed.device}")
+    return True
+
+
+def _find_zip_entry(archive: zipfile.ZipFile, extension: str) -> str:
+    entries = [name for name in archive.namelist() if name.endswith(extension)]
+    if len(entries) != 1:
+        dtslogger.error(f"Expected one '{extension}' file in {archive.filename}, found {len(entries)}.")
+        exit(6)
+    return entries[0]
+
+
+def _disk_image_block_map(data) -> bool:
+    # extracts the map of the disk image (if any) from its metadata
+    if not os.path.isfile(data["disk_metadata"]):
+        return False
+    with open(data["disk_metadata"], "rt") as fin:
+        block_map: Optional[dict] = json.load(fin).get("block_map", None)
+    if block_map is None:
+        return False
+    with open(data["disk_image_map"], "wt") as fout:
+        json.dump(block_map, fout)
+    return True
+
+
+def _disk_image_source(data) -> List[str]:
+    # use the extracted disk image if there is one (e.g., cached by older versions), or stream the archive
+    if os.path.isfile(data["disk_img"]):
+        return ["--input", data["disk_img"]]
+    if data["image_format"] == "xz":
+        return ["--input", data["disk_xz"], "--index", data["disk_metadata"]]
+    with zipfile.ZipFile(data["disk_zip"]) as archive:
+        entry = _find_zip_entry(archive, ".img")
+    return ["--input", data["disk_zip"], "--entry", entry]
+
+
 def _validate_hostname(hostname: str):
     # The proper regex for RFC 952 should be:
     # ^(([a-zA-Z]|[a-zA-Z][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z]|[A-Za-z][A-Za-z0-9\-]*[A-Za-z0-9])$
@@ -26,6 +26,17 @@ You can use --no-steps to exclude some steps:
     dts init_sd_card --no-steps download
 
 
+### Many SD cards
+
+You can flash many SD cards at once:
+
+    dts init_sd_card --device /dev/sdb,/dev/sdc --hostname robot1,robot2
+
+or keep a station running, every SD card inserted gets the next hostname:
+
+    dts init_sd_card --station --hostname robot1,robot2,robot3
+
+
 """
 
 LIST_DEVICES_CMD = "lsblk -p --output NAME,TYPE,SIZE,VENDOR | grep --color=never 'disk\|TYPE'"
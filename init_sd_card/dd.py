@@ -2,13 +2,29 @@
 
 import os
 import sys
+import json
 import time
+import errno
+import fcntl
+import mmap
+import queue
+import stat
+import struct
 import logging
 import argparse
+import base64
+import hashlib
+import lzma
 import pathlib
+import threading
+import zipfile
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 logging.basicConfig()
 logger = logging.getLogger("dd")
+logger.setLevel(logging.INFO)
 
 utils_dir = os.path.join(pathlib.Path(__file__).parent.absolute(), "..", "utils")
 sys.path.append(utils_dir)
@@ -16,63 +32,874 @@ sys.path.append(utils_dir)
 import progress_bar
 import misc_utils
 
+# O_DIRECT requires offsets, sizes and buffers aligned to the logical block size of the device
+ALIGNMENT = 4096
+DEFAULT_BLOCK_SIZE = 4 * 1024**2
+DEFAULT_BUFFERS = 4
+# from linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+# written data is hashed in segments of (at most) this size, a mismatch is reported per segment
+SEGMENT_SIZE = 32 * 1024**2
+HASH_ALGORITHM = "sha256"
+# frames of seekable (xz) images decompressed in parallel
+DECOMPRESSION_WORKERS = min(4, os.cpu_count() or 1)
 
-# configure parser
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input", required=True, help="Input device or file")
-parser.add_argument("-o", "--output", required=True, help="Output device or file")
-parser.add_argument("-b", "--block-size", default=1024**2, type=int, help="Block size")
-# parse arguments
-parsed = parser.parse_args()
-
-# make sure source and destination exist
-if not os.path.exists(parsed.input):
-    print(f"Fatal: input `{parsed.input}` not found.")
-if not os.path.exists(parsed.output):
-    print(f"Fatal: output `{parsed.output}` not found.")
-
-# open source and destination
-src_size = os.stat(parsed.input).st_size
-written = 0
-current_progress = 0
-stime = time.time()
-pbar = progress_bar.ProgressBar(header="Flashing [ETA: ND]")
-
-# open resources
-src = open(parsed.input, "rb")
-tgt = open(parsed.output, "wb")
-
-# transfer chunks from source to target
-try:
-    chunk = src.read(parsed.block_size)
-    while chunk:
-        tgt.write(chunk)
-        written += len(chunk)
-        new_progress = int(written / src_size * 100.0)
-        if new_progress != current_progress:
-            # flush buffers and sync before notifying the new progress
-            tgt.flush()
-            os.fsync(tgt.fileno())
+Range = Tuple[int, int]
+# ranges that were not written (holes) have no hash, they are expected to read back as zeros
+Segment = Tuple[int, int, Optional[str]]
+
+
+def read_full(src, buf, size: int) -> int:
+    # fill the buffer unless EOF is reached, short reads would break the alignment of the next blocks
+    view = memoryview(buf)[:size]
+    n = 0
+    while n < size:
+        r = src.readinto(view[n:])
+        if not r:
+            break
+        n += r
+    view.release()
+    return n
+
+
+def write_full(fd: int, buf, n: int, offset: int):
+    view = memoryview(buf)[:n]
+    while len(view):
+        w = os.pwrite(fd, view, offset)
+        view = view[w:]
+        offset += w
+    view.release()
+
+
+def is_zero(buf, n: int, zeros: bytes) -> bool:
+    return buf[:n] == (zeros if n == len(zeros) else zeros[:n])
+
+
+def merge_ranges(ranges: List[Range], size: int, align: int = 1) -> List[Range]:
+    # align ranges outwards and merge the ones that overlap or touch
+    out: List[List[int]] = []
+    for offset, length in sorted(ranges):
+        start = offset - offset % align
+        end = min(size, -(-(offset + length) // align) * align)
+        if out and start <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], end)
+        elif end > start:
+            out.append([start, end])
+    return [(start, end - start) for start, end in out]
+
+
+def complement_ranges(ranges: List[Range], size: int) -> List[Range]:
+    out: List[Range] = []
+    cursor = 0
+    for offset, length in ranges:
+        if offset > cursor:
+            out.append((cursor, offset - cursor))
+        cursor = max(cursor, offset + length)
+    if cursor < size:
+        out.append((cursor, size - cursor))
+    return out
+
+
+def data_extents(fd: int, size: int) -> List[Range]:
+    """
+    Returns the ranges of a file that contain data, i.e., without the holes of sparse files.
+    The whole file is returned when holes cannot be detected.
+    """
+    seek_data, seek_hole = getattr(os, "SEEK_DATA", None), getattr(os, "SEEK_HOLE", None)
+    if seek_data is None or not stat.S_ISREG(os.fstat(fd).st_mode):
+        return [(0, size)]
+    extents: List[Range] = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, seek_data)
+            except OSError as e:
+                # no more data after `offset`
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            end = os.lseek(fd, start, seek_hole)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return [(0, size)]
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return merge_ranges(extents, size, ALIGNMENT)
+
+
+class FrameReader:
+    """
+    Reads an image compressed as a sequence of independent xz streams (frames), as described by the
+    frame index [(offset, length, compressed_offset, compressed_length), ...]. The frames that follow
+    the one being read are decompressed in parallel.
+    """
+
+    def __init__(self, path: str, frames: List[list], workers: int = DECOMPRESSION_WORKERS):
+        position = 0
+        for offset, length, _, _ in frames:
+            if offset != position:
+                raise ValueError(f"The frame index of `{path}` is not contiguous at byte {position}.")
+            position += length
+        self.size = position
+        self._fd = os.open(path, os.O_RDONLY)
+        self._frames = collections.deque(frames)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._window = workers + 1
+        self._pending: collections.deque = collections.deque()
+        self._data = memoryview(b"")
+
+    def _decompress(self, frame: list) -> bytes:
+        offset, length, compressed_offset, compressed_length = frame
+        compressed = os.pread(self._fd, compressed_length, compressed_offset)
+        # xz streams carry their own checksum, corrupted frames are detected here
+        data = lzma.decompress(compressed, format=lzma.FORMAT_XZ)
+        if len(data) != length:
+            raise ValueError(f"The frame at byte {offset} has {len(data)} bytes, expected {length}.")
+        return data
+
+    def readinto(self, buf) -> int:
+        if not self._data:
+            while self._frames and len(self._pending) < self._window:
+                self._pending.append(self._pool.submit(self._decompress, self._frames.popleft()))
+            if not self._pending:
+                return 0
+            self._data = memoryview(self._pending.popleft().result())
+        n = min(len(buf), len(self._data))
+        buf[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+    def close(self):
+        self._frames.clear()
+        self._pool.shutdown(wait=True)
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def open_source(path: str, entry: Optional[str] = None, index: Optional[str] = None):
+    # seekable xz images are decompressed on the fly, in parallel
+    if index is not None:
+        with open(index, "rt") as fin:
+            compression = json.load(fin).get("compression", {})
+        if compression.get("format", None) != "xz":
+            raise ValueError(f"The index `{index}` does not describe an xz image.")
+        src = FrameReader(path, compression["frames"])
+        return src, src.size
+    # disk images can be streamed straight out of a zip archive, decompressing on the fly
+    if entry is not None:
+        archive = zipfile.ZipFile(path)
+        try:
+            info = archive.getinfo(entry)
+        except KeyError:
+            archive.close()
+            raise ValueError(f"The archive `{path}` does not contain the entry `{entry}`.")
+        return archive.open(info), info.file_size
+    src = open(path, "rb", buffering=0)
+    return src, os.fstat(src.fileno()).st_size
+
+
+def open_target(path: str, direct: bool):
+    flags = os.O_WRONLY
+    if not (os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode)):
+        flags |= os.O_CREAT | os.O_TRUNC
+    if direct:
+        o_direct = getattr(os, "O_DIRECT", 0)
+        if not o_direct:
+            logger.warning("Direct I/O is not supported on this platform, using buffered I/O instead.")
+        else:
+            try:
+                return os.open(path, flags | o_direct, 0o644), True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                logger.warning(f"Direct I/O is not supported by `{path}`, using buffered I/O instead.")
+    return os.open(path, flags, 0o644), False
+
+
+def disable_direct_io(fd: int):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~getattr(os, "O_DIRECT", 0))
+
+
+def discard_zeroes_data(fd: int) -> bool:
+    # only some devices guarantee that discarded blocks read back as zeros
+    rdev = os.fstat(fd).st_rdev
+    sysfs = f"/sys/dev/block/{os.major(rdev)}:{os.minor(rdev)}"
+    # partitions share the queue of their disk
+    for queue_dir in [os.path.join(sysfs, "queue"), os.path.join(sysfs, "..", "queue")]:
+        try:
+            with open(os.path.join(queue_dir, "discard_zeroes_data"), "rt") as fin:
+                return fin.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def discard(fd: int, ranges: List[Range]) -> List[Range]:
+    # best effort, not all devices (e.g., most USB card readers) support discard
+    # returns the ranges that were not discarded
+    for i, (offset, length) in enumerate(ranges):
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", offset, length))
+        except OSError as e:
+            logger.warning(f"The device does not support discarding unused blocks ({e.strerror}).")
+            return ranges[i:]
+    return []
+
+
+def zero_out(fd: int, ranges: List[Range], block_size: int):
+    # the kernel offloads zeroing to the device when possible and writes zeros itself otherwise
+    zeros: Optional[bytes] = None
+    for offset, length in ranges:
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+            continue
+        except OSError as e:
+            logger.debug(f"BLKZEROOUT failed at byte {offset} ({e.strerror}), writing zeros instead.")
+        if zeros is None:
+            disable_direct_io(fd)
+            zeros = bytes(block_size)
+        end = offset + length
+        while offset < end:
+            n = min(block_size, end - offset)
+            write_full(fd, zeros, n, offset)
+            offset += n
+
+
+class BlockReader(threading.Thread):
+    """
+    Reads the given ranges of the source into a ring of page-aligned buffers, the consumer gets
+    (offset, buffer, length) tuples from `filled` and gives buffers back to the ring once they are
+    written. Blocks made of zeros are returned with no buffer when `skip_zeros` is set.
+    When `hashing` is set, the blocks returned with a buffer are also hashed (in segments) while
+    they are read, the result is available in `segments` once the reader is done.
+    When `checksum` is set, everything read is also hashed as a whole, in `checksum`. The gaps between
+    the ranges (and up to `size`, if given) are hashed as the zeros they stand for.
+    """
+
+    def __init__(
+        self,
+        src,
+        ranges: List[Range],
+        block_size: int,
+        buffers: int,
+        skip_zeros: bool = False,
+        hashing: bool = False,
+        checksum: bool = False,
+        size: Optional[int] = None,
+    ):
+        super(BlockReader, self).__init__(daemon=True)
+        self._src = src
+        self._ranges = ranges
+        self._size = size
+        self._block_size = block_size
+        self._zeros: Optional[bytes] = bytes(block_size) if skip_zeros else None
+        self._hashing = hashing
+        self._segment: Optional[list] = None
+        self.segments: List[Segment] = []
+        self.checksum = hashlib.new(HASH_ALGORITHM) if checksum else None
+        self.ring: queue.Queue = queue.Queue()
+        self.filled: queue.Queue = queue.Queue()
+        for _ in range(buffers):
+            # anonymous maps are page-aligned, as required by O_DIRECT
+            self.ring.put(mmap.mmap(-1, block_size))
+
+    def run(self):
+        try:
+            position = 0
+            for offset, length in self._ranges:
+                if offset != position:
+                    self._hash_gap(position, offset)
+                    self._src.seek(offset)
+                end = offset + length
+                while offset < end:
+                    buf = self.ring.get()
+                    size = min(self._block_size, end - offset)
+                    n = read_full(self._src, buf, size)
+                    if n < size:
+                        raise EOFError(f"Unexpected end of input at byte {offset + n}")
+                    if self.checksum is not None:
+                        with memoryview(buf) as view:
+                            self.checksum.update(view[:n])
+                    if self._zeros is not None and is_zero(buf, n, self._zeros):
+                        self.ring.put(buf)
+                        buf = None
+                    elif self._hashing:
+                        self._hash(offset, buf, n)
+                    self.filled.put((offset, buf, n))
+                    offset += n
+                position = offset
+            if self._size is not None:
+                self._hash_gap(position, self._size)
+            self._close_segment()
+        except BaseException as e:
+            self.filled.put(e)
+            return
+        self.filled.put(None)
+
+    def _hash_gap(self, start: int, end: int):
+        if self.checksum is None:
+            return
+        zeros = memoryview(bytes(min(self._block_size, max(0, end - start))))
+        while start < end:
+            n = min(len(zeros), end - start)
+            self.checksum.update(zeros[:n])
+            start += n
+
+    def _hash(self, offset: int, buf, n: int):
+        # contiguous blocks are hashed together, up to SEGMENT_SIZE bytes
+        segment = self._segment
+        if segment is None or segment[0] + segment[1] != offset or segment[1] + n > SEGMENT_SIZE:
+            self._close_segment()
+            segment = self._segment = [offset, 0, hashlib.new(HASH_ALGORITHM)]
+        with memoryview(buf) as view:
+            segment[2].update(view[:n])
+        segment[1] += n
+
+    def _close_segment(self):
+        if self._segment is not None:
+            offset, length, digest = self._segment
+            self.segments.append((offset, length, digest.hexdigest()))
+            self._segment = None
+
+
+def read_map(map_path: str) -> List[Segment]:
+    with open(map_path, "rt") as fin:
+        data = json.load(fin)
+    if data.get("algorithm", None) != HASH_ALGORITHM:
+        raise ValueError(f"The map `{map_path}` was not created by this version of the tool.")
+    return [tuple(segment) for segment in data["segments"]]
+
+
+def write_map(map_path: str, size: int, segments: List[Segment]):
+    with open(map_path, "wt") as fout:
+        json.dump({"size": size, "algorithm": HASH_ALGORITHM, "segments": segments}, fout)
+
+
+def hash_image(
+    src_path: str, entry: Optional[str], index: Optional[str], block_size: int, buffers: int
+) -> List[Segment]:
+    src, size = open_source(src_path, entry, index)
+    with src:
+        reader = BlockReader(src, [(0, size)], block_size, buffers, hashing=True)
+        reader.start()
+        progress = Progress("Hashing", size)
+        done = 0
+        while True:
+            item = reader.filled.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            _, buf, n = item
+            reader.ring.put(buf)
+            done += n
+            progress.update(done, done)
+    progress.pbar.update(100)
+    return reader.segments
+
+
+class Progress:
+    # progress bars are not shown when quiet
+    buffer = sys.stdout
+    # with more than one target, the progress of each target is logged in steps of this many percent
+    TARGET_STEP = 25
+
+    def __init__(self, action: str, total: int, targets: List[str] = ()):
+        self._action = action
+        self._total = max(1, total)
+        self._current = 0
+        self._stime = time.time()
+        self._targets = {target: 0 for target in targets} if len(targets) > 1 else {}
+        self.pbar = progress_bar.ProgressBar(buf=self.buffer, header=f"{action} [ETA: ND]")
+
+    def update_target(self, target: str, fraction: float):
+        if target not in self._targets:
+            return
+        percent = int(fraction * 100) // self.TARGET_STEP * self.TARGET_STEP
+        if percent > self._targets[target]:
+            self._targets[target] = percent
+            logger.info(f"[{target}] {self._action}: {percent}%")
+
+    def update(self, done: int, transferred: int):
+        new_progress = int(done / self._total * 100.0)
+        if new_progress != self._current:
             # update progress and progress bar
-            current_progress = new_progress
-            pbar.update(current_progress)
-            # compute ETA
-            elapsed = time.time() - stime
-            eta = (100 - current_progress) * (elapsed / current_progress)
-            pbar.set_header("Flashing [ETA: {}]".format(misc_utils.human_time(eta, True)))
-        # read next chunk
-        chunk = src.read(parsed.block_size)
-    # flus`h I/O buffer
-    logger.info("Flushing I/O buffer...")
-    os.fsync(tgt.fileno())
-    logger.info("`Done!")
-except KeyboardInterrupt:
-    pass
-finally:
-    # close resources
-    src.close()
-    tgt.close()
-
-# jump to 100% if success
-pbar.update(100)
-logger.info("Flashed in {}".format(misc_utils.human_time(time.time() - stime)))
+            self._current = new_progress
+            self.pbar.update(self._current)
+            # compute ETA and throughput
+            elapsed = time.time() - self._stime
+            eta = (100 - self._current) * (elapsed / self._current)
+            speed = misc_utils.human_size(transferred / max(elapsed, 1e-6))
+            self.pbar.set_header(
+                "{} [ETA: {}, {}/s]".format(self._action, misc_utils.human_time(eta, True), speed)
+            )
+
+
+class TargetWriter(threading.Thread):
+    """
+    Writes the blocks it is given to one target and gives them back through `release`.
+    A target that fails stops writing, the other targets are not affected.
+    """
+
+    def __init__(self, path: str, direct: bool, release):
+        super(TargetWriter, self).__init__(daemon=True)
+        self.path = path
+        self.fd, self.direct = open_target(path, direct)
+        self.is_file = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.blocks: queue.Queue = queue.Queue()
+        self.written = 0
+        self.written_ranges: List[Range] = []
+        # bytes of the image processed (written or skipped) by this target
+        self.done = 0
+        self.error: Optional[BaseException] = None
+        self.elapsed = 0.0
+        self._release = release
+        self._stime = time.time()
+
+    def run(self):
+        while True:
+            item = self.blocks.get()
+            if item is None:
+                break
+            offset, buf, n, done = item
+            try:
+                if self.error is None and buf is not None:
+                    self._write(offset, buf, n)
+            except OSError as e:
+                self.error = e
+            finally:
+                if buf is not None:
+                    self._release(buf)
+                self.done = done
+
+    def _write(self, offset: int, buf, n: int):
+        # the last block might not be aligned
+        if self.direct and n % ALIGNMENT != 0:
+            disable_direct_io(self.fd)
+            self.direct = False
+        write_full(self.fd, buf, n, offset)
+        self.written += n
+        # keep track of what was actually written
+        if self.written_ranges and sum(self.written_ranges[-1]) == offset:
+            self.written_ranges[-1] = (self.written_ranges[-1][0], self.written_ranges[-1][1] + n)
+        else:
+            self.written_ranges.append((offset, n))
+
+    def finish(self, size: int, discard_holes: bool, block_size: int):
+        try:
+            if self.error is not None:
+                return
+            # files keep the size of the image, unmapped ranges become holes
+            if self.is_file:
+                os.ftruncate(self.fd, size)
+            else:
+                # devices still hold old data where nothing was written, the holes of the image are zeroed
+                holes = complement_ranges(self.written_ranges, size)
+                if holes and discard_holes and discard_zeroes_data(self.fd):
+                    holes = discard(self.fd, holes)
+                zero_out(self.fd, holes, block_size)
+                zeroed = misc_utils.human_size(size - sum(length for _, length in self.written_ranges))
+                logger.debug(f"[{self.path}] Zeroed {zeroed}")
+            # flush I/O buffer (only once, at the end)
+            os.fsync(self.fd)
+        except OSError as e:
+            self.error = e
+        finally:
+            os.close(self.fd)
+            self.elapsed = time.time() - self._stime
+
+
+def flash(
+    src_path: str,
+    entry: Optional[str],
+    index: Optional[str],
+    tgt_paths: List[str],
+    block_size: int,
+    buffers: int,
+    direct: bool,
+    sparse: bool,
+    discard_holes: bool,
+    map_path: Optional[str],
+    sha256: Optional[str],
+    report_path: Optional[str],
+):
+    # open resources
+    src, src_size = open_source(src_path, entry, index)
+    # only the ranges of the image that contain data are transferred (holes are only known for files)
+    extents = [(0, src_size)]
+    if sparse and entry is None and index is None:
+        extents = data_extents(src.fileno(), src_size)
+    mapped = sum(length for _, length in extents)
+    if sparse:
+        size_txt, mapped_txt = misc_utils.human_size(src_size), misc_utils.human_size(mapped)
+        logger.info(f"Image size: {size_txt}, mapped: {mapped_txt}")
+    # the image is read once, every block goes to all the targets and back to the ring once written by all
+    references = {}
+    lock = threading.Lock()
+
+    def release(buf):
+        with lock:
+            references[id(buf)] -= 1
+            if references[id(buf)] > 0:
+                return
+            del references[id(buf)]
+        reader.ring.put(buf)
+
+    writers = [TargetWriter(tgt_path, direct, release) for tgt_path in tgt_paths]
+    # blocks of zeros are not written, they end up in holes of files and are zeroed (or discarded) on
+    # devices once everything else is written
+    skip_zeros = sparse
+    # the image is hashed while it is read, so that it does not need to be read again to verify,
+    # skipped blocks and holes are zeros and are verified as such
+    reader = BlockReader(
+        src,
+        extents,
+        block_size,
+        buffers,
+        skip_zeros=skip_zeros,
+        hashing=map_path is not None,
+        checksum=sha256 is not None,
+        size=src_size,
+    )
+    for writer in writers:
+        writer.start()
+    reader.start()
+    progress = Progress("Flashing", mapped, tgt_paths)
+    # targets that fail are reported right away, the others keep going
+    failures = set()
+
+    def _report():
+        for writer in writers:
+            if writer.error is None:
+                progress.update_target(writer.path, writer.done / max(1, mapped))
+            elif writer.path not in failures:
+                failures.add(writer.path)
+                logger.error(f"[{writer.path}] Flashing failed: {writer.error}")
+
+    # transfer blocks from source to targets
+    done = 0
+    try:
+        while True:
+            item = reader.filled.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            offset, buf, n = item
+            done += n
+            if buf is not None:
+                with lock:
+                    references[id(buf)] = len(writers)
+            # skipped blocks are passed along too, they count towards the progress of each target
+            for writer in writers:
+                writer.blocks.put((offset, buf, n, done))
+            progress.update(done, min(writer.written for writer in writers))
+            _report()
+        for writer in writers:
+            writer.blocks.put(None)
+        for writer in writers:
+            writer.join()
+        logger.info("Flushing I/O buffer...")
+        finishers = [
+            threading.Thread(target=writer.finish, args=(src_size, discard_holes, block_size), daemon=True)
+            for writer in writers
+        ]
+        for finisher in finishers:
+            finisher.start()
+        for finisher in finishers:
+            finisher.join()
+        _report()
+        logger.info("Done!")
+    except KeyboardInterrupt:
+        exit(1)
+    finally:
+        # close resources
+        src.close()
+
+    # store the map (and hashes) of the blocks written, used for verification, what was skipped must be zeros
+    if map_path:
+        written: List[Range] = [(offset, length) for offset, length, _ in reader.segments]
+        holes: List[Segment] = [
+            (offset, length, None) for offset, length in complement_ranges(written, src_size)
+        ]
+        write_map(map_path, src_size, sorted(reader.segments + holes))
+
+    # jump to 100% if success
+    progress.pbar.update(100)
+    # the image is checked while it is flashed, it does not need to be read beforehand
+    if sha256 is not None and reader.checksum.hexdigest() != sha256:
+        logger.error("The image does not match its checksum, it is corrupted.")
+        exit(3)
+    for writer in writers:
+        if writer.error is not None:
+            continue
+        logger.info(
+            "[{}] Flashed {} in {} ({}/s)".format(
+                writer.path,
+                misc_utils.human_size(writer.written),
+                misc_utils.human_time(writer.elapsed),
+                misc_utils.human_size(writer.written / max(writer.elapsed, 1e-6)),
+            )
+        )
+    if report_path:
+        write_report(report_path, {writer.path: writer.error for writer in writers})
+    if failures:
+        exit(2)
+
+
+def write_report(report_path: str, errors: dict):
+    # the outcome of each target (None if successful), lets the caller go on with the targets that succeeded
+    with open(report_path, "wt") as fout:
+        json.dump({target: None if error is None else str(error) for target, error in errors.items()}, fout)
+
+
+def verify_target(tgt_path: str, block_size: int, buffers: int, segments: List[Segment], counter: list):
+    """
+    Compares the target with the hashes of the given segments, returns the first mismatching range
+    (if any). The number of bytes verified is kept up to date in `counter[0]`.
+    """
+    # read the device in the background while this thread hashes
+    tgt = open(tgt_path, "rb", buffering=0)
+    # drop cached pages, we want to read what is on the device
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(tgt.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    reader = BlockReader(tgt, [(offset, length) for offset, length, _ in segments], block_size, buffers)
+    reader.start()
+    zeros = bytes(block_size)
+    # compare hashes, segment by segment, holes are compared with zeros
+    try:
+        for offset, length, expected in segments:
+            digest = hashlib.new(HASH_ALGORITHM)
+            match = True
+            remaining = length
+            while remaining > 0:
+                item = reader.filled.get()
+                if item is None:
+                    raise EOFError("Unexpected end of device")
+                if isinstance(item, BaseException):
+                    raise item
+                _, buf, n = item
+                if expected is None:
+                    match = match and is_zero(buf, n, zeros)
+                else:
+                    with memoryview(buf) as view:
+                        digest.update(view[:n])
+                reader.ring.put(buf)
+                remaining -= n
+                counter[0] += n
+            if not match or (expected is not None and digest.hexdigest() != expected):
+                return offset, offset + length
+    finally:
+        tgt.close()
+    return None
+
+
+def verify(
+    tgt_paths: List[str], block_size: int, buffers: int, segments: List[Segment], report_path: Optional[str]
+):
+    stime = time.time()
+    total = sum(length for _, length, _ in segments)
+    progress = Progress("Verifying", total * len(tgt_paths), tgt_paths)
+    # targets are verified in parallel
+    results = {}
+    counters = {tgt_path: [0] for tgt_path in tgt_paths}
+
+    def _verify(tgt_path: str):
+        try:
+            results[tgt_path] = verify_target(tgt_path, block_size, buffers, segments, counters[tgt_path])
+        except (OSError, EOFError) as e:
+            results[tgt_path] = e
+
+    workers = [threading.Thread(target=_verify, args=(tgt_path,), daemon=True) for tgt_path in tgt_paths]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            done = sum(counter[0] for counter in counters.values())
+            progress.update(done, done)
+            for tgt_path, counter in counters.items():
+                progress.update_target(tgt_path, counter[0] / max(1, total))
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        exit(1)
+
+    progress.pbar.update(100)
+    elapsed = time.time() - stime
+    errors = {}
+    for tgt_path in tgt_paths:
+        result = results.get(tgt_path, None)
+        errors[tgt_path] = None
+        if isinstance(result, BaseException):
+            errors[tgt_path] = result
+            logger.error(f"[{tgt_path}] Verification failed: {result}")
+        elif result is not None:
+            errors[tgt_path] = "Mismatch in range position [{}-{}]".format(*result)
+            logger.error(f"[{tgt_path}] {errors[tgt_path]}")
+        else:
+            logger.info(
+                "[{}] Verified {} in {} ({}/s)".format(
+                    tgt_path,
+                    misc_utils.human_size(total),
+                    misc_utils.human_time(elapsed),
+                    misc_utils.human_size(total / max(elapsed, 1e-6)),
+                )
+            )
+    if report_path:
+        write_report(report_path, errors)
+    if any(error is not None for error in errors.values()):
+        exit(5)
+
+
+def patch(tgt_path: str, patches: List[dict], attempts: int = 2):
+    """
+    Writes all the patches (dicts with `offset` and base64-encoded `data`) with a single open
+    of the target, in offset order, syncs once and reads the patched ranges back to verify them.
+    """
+    patches = sorted(((int(p["offset"]), base64.b64decode(p["data"])) for p in patches), key=lambda p: p[0])
+    tgt = os.open(tgt_path, os.O_RDWR)
+    try:
+        pending = patches
+        for attempt in range(attempts):
+            for offset, data in pending:
+                write_full(tgt, data, len(data), offset)
+            os.fsync(tgt)
+            # drop cached pages, we want to read what is on the device
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(tgt, 0, 0, os.POSIX_FADV_DONTNEED)
+            pending = [(offset, data) for offset, data in pending if os.pread(tgt, len(data), offset) != data]
+            if not pending:
+                break
+            logger.warning(f"[{attempt + 1}/{attempts}] {len(pending)} patch(es) did not stick, rewriting...")
+    finally:
+        os.close(tgt)
+    if pending:
+        for offset, data in pending:
+            logger.error("Mismatch in range position [{}-{}]".format(offset, offset + len(data)))
+        exit(5)
+    logger.info(f"Applied {len(patches)} patch(es), {sum(len(d) for _, d in patches)} bytes.")
+
+
+if __name__ == "__main__":
+    # configure parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", default=None, help="Input device or file")
+    parser.add_argument(
+        "-e", "--entry", default=None, help="Name of the image inside the (zip) archive given as input"
+    )
+    parser.add_argument(
+        "--index", default=None, help="Metadata (JSON) with the frame index of the (xz) image given as input"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        action="append",
+        help="Output device or file (can be given multiple times, the image is read only once)",
+    )
+    parser.add_argument("-b", "--block-size", default=DEFAULT_BLOCK_SIZE, type=int, help="Block size")
+    parser.add_argument(
+        "-n",
+        "--buffers",
+        default=DEFAULT_BUFFERS,
+        type=int,
+        help="Number of buffers shared by reader and writer",
+    )
+    parser.add_argument("--direct", default=False, action="store_true", help="Use direct I/O (O_DIRECT)")
+    parser.add_argument(
+        "--no-sparse",
+        dest="sparse",
+        default=True,
+        action="store_false",
+        help="Write all the blocks of the image, including holes and blocks full of zeros",
+    )
+    parser.add_argument(
+        "--discard",
+        default=False,
+        action="store_true",
+        help="Discard (instead of zeroing) the holes of the image on devices that read them back as zeros",
+    )
+    parser.add_argument("--map", default=None, help="Map of the written blocks (written when flashing)")
+    parser.add_argument(
+        "--sha256", default=None, help="Expected checksum of the image, checked while flashing (exit code 3)"
+    )
+    parser.add_argument(
+        "--verify",
+        default=False,
+        action="store_true",
+        help="Verify the output against the hashes in --map (or against --input, if no map is given)",
+    )
+    parser.add_argument(
+        "--patch",
+        default=False,
+        action="store_true",
+        help="Apply the patches read (as JSON) from stdin to the output, then verify them",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="Where to write the outcome (JSON) of each output, when flashing or verifying",
+    )
+    parser.add_argument("-q", "--quiet", default=False, action="store_true", help="Do not show progress bars")
+    # parse arguments
+    parsed = parser.parse_args()
+    if parsed.quiet:
+        Progress.buffer = open(os.devnull, "wt")
+
+    # patches are written in place, nothing else is needed
+    if parsed.patch:
+        if len(parsed.output) != 1 or not os.path.exists(parsed.output[0]):
+            print("Fatal: exactly one (existing) output is needed to apply patches.")
+            exit(1)
+        patch(parsed.output[0], json.load(sys.stdin))
+        exit(0)
+
+    # make sure source and destination exist
+    if parsed.input is None and not (parsed.verify and parsed.map):
+        print("Fatal: an input is required.")
+        exit(1)
+    if parsed.input is not None and not os.path.exists(parsed.input):
+        print(f"Fatal: input `{parsed.input}` not found.")
+        exit(1)
+    for output in parsed.output if parsed.verify else []:
+        if not os.path.exists(output):
+            print(f"Fatal: output `{output}` not found.")
+            exit(1)
+    if parsed.block_size <= 0 or parsed.buffers < 2:
+        print("Fatal: the block size must be positive and at least two buffers are needed.")
+        exit(1)
+
+    # direct I/O needs aligned blocks
+    block_size = parsed.block_size
+    if block_size % ALIGNMENT != 0:
+        block_size += ALIGNMENT - block_size % ALIGNMENT
+
+    if parsed.verify:
+        if parsed.map:
+            segments = read_map(parsed.map)
+        else:
+            segments = hash_image(parsed.input, parsed.entry, parsed.index, block_size, parsed.buffers)
+        verify(parsed.output, block_size, parsed.buffers, segments, parsed.report)
+    else:
+        flash(
+            parsed.input,
+            parsed.entry,
+            parsed.index,
+            parsed.output,
+            block_size,
+            parsed.buffers,
+            parsed.direct,
+            parsed.sparse,
+            parsed.discard,
+            parsed.map,
+            parsed.sha256,
+            parsed.report,
+        )
@@ -0,0 +1,219 @@
+import fnmatch
+import os
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from dt_shell import dtslogger
+
+from utils.misc_utils import human_size, human_time
+
+# block devices events, as seen by udev once it is done processing them (e.g., creating the device files)
+UDEV_MONITOR_CMD = ["udevadm", "monitor", "--udev", "--subsystem-match=block", "--property"]
+# devices we never flash, unless explicitly matched
+IGNORED_DEVICES = ["/dev/loop*", "/dev/ram*", "/dev/zram*", "/dev/dm-*", "/dev/md*", "/dev/sr*"]
+
+
+class UdevMonitor:
+    """
+    Iterates over the properties of the block devices events reported by udev, e.g.,
+    {"ACTION": "add", "DEVNAME": "/dev/sdb", "DEVTYPE": "disk", ...}, until closed.
+    """
+
+    def __init__(self, cmd: List[str] = UDEV_MONITOR_CMD):
+        self._cmd = cmd
+        self._proc: Optional[subprocess.Popen] = None
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        self._proc = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        event: Dict[str, str] = {}
+        for line in self._proc.stdout:
+            line = line.strip()
+            # events are separated by empty lines
+            if not line:
+                if "ACTION" in event and "DEVNAME" in event:
+                    yield event
+                event = {}
+                continue
+            if "=" in line:
+                key, value = line.split("=", 1)
+                event[key] = value
+
+    def close(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.terminate()
+            self._proc.wait()
+
+
+def device_size(device: str) -> int:
+    # size of a block device in bytes, 0 when there is no media (e.g., card reader with no card)
+    try:
+        with open(f"/sys/class/block/{os.path.basename(device)}/size", "rt") as fin:
+            return int(fin.read().strip()) * 512
+    except (OSError, ValueError):
+        return 0
+
+
+def is_removable(event: Dict[str, str]) -> bool:
+    name = os.path.basename(event["DEVNAME"])
+    try:
+        with open(f"/sys/class/block/{name}/removable", "rt") as fin:
+            if fin.read().strip() == "1":
+                return True
+    except OSError:
+        pass
+    # card readers are not always flagged as removable
+    return event.get("ID_BUS", None) == "usb" or name.startswith("mmcblk")
+
+
+class Slot:
+    def __init__(self, device: str, hostname: str):
+        self.device = device
+        self.hostname = hostname
+        self.stime = time.time()
+        self.error: Optional[str] = None
+        self.worker: Optional[threading.Thread] = None
+
+
+class Station:
+    """
+    Waits for new SD cards (whole block devices) to appear and processes each one of them, in parallel,
+    with the next hostname from the queue. A card has to be removed before its slot can be used again.
+    Cards with a size (in bytes) out of `size_range` are ignored, nothing is written before `confirm`
+    (if given) accepts the first card.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[str, str], Optional[int]],
+        hostnames: List[str],
+        match: Optional[str] = None,
+        monitor: Optional[UdevMonitor] = None,
+        size_range: Optional[Tuple[int, int]] = None,
+        confirm: Optional[Callable[[str, int], bool]] = None,
+    ):
+        self._process = process
+        self._hostnames: Deque[str] = deque(hostnames)
+        self._match = match
+        self._size_range = size_range
+        self._confirm = confirm
+        self._confirmed = confirm is None
+        # cards that were rejected, until they are removed
+        self._ignored: Set[str] = set()
+        self._monitor = monitor or UdevMonitor()
+        self._lock = threading.Lock()
+        # device -> slot, slots are freed when the card is removed
+        self._slots: Dict[str, Slot] = {}
+        self._workers: List[threading.Thread] = []
+        self._in_progress = 0
+        self.completed: List[Slot] = []
+        self.failed: List[Slot] = []
+
+    def accepts(self, event: Dict[str, str]) -> bool:
+        device = event["DEVNAME"]
+        if event.get("DEVTYPE", None) != "disk":
+            return False
+        if self._match is not None:
+            return fnmatch.fnmatch(device, self._match)
+        if any(fnmatch.fnmatch(device, pattern) for pattern in IGNORED_DEVICES):
+            return False
+        return is_removable(event)
+
+    def run(self):
+        dtslogger.info(f"Station ready, {len(self._hostnames)} hostname(s) in the queue. Insert SD cards...")
+        events: queue.Queue = queue.Queue()
+
+        def _read():
+            for e in self._monitor:
+                events.put(e)
+            events.put(None)
+
+        threading.Thread(target=_read, daemon=True).start()
+        try:
+            # keep going until all the hostnames are used
+            while self._hostnames or self._in_progress:
+                try:
+                    event = events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if event is None:
+                    dtslogger.error("The udev monitor stopped unexpectedly.")
+                    break
+                self._handle(event)
+        finally:
+            self._monitor.close()
+            # wait for the cards being processed
+            for worker in self._workers:
+                worker.join()
+
+    def _handle(self, event: Dict[str, str]):
+        device, action = event["DEVNAME"], event["ACTION"]
+        if not self.accepts(event):
+            return
+        # cards inserted in a reader show up as a change of media size
+        size = 0 if action == "remove" else device_size(device)
+        with self._lock:
+            slot = self._slots.get(device, None)
+            if size <= 0:
+                self._ignored.discard(device)
+                if slot is not None:
+                    if slot.worker.is_alive():
+                        dtslogger.warning(f"[{device}] Card removed while '{slot.hostname}' was in progress.")
+                    else:
+                        dtslogger.info(f"[{device}] Card removed, slot available.")
+                    del self._slots[device]
+                return
+            # the card is already being processed (or was processed, or rejected, and not removed yet)
+            if slot is not None or device in self._ignored:
+                return
+        if self._size_range is not None and not (self._size_range[0] <= size <= self._size_range[1]):
+            dtslogger.warning(f"[{device}] Unexpected size ({human_size(size)}), ignoring card.")
+            self._ignored.add(device)
+            return
+        # nothing is written before the first card is confirmed
+        if not self._confirmed:
+            if not self._confirm(device, size):
+                dtslogger.info(f"[{device}] Ignoring card.")
+                self._ignored.add(device)
+                return
+            self._confirmed = True
+        with self._lock:
+            if not self._hostnames:
+                dtslogger.warning(f"[{device}] No hostnames left in the queue, ignoring card.")
+                return
+            slot = Slot(device, self._hostnames.popleft())
+            slot.worker = threading.Thread(target=self._work, args=(slot,), daemon=True)
+            self._slots[device] = slot
+            self._workers.append(slot.worker)
+            self._in_progress += 1
+        dtslogger.info(f"[{device}] Card detected, initializing as '{slot.hostname}'...")
+        slot.worker.start()
+
+    def _work(self, slot: Slot):
+        nbytes = None
+        try:
+            nbytes = self._process(slot.device, slot.hostname)
+        except BaseException as e:
+            # steps exit() on errors
+            slot.error = f"{type(e).__name__}: {e}"
+        elapsed = time.time() - slot.stime
+        with self._lock:
+            self._in_progress -= 1
+            if slot.error is not None:
+                # the hostname goes to the next card
+                self._hostnames.appendleft(slot.hostname)
+                self.failed.append(slot)
+            else:
+                self.completed.append(slot)
+            left = len(self._hostnames)
+        if slot.error is not None:
+            dtslogger.error(f"[{slot.device}] Failed to initialize '{slot.hostname}' ({slot.error}).")
+            return
+        speed = f", {human_size(nbytes / max(elapsed, 1e-6))}/s" if nbytes else ""
+        dtslogger.info(
+            f"[{slot.device}] '{slot.hostname}' ready in {human_time(elapsed)}{speed}. "
+            f"You can remove the card. {left} hostname(s) left."
+        )
@@ -27,23 +27,31 @@ class DTCommand(DTCommandAbs):
             default=None,
             help="Docker socket or hostname where to run the image",
         )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            default=False,
+            help="Ignore the cached discovery data and wait for the device to announce itself",
+        )
 
         parser.add_argument("stack", nargs=1, default=None)
-        parsed, _ = parser.parse_known_args(args=args)
-        # ---
         # try to interpret it as a multi-command
         multi = MultiCommand(DTCommand, shell, [("-H", "--machine")], args)
         if multi.is_multicommand:
-            multi.execute()
+            if not multi.execute():
+                exit(1)
             return
         # ---
+        # parse arguments
+        parsed, _ = parser.parse_known_args(args=args)
+        # ---
         parsed.stack = parsed.stack[0]
         # special stack is `duckietown`
         if parsed.stack == DUCKIETOWN_STACK:
             # retrieve robot type from device
             dtslogger.info(f'Waiting for device "{parsed.machine}"...')
             hostname = parsed.machine.replace(".local", "")
-            _, _, data = wait_for_service("DT::ROBOT_TYPE", hostname)
+            _, _, data = wait_for_service("DT::ROBOT_TYPE", hostname, use_cache=not parsed.no_cache)
             rtype = data["type"]
             dtslogger.info(f'Detected device type is "{rtype}".')
             parsed.stack = f"{DUCKIETOWN_STACK}/{rtype}"
@@ -1,39 +1,180 @@
+import asyncio
 import json
+import os
+import tempfile
+import threading
 import time
+from collections import defaultdict
 from types import SimpleNamespace
-from zeroconf import ServiceBrowser, Zeroconf
+from typing import Dict, Optional, Callable, Tuple, Set
+from zeroconf import ServiceBrowser, Zeroconf, ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
 
 from dt_shell import dtslogger
+from dt_shell.constants import DTShellConstants
 
+DUCKIETOWN_SERVICE_TYPE = "_duckietown._tcp.local."
+SERVICE_INFO_TIMEOUT_MS = 3000
+# services whose data is safe to cache, service -> TTL (in seconds) of the cached data;
+# a configuration can change without reflashing the device, it is only trusted for a short time
+CACHEABLE_SERVICES = {
+    "DT::ROBOT_TYPE": 24 * 60 * 60,
+    "DT::ROBOT_CONFIGURATION": 5 * 60,
+}
+# keys the TXT data of a service must have to be usable, e.g., the data is empty when the service info
+# could not be retrieved in time
+SERVICE_TXT_KEYS = {
+    "DT::ROBOT_TYPE": {"type"},
+    "DT::ROBOT_CONFIGURATION": {"configuration"},
+}
 
-def wait_for_service(target_service: str, target_hostname: str = None, timeout: int = 10):
+
+def wait_for_service(
+    target_service: str, target_hostname: str = None, timeout: int = 10, use_cache: bool = True
+):
+    # look in the cache first
+    if use_cache and target_hostname is not None:
+        data: Optional[dict] = get_cached_service(target_service, target_hostname)
+        if data is not None:
+            dtslogger.debug(f"Discovery cache hit (service={target_service}, hostname={target_hostname})")
+            return target_service, target_hostname, data
     # define callbacks
     workspace = SimpleNamespace(service=target_service, hostname=target_hostname, data=None)
+    found = threading.Event()
+    seen: Dict[str, Dict[str, dict]] = defaultdict(dict)
 
     def cb(service: str, hostname: str, data: dict):
+        if not is_complete_txt(service, data):
+            dtslogger.debug(f"Ignoring incomplete data (service={service}, hostname={hostname}, data={data})")
+            return
+        seen[service][hostname] = data
         if target_service == service and target_hostname == hostname:
             workspace.data = data
             workspace.service = service
             workspace.hostname = hostname
+            found.set()
 
     # perform discover
     zeroconf = Zeroconf()
     listener = DiscoverListener(service_in_callback=cb)
     # noinspection PyTypeChecker
-    ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
+    ServiceBrowser(zeroconf, DUCKIETOWN_SERVICE_TYPE, listener)
     # wait
-    stime = time.time()
-    while workspace.data is None:
-        time.sleep(0.5)
-        if (timeout > 0) and (time.time() - stime > timeout):
-            msg = f"No devices matched the search criteria (service={target_service}, hostname={target_hostname})."
-            zeroconf.close()
-            raise TimeoutError(msg)
+    found.wait(timeout=timeout if timeout > 0 else None)
     zeroconf.close()
+    # whatever we saw is worth remembering
+    update_discovery_cache(seen)
+    if workspace.data is None:
+        msg = (
+            f"No devices matched the search criteria (service={target_service}, hostname={target_hostname})."
+        )
+        raise TimeoutError(msg)
     # ---
     return workspace.service, workspace.hostname, workspace.data
 
 
+def is_complete_txt(service: str, data: Optional[dict]) -> bool:
+    return isinstance(data, dict) and SERVICE_TXT_KEYS.get(service, set()).issubset(data)
+
+
+def _discovery_cache_file() -> str:
+    return os.path.join(os.path.expanduser(DTShellConstants.ROOT), "cache", "discovery.json")
+
+
+def load_discovery_cache() -> Dict[str, Dict[str, dict]]:
+    """
+    Returns the discovery cache as a map hostname -> service -> {"data": ..., "last_seen": ...}.
+    """
+    fpath: str = _discovery_cache_file()
+    if not os.path.isfile(fpath):
+        return {}
+    try:
+        with open(fpath, "rt") as fin:
+            cache = json.load(fin)
+        return cache if isinstance(cache, dict) else {}
+    except (ValueError, OSError):
+        return {}
+
+
+def update_discovery_cache(services: Dict[str, Dict[str, dict]]):
+    """
+    Stores the TXT data of the (cacheable) services in `services` (service -> hostname -> data).
+    """
+    now: float = time.time()
+    entries = [
+        (service, hostname, data)
+        for service, hosts in services.items()
+        if service in CACHEABLE_SERVICES
+        for hostname, data in hosts.items()
+        # failed lookups are not worth remembering
+        if data and is_complete_txt(service, data)
+    ]
+    if not entries:
+        return
+    cache = load_discovery_cache()
+    for service, hostname, data in entries:
+        cached: Optional[dict] = cache.get(hostname, {}).get(service, None)
+        if cached is not None and cached["data"] != data:
+            # the device changed (e.g., reflashed), nothing we know about it can be trusted anymore
+            dtslogger.debug(f"Discovery cache: dropping stale entries of '{hostname}'")
+            cache.pop(hostname)
+        cache.setdefault(hostname, {})[service] = {"data": data, "last_seen": now}
+    # write atomically, other shells might be doing the same
+    fpath: str = _discovery_cache_file()
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wt", dir=os.path.dirname(fpath), delete=False) as fout:
+            json.dump(cache, fout, indent=4, sort_keys=True)
+        os.replace(fout.name, fpath)
+    except OSError as e:
+        dtslogger.debug(f"Could not update the discovery cache: {e}")
+
+
+def get_cached_service(service: str, hostname: str, ttl: Optional[float] = None) -> Optional[dict]:
+    """
+    Returns the TXT data of a service from the discovery cache, None on a miss or stale entry.
+    """
+    if ttl is None:
+        ttl = CACHEABLE_SERVICES.get(service, 0)
+    entry: Optional[dict] = load_discovery_cache().get(hostname, {}).get(service, None)
+    if entry is None or time.time() - entry.get("last_seen", 0) > ttl:
+        return None
+    # entries written by older versions might be empty
+    if not entry.get("data", None) or not is_complete_txt(service, entry["data"]):
+        return None
+    return entry["data"]
+
+
+def discover_devices(timeout: float = 5) -> Dict[str, dict]:
+    """
+    Browses the network for `timeout` seconds and returns the devices found as a map
+    hostname -> {"type": ..., "configuration": ..., "status": ..., "addresses": ..., "port": ...}.
+    """
+
+    async def _snapshot() -> Dict[str, dict]:
+        discovery = AsyncDiscovery()
+        await discovery.start()
+        await asyncio.sleep(timeout)
+        # give in-flight service info requests a chance to complete
+        await discovery.wait_pending(1.0)
+        await discovery.stop()
+        return discovery.devices()
+
+    return asyncio.run(_snapshot())
+
+
+def match_device(device: dict, selector: Dict[str, str]) -> bool:
+    """
+    Checks whether a discovered device matches all the `key=value` pairs of a selector.
+    Values can list alternatives separated by `|`.
+    """
+    for key, value in selector.items():
+        actual: Optional[str] = device.get(key, None)
+        if actual is None or actual.lower() not in [v.strip().lower() for v in value.split("|")]:
+            return False
+    return True
+
+
 class DiscoverListener:
     def __init__(self, service_in_callback=None, service_out_callback=None):
         self.service_in_callback = service_in_callback
@@ -49,13 +190,13 @@ class DiscoverListener:
         txt = dict()
         try:
             sinfo = zeroconf.get_service_info(type, sname)
-            txt = (
-                json.loads(list(sinfo.properties.keys())[0].decode("utf-8"))
-                if len(sinfo.properties)
-                else dict()
-            )
-        except:
-            pass
+        except Exception as e:
+            dtslogger.debug(f"Could not retrieve the info of the service '{sname}': {e}")
+            sinfo = None
+        if sinfo is None:
+            dtslogger.debug(f"No info received for the service '{sname}'")
+        else:
+            txt = parse_service_txt(sinfo.properties)
         return name, hostname, txt
 
     def remove_service(self, zeroconf, type, sname):
@@ -77,3 +218,131 @@ class DiscoverListener:
     def update_service(self, *args, **kwargs):
         # TODO: implement this
         pass
+
+
+def parse_service_name(sname: str) -> Tuple[Optional[str], Optional[str]]:
+    name = sname.replace(f".{DUCKIETOWN_SERVICE_TYPE}", "")
+    service_parts = name.split("::")
+    if len(service_parts) != 3 or service_parts[0] != "DT":
+        return None, None
+    return "{}::{}".format(service_parts[0], service_parts[1]), service_parts[2]
+
+
+def parse_service_txt(properties: dict) -> dict:
+    # Duckietown devices publish a JSON string as the only key of the TXT record
+    if not properties:
+        return dict()
+    txt_str: str = list(properties.keys())[0].decode("utf-8")
+    if not txt_str.strip():
+        return dict()
+    try:
+        return json.loads(txt_str)
+    except json.JSONDecodeError:
+        dtslogger.debug(
+            f"An error occurred while decoding the TXT string '{txt_str}'. A JSON string was expected."
+        )
+        return dict()
+
+
+class AsyncDiscovery:
+    """
+    Keeps a live view of the Duckietown services in the network using zeroconf's asyncio API.
+    Service info of new services is resolved concurrently, outside of the browser's callback.
+    The optional `on_change` callback is called (in the event loop) every time the view changes.
+    """
+
+    def __init__(self, on_change: Optional[Callable[[], None]] = None):
+        self._on_change = on_change
+        self._aiozc: Optional[AsyncZeroconf] = None
+        self._browser: Optional[AsyncServiceBrowser] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # service -> hostname -> {"port": ..., "txt": ..., "addresses": ...}
+        self.services: Dict[str, Dict[str, dict]] = defaultdict(dict)
+
+    async def start(self):
+        self._aiozc = AsyncZeroconf()
+        self._browser = AsyncServiceBrowser(
+            self._aiozc.zeroconf, [DUCKIETOWN_SERVICE_TYPE], handlers=[self._on_state_change]
+        )
+
+    async def stop(self):
+        if self._browser is not None:
+            await self._browser.async_cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._aiozc is not None:
+            await self._aiozc.async_close()
+        self._browser = self._aiozc = None
+        # whatever we saw is worth remembering
+        update_discovery_cache(
+            {
+                service: {h: info["txt"] for h, info in hosts.items()}
+                for service, hosts in self.services.items()
+            }
+        )
+
+    async def wait_pending(self, timeout: float):
+        """
+        Waits (at most `timeout` seconds) for the service info requests in flight to complete.
+        """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def devices(self) -> Dict[str, dict]:
+        devices: Dict[str, dict] = defaultdict(
+            lambda: {
+                "type": None,
+                "configuration": None,
+                "status": None,
+                "online": False,
+                "busy": False,
+                "addresses": [],
+                "port": None,
+            }
+        )
+        for service, hosts in self.services.items():
+            for hostname, info in hosts.items():
+                device: dict = devices[hostname]
+                device["addresses"] = sorted(set(device["addresses"]).union(info["addresses"]))
+                device["port"] = device["port"] or info["port"]
+                if service == "DT::ROBOT_TYPE":
+                    device["type"] = info["txt"].get("type", device["type"])
+                elif service == "DT::ROBOT_CONFIGURATION":
+                    device["configuration"] = info["txt"].get("configuration", device["configuration"])
+                elif service == "DT::PRESENCE":
+                    device["status"] = device["status"] or "ready"
+                elif service == "DT::BOOTING":
+                    device["status"] = "booting"
+                elif service == "DT::ONLINE":
+                    device["online"] = True
+                elif service == "DT::BUSY":
+                    device["busy"] = True
+        return dict(devices)
+
+    def _on_state_change(self, zeroconf: Zeroconf, service_type: str, name: str, state_change):
+        service, hostname = parse_service_name(name)
+        dtslogger.debug(f"Zeroconf:{state_change} (name={service}, hostname={hostname})")
+        if not service:
+            return
+        if state_change is ServiceStateChange.Removed:
+            self.services[service].pop(hostname, None)
+            self._changed()
+            return
+        task = asyncio.ensure_future(self._resolve(service_type, name, service, hostname))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, service_type: str, name: str, service: str, hostname: str):
+        info = AsyncServiceInfo(service_type, name)
+        if not await info.async_request(self._aiozc.zeroconf, SERVICE_INFO_TIMEOUT_MS):
+            return
+        self.services[service][hostname] = {
+            "port": info.port,
+            "txt": parse_service_txt(info.properties),
+            "addresses": info.parsed_addresses(),
+        }
+        self._changed()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
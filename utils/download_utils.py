@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Set
+
+import requests
+from dt_data_api import Storage, TransferError
+from dt_data_api.constants import PUBLIC_STORAGE_URL
+from dt_data_api.exceptions import TransferAborted
+from dt_shell import dtslogger
+
+__all__ = [
+    "DEFAULT_DOWNLOAD_WORKERS",
+    "RangedDownload",
+    "TransferAborted",
+    "file_sha256",
+]
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+CHUNK_SIZE = 32 * 1024**2
+MAX_ATTEMPTS = 5
+REQUEST_TIMEOUT = 30
+STREAM_BUF_SIZE = 1024**2
+PARTIAL_EXT = ".partial"
+JOURNAL_EXT = ".journal"
+
+
+@dataclass
+class Chunk:
+    index: int
+    # object (part) the chunk belongs to and byte range within it
+    part: str
+    start: int
+    length: int
+    # position of the chunk in the destination file
+    offset: int
+
+
+def file_sha256(path: str, buf_size: int = 4 * 1024**2) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for data in iter(lambda: fin.read(buf_size), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class RangedDownload:
+    """
+    Downloads an object from a storage space of the DCSS in parallel byte ranges.
+
+    Data is written to `<destination>.partial` and the completed chunks are recorded in a journal
+    (`<destination>.journal`), so that an interrupted download resumes from where it stopped.
+    The journal is discarded if the object changed in the meantime.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        obj: str,
+        destination: str,
+        workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+        sha256: Optional[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        self._storage = storage
+        self._obj = obj.lstrip("/")
+        self._destination = destination
+        self._workers = max(1, workers)
+        self._chunk_size = chunk_size
+        self._sha256 = sha256
+        self._on_progress = on_progress
+        self._partial = destination + PARTIAL_EXT
+        self._journal = destination + JOURNAL_EXT
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done: Set[int] = set()
+        self._parts: List[list] = []
+        self.size: int = 0
+        self.downloaded: int = 0
+
+    @property
+    def resumable(self) -> bool:
+        return os.path.isfile(self._journal) and os.path.isfile(self._partial)
+
+    def abort(self):
+        self._stop.set()
+
+    def run(self):
+        # objects can be stored in multiple parts (<obj>.000, <obj>.001, ...)
+        # noinspection PyProtectedMember
+        parts = self._storage._get_parts(self._obj)
+        for part in parts:
+            meta = self._storage.head(part)
+            self._parts.append([part, int(meta["Content-Length"]), meta.get("ETag", "")])
+        self.size = sum(size for _, size, _ in self._parts)
+        chunks = self._chunks()
+        # resume (if possible)
+        self._load_journal()
+        self.downloaded = sum(chunks[i].length for i in self._done)
+        if self._done:
+            dtslogger.info(f"Resuming download, {len(self._done)}/{len(chunks)} chunks already downloaded.")
+        self._report()
+        # download missing chunks
+        fd = os.open(self._partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            missing = [chunk for chunk in chunks if chunk.index not in self._done]
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                futures = [pool.submit(self._fetch, fd, chunk) for chunk in missing]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                # stop the other workers as soon as one of them fails
+                errors = [f.exception() for f in done if f.exception() is not None]
+                if errors:
+                    self._stop.set()
+                    raise errors[0]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        # verify
+        if self._sha256 is not None:
+            dtslogger.info("Verifying checksum...")
+            sha256 = file_sha256(self._partial)
+            if sha256 != self._sha256.lower():
+                os.remove(self._partial)
+                os.remove(self._journal)
+                raise TransferError(f"Checksum mismatch, expected {self._sha256}, got {sha256}.")
+        # the download is complete
+        os.replace(self._partial, self._destination)
+        os.remove(self._journal)
+
+    def _chunks(self) -> List[Chunk]:
+        chunks: List[Chunk] = []
+        offset = 0
+        for part, size, _ in self._parts:
+            for start in range(0, size, self._chunk_size):
+                length = min(self._chunk_size, size - start)
+                chunks.append(Chunk(len(chunks), part, start, length, offset + start))
+            offset += size
+        return chunks
+
+    def _load_journal(self):
+        if not self.resumable:
+            return
+        try:
+            with open(self._journal, "rt") as fin:
+                journal = json.load(fin)
+        except (ValueError, OSError):
+            return
+        # the object must not have changed in the meantime
+        if journal.get("parts") != self._parts or journal.get("chunk_size") != self._chunk_size:
+            dtslogger.info("The remote object changed since the last attempt, restarting download.")
+            return
+        self._done = set(journal.get("done", []))
+
+    def _save_journal(self):
+        # write atomically, a crash must not corrupt the journal
+        tmp = self._journal + ".tmp"
+        journal = {"parts": self._parts, "chunk_size": self._chunk_size, "done": sorted(self._done)}
+        with open(tmp, "wt") as fout:
+            json.dump(journal, fout)
+        os.replace(tmp, self._journal)
+
+    def _url(self, part: str) -> str:
+        # noinspection PyProtectedMember
+        storage, name = self._storage, self._storage._name
+        if name == "public":
+            return getattr(storage, "_storage_url", PUBLIC_STORAGE_URL).format(bucket=name, object=part)
+        # presigned URLs expire, a new one is requested every time
+        # noinspection PyProtectedMember
+        url = storage.api.authorize_request("get_object", storage._full_name, part)
+        endpoint_url = getattr(storage, "_endpoint_url", None)
+        return endpoint_url(url) if endpoint_url is not None else url
+
+    def _fetch(self, fd: int, chunk: Chunk):
+        received = 0
+        for attempt in range(MAX_ATTEMPTS):
+            if self._stop.is_set():
+                raise TransferAborted("Download aborted")
+            # only ask for the bytes we do not have yet
+            first, last = chunk.start + received, chunk.start + chunk.length - 1
+            try:
+                url, headers = self._url(chunk.part), {"Range": f"bytes={first}-{last}"}
+                with requests.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as res:
+                    if res.status_code != 206:
+                        raise TransferError(f"Transfer Error: Code: {res.status_code} Message: {res.reason}")
+                    for data in res.iter_content(STREAM_BUF_SIZE):
+                        if self._stop.is_set():
+                            raise TransferAborted("Download aborted")
+                        os.pwrite(fd, data, chunk.offset + received)
+                        received += len(data)
+                        with self._lock:
+                            self.downloaded += len(data)
+                        self._report()
+            except (requests.RequestException, TransferError) as e:
+                dtslogger.debug(f"Chunk {chunk.index} [attempt {attempt + 1}/{MAX_ATTEMPTS}]: {e}")
+                time.sleep(min(2**attempt, 10))
+                continue
+            if received >= chunk.length:
+                with self._lock:
+                    self._done.add(chunk.index)
+                    self._save_journal()
+                return
+        raise TransferError(f"Could not download bytes [{chunk.offset}-{chunk.offset + chunk.length}].")
+
+    def _report(self):
+        if self._on_progress is not None:
+            self._on_progress(self.downloaded, self.size)
@@ -1,19 +1,107 @@
 import copy
+import io
 import logging
+import multiprocessing
 import os
+import queue
 import re
 import sys
+import tempfile
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from itertools import product
-from threading import Thread
-from typing import List, Tuple, Any, Type
-from collections import OrderedDict
+from typing import List, Tuple, Any, Type, Dict, Optional
+from collections import OrderedDict, defaultdict
 
-from dt_shell import DTCommandAbs, DTShell, dtslogger
+from dt_shell import DTCommandAbs, DTShell, UserError, dtslogger
+from termcolor import colored
+
+from utils.table_utils import format_matrix
 
 
 VERBOSE_ARG = "-vvv"
+MAX_WORKERS_ARG = "--max-workers"
+PROCESSES_ARG = "--processes"
+SELECTOR_PREFIX = "@"
+SELECTOR_KEYS = {
+    "type": "type",
+    "config": "configuration",
+    "configuration": "configuration",
+    "status": "status",
+}
+SELECTOR_DISCOVERY_TIMEOUT = 5
+DEFAULT_MAX_WORKERS = 8
+# the result of a worker process can still be in transit for a while after the process exits
+WORKER_RESULT_TIMEOUT = 5
+
+
+@dataclass
+class WorkerResult:
+    args: List[str]
+    label: str
+    success: bool = False
+    aborted: bool = False
+    duration: float = 0.0
+    output: str = ""
+
+
+class _WorkerStream(io.TextIOBase):
+    """
+    Stream that routes what is written by registered worker threads into a per-thread buffer and
+    everything else to the original stream.
+    NOTE: output of subprocesses writing directly to the file descriptor is not captured.
+    """
+
+    def __init__(self, stream):
+        super(_WorkerStream, self).__init__()
+        self._stream = stream
+        self._buffers: Dict[int, io.StringIO] = {}
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def register(self, buffer: io.StringIO):
+        self._buffers[threading.get_ident()] = buffer
+
+    def unregister(self):
+        self._buffers.pop(threading.get_ident(), None)
+
+    def write(self, s: str) -> int:
+        buffer: Optional[io.StringIO] = self._buffers.get(threading.get_ident())
+        return (buffer if buffer is not None else self._stream).write(s)
+
+    def flush(self):
+        self._stream.flush()
+
+    def isatty(self) -> bool:
+        return False
+
+    def fileno(self) -> int:
+        return self._stream.fileno()
+
+    @property
+    def encoding(self):
+        return getattr(self._stream, "encoding", "utf-8")
+
+
+class _ErrorCounter(logging.Handler):
+    """
+    Counts the error records logged by each thread, commands often log an error and return nothing.
+    """
+
+    def __init__(self):
+        super(_ErrorCounter, self).__init__(level=logging.ERROR)
+        self._counts: Dict[int, int] = defaultdict(int)
+
+    def emit(self, record: logging.LogRecord):
+        self._counts[record.thread] += 1
+
+    def count(self) -> int:
+        return self._counts.get(threading.get_ident(), 0)
 
 
 class MultiCommand(object):
@@ -24,17 +112,36 @@ class MultiCommand(object):
         self._shell = shell
         self._multiargs = multiargs
         self._args = args
+        self._errors = _ErrorCounter()
         self._keys = []
         self._values = []
         self._verbose = VERBOSE_ARG in self._args
         if self._verbose:
             self._args.remove(VERBOSE_ARG)
+        self._processes = PROCESSES_ARG in self._args
+        if self._processes:
+            self._args.remove(PROCESSES_ARG)
+            if "fork" not in multiprocessing.get_all_start_methods():
+                dtslogger.warning(f"{PROCESSES_ARG} is not supported on this platform, using threads.")
+                self._processes = False
+        self._max_workers = DEFAULT_MAX_WORKERS
+        if MAX_WORKERS_ARG in self._args:
+            idx = self._args.index(MAX_WORKERS_ARG)
+            try:
+                self._max_workers = max(1, int(self._args[idx + 1]))
+            except (IndexError, ValueError):
+                raise UserError(f"The argument {MAX_WORKERS_ARG} expects an integer.")
+            del self._args[idx : idx + 2]
         # make sure this is not a recursive call
         if "__multiarg__" in args:
             args.remove("__multiarg__")
             return
         # parse args
         self._parse_args()
+        # a single target is not a multi-command, replace the pattern with its only value
+        if len(self._values) == 1:
+            for key, value in zip(self._keys, self._values[0]):
+                self._args[self._args.index(key) + 1] = value
         config_str = "\n\t".join(list(map(str, self._get_args())))
         dtslogger.debug(f"Multi-Arg Config: \n\t{config_str}")
 
@@ -42,49 +149,181 @@ class MultiCommand(object):
     def is_multicommand(self):
         return len(self._values) > 1
 
-    def execute(self):
-        workers = []
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    @property
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    @property
+    def values(self) -> List[Tuple[Any, ...]]:
+        return list(self._values)
+
+    def execute(self) -> bool:
+        jobs = []
         for args in self._get_args():
-            dtslogger.warning(f" =====> Multi-Arg: Running with args: {args}")
+            label = " ".join(f"{k} {args[args.index(k) + 1]}" for k in self._keys)
             args.append("__multiarg__")
-            worker = Thread(target=self._execute_single, args=(args,))
-            workers.append(worker)
-        # disable logging
-        _dev_null = _sys_stdout = _log_level = None  # complains about not defined below
-        if not self._verbose:
-            _sys_stdout = sys.stdout
-            _dev_null = open(os.devnull, "w")
-            sys.stdout = _dev_null
-            _log_level = dtslogger.level
-            dtslogger.setLevel(logging.WARNING)
-        # start workers
-        for w in workers:
-            w.start()
-        # wait for them to finish
-        for w in workers:
-            w.join()
-        # ---
+            jobs.append(WorkerResult(args=args, label=label))
+        dtslogger.info(
+            f" =====> Multi-Arg: Running {len(jobs)} targets, {min(self._max_workers, len(jobs))} at a time"
+        )
+        # run workers
+        dtslogger.addHandler(self._errors)
+        try:
+            if self._processes:
+                self._execute_processes(jobs)
+            else:
+                self._execute_threads(jobs)
+        finally:
+            dtslogger.removeHandler(self._errors)
+        # dump the output of failed workers
+        for job in jobs:
+            if not job.success and job.output:
+                dtslogger.error(f" <===== Multi-Arg: Output of [{job.label}]:")
+                print(job.output.rstrip("\n"))
+        # report
+        header = ["Status", "Time"]
+        data = [
+            [
+                job.label,
+                colored("Success", "green")
+                if job.success
+                else colored("Aborted", "yellow")
+                if job.aborted
+                else colored("Failed", "red"),
+                f"{job.duration:.1f}s",
+            ]
+            for job in jobs
+        ]
+        print(format_matrix(header, data, "{:^{}}", "{:<{}}", "{:<{}}", "\n", " | "))
+        success: bool = all(job.success for job in jobs)
+        if not success:
+            nfailed = len([job for job in jobs if not job.success])
+            dtslogger.error(f"Multi-Arg: {nfailed} out of {len(jobs)} targets failed.")
+        return success
+
+    @staticmethod
+    def _log_handlers() -> List[logging.StreamHandler]:
+        # stream handlers that records of our logger can end up in
+        handlers: List[logging.StreamHandler] = []
+        logger: Optional[logging.Logger] = dtslogger
+        while logger is not None:
+            handlers += [
+                h
+                for h in logger.handlers
+                if isinstance(h, logging.StreamHandler) and not isinstance(h, logging.FileHandler)
+            ]
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        return handlers
+
+    def _execute_threads(self, jobs: List[WorkerResult]):
+        # capture output of the workers (unless verbose)
+        streams: List[_WorkerStream] = []
+        handlers: List[Tuple[logging.StreamHandler, Any]] = []
         if not self._verbose:
-            _dev_null.close()
-            sys.stdout = _sys_stdout
-            dtslogger.setLevel(_log_level)
+            sys.stdout, sys.stderr = _WorkerStream(sys.stdout), _WorkerStream(sys.stderr)
+            streams = [sys.stdout, sys.stderr]
+            for handler in self._log_handlers():
+                handlers.append((handler, handler.setStream(_WorkerStream(handler.stream))))
+                streams.append(handler.stream)
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                for _ in pool.map(lambda j: self._execute_single(j, streams), jobs):
+                    pass
+        finally:
+            if not self._verbose:
+                for handler, stream in handlers:
+                    handler.setStream(stream)
+                sys.stdout, sys.stderr = streams[0].stream, streams[1].stream
 
-    def _log(self, msg):
-        dtslogger.setLevel(logging.INFO)
-        dtslogger.info(msg)
-        dtslogger.setLevel(logging.ERROR)
+    def _execute_single(self, job: WorkerResult, streams: List[_WorkerStream]):
+        buffer = io.StringIO()
+        for stream in streams:
+            stream.register(buffer)
+        try:
+            self._run(job)
+        finally:
+            for stream in streams:
+                stream.unregister()
+            job.output = buffer.getvalue()
+        self._log_result(job)
 
-    def _execute_single(self, args):
+    def _execute_processes(self, jobs: List[WorkerResult]):
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        pending: List[int] = list(range(len(jobs)))
+        running: Dict[int, multiprocessing.Process] = {}
+        # time at which workers were first seen dead without having reported back
+        exited: Dict[int, float] = {}
+        while pending or running:
+            # keep the pool full
+            while pending and len(running) < self._max_workers:
+                idx = pending.pop(0)
+                # the child inherits the command and the shell (fork), only the result travels back
+                proc = ctx.Process(target=self._execute_in_process, args=(idx, jobs[idx], results))
+                proc.start()
+                running[idx] = proc
+            # collect results
+            try:
+                idx, job = results.get(timeout=0.5)
+                jobs[idx] = job
+                exited.pop(idx, None)
+                running.pop(idx).join()
+                self._log_result(job)
+            except queue.Empty:
+                # workers that died without reporting back (e.g., killed, segfault)
+                now = time.time()
+                for idx, proc in list(running.items()):
+                    if proc.is_alive() or now - exited.setdefault(idx, now) < WORKER_RESULT_TIMEOUT:
+                        continue
+                    running.pop(idx)
+                    exited.pop(idx)
+                    jobs[idx].output = f"Worker process exited with code {proc.exitcode}"
+                    self._log_result(jobs[idx])
+
+    def _execute_in_process(self, idx: int, job: WorkerResult, results):
+        # capture everything written on stdout/stderr, subprocesses included (unless verbose)
+        with tempfile.TemporaryFile() as out:
+            if not self._verbose:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(out.fileno(), 1)
+                os.dup2(out.fileno(), 2)
+            self._run(job)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            out.seek(0)
+            job.output = out.read().decode("utf-8", errors="replace")
+        results.put((idx, job))
+
+    def _run(self, job: WorkerResult):
+        stime = time.time()
         try:
-            self._command.command(self._shell, args)
+            errors = self._errors.count()
+            ret = self._command.command(self._shell, job.args)
+            # a command that logs an error and returns nothing failed as well
+            job.success = ret is not False and (ret is True or self._errors.count() == errors)
         except KeyboardInterrupt:
-            dtslogger.error(f"   <===== Multi-Arg: Aborted with args: {args}")
+            job.aborted = True
+        except SystemExit as e:
+            job.success = e.code in [None, 0]
         except BaseException:
             # printing stack trace
             traceback.print_exc()
-            time.sleep(0.1)
-            dtslogger.error(f"   <===== Multi-Arg:  Failed with args: {args}")
-        self._log(f"    <===== Multi-Arg: Success with args: {args}")
+        finally:
+            job.duration = time.time() - stime
+
+    @staticmethod
+    def _log_result(job: WorkerResult):
+        if job.success:
+            dtslogger.info(f"    <===== Multi-Arg: Success with [{job.label}] in {job.duration:.1f}s")
+        else:
+            dtslogger.error(f"    <===== Multi-Arg: Failed with [{job.label}]")
 
     def _get_args(self):
         args = [copy.deepcopy(self._args) for _ in range(len(self._values))]
@@ -113,6 +352,8 @@ class MultiCommand(object):
                 return
             # parse values
             values[marg] = self._parse_values(marg_value)
+            if not values[marg]:
+                raise UserError(f"The value '{marg_value}' of {marg} does not match any target.")
         # combine values into a list of tuples
         self._keys = list(values.keys())
         self._values = list(product(*values.values()))
@@ -120,14 +361,23 @@ class MultiCommand(object):
     @staticmethod
     def _parse_values(arg_value: str) -> List[Any]:
         arg_value = str(arg_value)
+        # fleet selectors (e.g., @duckiebot, @type=watchtower,config=WT21A) are resolved via discovery
+        if arg_value.startswith(SELECTOR_PREFIX):
+            return MultiCommand._resolve_selector(arg_value[len(SELECTOR_PREFIX) :])
         match = re.match("^.*{([^}]+)}.*$", arg_value)
         if not match:
             return [arg_value]
         s, f = arg_value.index("{"), arg_value.index("}") + 1
         domain = match.group(1)
+
+        def _range(m):
+            # keep zero-padding, e.g., {01-60}
+            width = len(m.group(1)) if m.group(1).startswith("0") else 0
+            return [str(i).zfill(width) for i in range(int(m.group(1)), int(m.group(2)) + 1, 1)]
+
         patterns = {
-            r"^(\d)+\-(\d)+$": lambda m: list(range(int(m.group(1)), int(m.group(2)) + 1, 1)),
-            r"^(\d)+(\,(\d)+)*$": lambda m: list(map(int, m.group(0).split(","))),
+            r"^(\d+)\-(\d+)$": _range,
+            r"^([^,]+)(\,([^,]+))*$": lambda m: [v.strip() for v in m.group(0).split(",")],
         }
         for pattern, parser in patterns.items():
             match = re.match(pattern, domain)
@@ -140,3 +390,24 @@ class MultiCommand(object):
                 dtslogger.error(f'Error parsing multi-arg value "{domain}".')
                 return []
             return skeleton(values)
+
+    @staticmethod
+    def _resolve_selector(selector: str) -> List[str]:
+        from utils.avahi_utils import discover_devices, match_device
+
+        # parse selector: `<type>` is a shortcut for `type=<type>`, an empty selector matches everything
+        criteria: Dict[str, str] = {}
+        for term in filter(len, selector.split(",")):
+            key, _, value = term.partition("=") if "=" in term else ("type", "=", term)
+            key = SELECTOR_KEYS.get(key.strip().lower(), None)
+            if key is None:
+                dtslogger.error(
+                    f"Invalid fleet selector term '{term}'. Supported keys are: {', '.join(SELECTOR_KEYS)}."
+                )
+                return []
+            criteria[key] = value.strip()
+        dtslogger.info(f"Discovering devices matching '{SELECTOR_PREFIX}{selector}'...")
+        devices: Dict[str, dict] = discover_devices(timeout=SELECTOR_DISCOVERY_TIMEOUT)
+        hostnames: List[str] = sorted(h for h, device in devices.items() if match_device(device, criteria))
+        dtslogger.info(f"Found {len(hostnames)} device(s) matching '{SELECTOR_PREFIX}{selector}'.")
+        return hostnames
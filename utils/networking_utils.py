@@ -1,29 +1,113 @@
+import atexit
+import ipaddress
+import json
 import os
-import re
 import socket
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from dt_shell import dtslogger
+from dt_shell.constants import DTShellConstants
 
 from utils.exceptions import NetworkingError
 
+MDNS_TIMEOUT = 3.0
+# delays (in seconds, since the first query) at which unanswered mDNS queries are sent again
+MDNS_RETRANSMIT = [0.25, 1.0, 2.0]
 
-def get_ip_from_ping(alias):
-    response = os.popen("ping -c 1 %s" % alias).read()
-    m = re.search("PING.*?\((.*?)\)+", response)
-    if m:
-        return m.group(1)
-    else:
-        raise Exception("Unable to locate %s!" % alias)
+# in-process cache, hostname -> (ip, expiration time)
+_resolved: Dict[str, tuple] = {}
+_zeroconf = None
+_zeroconf_lock = threading.Lock()
 
 
 def get_duckiebot_ip(duckiebot_name):
     try:
-        duckiebot_ip = get_ip_from_ping("%s.local" % duckiebot_name)
-    except Exception as e:
-        print(e)
-        duckiebot_ip = get_ip_from_ping(duckiebot_name)
+        duckiebot_ip = get_ip(f"{duckiebot_name}.local")
+    except NetworkingError:
+        duckiebot_ip = get_ip(duckiebot_name)
 
     return duckiebot_ip
 
 
+def get_ip(hostname: str) -> str:
+    """
+    Resolves a hostname to an IP address. Names in the `.local` domain are resolved via mDNS
+    (answers are cached with their TTL), everything else through the system resolver.
+    """
+    try:
+        ipaddress.ip_address(hostname)
+        return hostname
+    except ValueError:
+        pass
+    if hostname.rstrip(".").endswith(".local"):
+        ip: Optional[str] = resolve_mdns([hostname])[hostname]
+        if ip is not None:
+            return ip
+    # fall back to the system resolver
+    try:
+        return socket.gethostbyname(hostname)
+    except socket.gaierror as e:
+        msg = f"Failed to resolve host using name '{hostname}'.\n\tException(socket.gaierror): {e}"
+        raise NetworkingError(msg)
+
+
+def resolve_mdns(hostnames: List[str], timeout: float = MDNS_TIMEOUT) -> Dict[str, Optional[str]]:
+    """
+    Resolves many `.local` hostnames at once by querying mDNS directly. Returns a map hostname -> IP
+    (None for hostnames that did not answer within `timeout` seconds).
+    """
+    from zeroconf import DNSOutgoing, DNSQuestion, current_time_millis
+    from zeroconf.const import _TYPE_A, _CLASS_IN, _FLAGS_QR_QUERY
+
+    now: float = time.time()
+    results: Dict[str, Optional[str]] = {h: None for h in hostnames}
+    # look in the caches first
+    disk_cache: Dict[str, dict] = _load_mdns_cache()
+    for hostname in hostnames:
+        ip, expires = _resolved.get(hostname, (None, 0))
+        if ip is None and hostname in disk_cache:
+            ip, expires = disk_cache[hostname]["ip"], disk_cache[hostname]["expires"]
+        if ip is not None and expires > now:
+            results[hostname] = ip
+    missing: List[str] = [h for h, ip in results.items() if ip is None]
+    if not missing:
+        return results
+    # ask all the missing hostnames in the same query
+    zc = _get_zeroconf()
+    names: Dict[str, str] = {h: h.rstrip(".") + "." for h in missing}
+    stime: float = time.time()
+    retransmit: List[float] = [0.0] + [t for t in MDNS_RETRANSMIT if t < timeout]
+    while missing and time.time() - stime < timeout:
+        if retransmit and time.time() - stime >= retransmit[0]:
+            retransmit.pop(0)
+            out = DNSOutgoing(_FLAGS_QR_QUERY)
+            for hostname in missing:
+                out.add_question(DNSQuestion(names[hostname], _TYPE_A, _CLASS_IN))
+            zc.send(out)
+        time.sleep(0.02)
+        # collect answers
+        for hostname in list(missing):
+            # NOTE: zeroconf timestamps records using a monotonic clock
+            zc_now: float = current_time_millis()
+            records = zc.cache.get_all_by_details(names[hostname], _TYPE_A, _CLASS_IN)
+            records = [r for r in records if not r.is_expired(zc_now)]
+            if not records:
+                continue
+            record = max(records, key=lambda r: r.created)
+            ip: str = socket.inet_ntoa(record.address)
+            expires: float = time.time() + record.get_remaining_ttl(zc_now)
+            results[hostname] = ip
+            _resolved[hostname] = (ip, expires)
+            disk_cache[hostname] = {"ip": ip, "expires": expires}
+            missing.remove(hostname)
+    dtslogger.debug(f"mDNS: resolved {len(hostnames) - len(missing)}/{len(hostnames)} hostname(s)")
+    _save_mdns_cache(disk_cache)
+    return results
+
+
 def resolve_hostname(hostname: str) -> str:
     # separate protocol (if any)
     protocol = ""
@@ -36,9 +120,60 @@ def resolve_hostname(hostname: str) -> str:
         idx = hostname.index(":")
         hostname, port = hostname[0:idx], hostname[idx:]
     # perform name resolution
-    try:
-        ip = socket.gethostbyname(hostname)
-    except socket.gaierror as e:
-        msg = f"Failed to resolve host using name '{hostname}'.\n\tException(socket.gaierror): {e}"
-        raise NetworkingError(msg)
+    ip = get_ip(hostname)
     return protocol + ip + port
+
+
+def _get_zeroconf():
+    global _zeroconf
+    with _zeroconf_lock:
+        if _zeroconf is None:
+            from zeroconf import Zeroconf
+
+            _zeroconf = Zeroconf()
+            atexit.register(_zeroconf.close)
+        return _zeroconf
+
+
+def _reset_zeroconf():
+    # a forked child inherits the parent's instance (whose threads did not survive the fork) and,
+    # possibly, a lock held by one of those threads, start over with fresh ones
+    global _zeroconf, _zeroconf_lock
+    _zeroconf = None
+    _zeroconf_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_zeroconf)
+
+
+def _mdns_cache_file() -> str:
+    return os.path.join(os.path.expanduser(DTShellConstants.ROOT), "cache", "mdns.json")
+
+
+def _load_mdns_cache() -> Dict[str, dict]:
+    fpath: str = _mdns_cache_file()
+    if not os.path.isfile(fpath):
+        return {}
+    try:
+        with open(fpath, "rt") as fin:
+            cache = json.load(fin)
+    except (ValueError, OSError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    # drop expired entries
+    now: float = time.time()
+    return {h: e for h, e in cache.items() if isinstance(e, dict) and e.get("expires", 0) > now}
+
+
+def _save_mdns_cache(cache: Dict[str, dict]):
+    # write atomically, other shells might be doing the same
+    fpath: str = _mdns_cache_file()
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wt", dir=os.path.dirname(fpath), delete=False) as fout:
+            json.dump(cache, fout, indent=4, sort_keys=True)
+        os.replace(fout.name, fpath)
+    except OSError as e:
+        dtslogger.debug(f"Could not update the mDNS cache: {e}")
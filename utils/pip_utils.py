@@ -1,6 +1,17 @@
 DEFAULT_INDEX_URL = "https://pypi.org/simple/"
 import os
-from dt_shell import dtslogger
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from dt_shell import dtslogger, UserError
+
+VCS_SCHEMES: Tuple[str, ...] = ("git+", "hg+", "svn+", "bzr+")
+URL_SCHEMES: Tuple[str, ...] = VCS_SCHEMES + ("http://", "https://", "file://")
+
+_NAME_RE = re.compile(r"^([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*(?:\[([^\]]*)\])?\s*(.*)$")
+_EGG_RE = re.compile(r"[#&]egg=([A-Za-z0-9._-]+)(?:\[([^\]]*)\])?")
 
 
 def get_pip_index_url() -> str:
@@ -17,3 +28,164 @@ def import_or_install(package, name):
         __import__(name)
     except ImportError:
         pip.main(["install", package])
+
+
+def canonicalize_name(name: str) -> str:
+    # PEP 503 normalized name
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def is_comment(line: str) -> bool:
+    return len(line.strip()) <= 0 or line.lstrip().startswith("#")
+
+
+@dataclass
+class PipRequirement:
+    raw: str
+    name: str
+    extras: Tuple[str, ...] = tuple()
+    specifier: str = ""
+    url: Optional[str] = None
+    marker: Optional[str] = None
+    editable: bool = False
+
+    @property
+    def key(self) -> str:
+        return canonicalize_name(self.name)
+
+    @property
+    def is_vcs(self) -> bool:
+        return self.url is not None and self.url.startswith(VCS_SCHEMES)
+
+    @classmethod
+    def parse(cls, line: str) -> Optional["PipRequirement"]:
+        """
+        Parses a single line of a requirements file or of the output of `pip freeze`.
+        Returns None for comments, empty lines and pip options (e.g. --index-url).
+        """
+        raw: str = line.strip()
+        # drop inline comments (pip requires a whitespace before them)
+        content: str = re.split(r"\s+#", raw, maxsplit=1)[0].strip()
+        if is_comment(content) or (content.startswith("-") and not content.startswith(("-e", "--editable"))):
+            return None
+        # editable requirements
+        editable: bool = False
+        for prefix in ("--editable", "-e"):
+            if content.startswith(prefix):
+                editable = True
+                content = content[len(prefix) :].lstrip(" =")
+                break
+        # environment markers (URLs need a whitespace before ';')
+        marker: Optional[str] = None
+        url_like: bool = content.startswith(URL_SCHEMES) or " @ " in content or "@" in content.split(";")[0]
+        parts = re.split(r"\s+;\s*" if url_like else r"\s*;\s*", content, maxsplit=1)
+        if len(parts) == 2:
+            content, marker = parts[0].strip(), parts[1].strip() or None
+        # bare URLs and editables carry their name in the egg fragment
+        if editable or content.startswith(URL_SCHEMES):
+            egg = _EGG_RE.search(content)
+            if egg is None:
+                raise UserError(f"Cannot determine the name of the package from requirement '{raw}'.")
+            extras = tuple(e.strip() for e in (egg.group(2) or "").split(",") if e.strip())
+            return cls(raw, egg.group(1), extras, "", content, marker, editable)
+        # named requirements
+        match = _NAME_RE.match(content)
+        if match is None:
+            raise UserError(f"Invalid requirement '{raw}'.")
+        name, extras, rest = match.group(1), match.group(2) or "", match.group(3).strip()
+        extras = tuple(e.strip() for e in extras.split(",") if e.strip())
+        # direct references, i.e., `name @ url`
+        if rest.startswith("@"):
+            return cls(raw, name, extras, "", rest[1:].strip(), marker, editable)
+        specifier: str = re.sub(r"\s+", "", rest.strip("()"))
+        return cls(raw, name, extras, specifier, None, marker, editable)
+
+    def pinned_as(self, pinned: "PipRequirement") -> str:
+        """
+        Returns the line that pins this requirement to the version found in `pinned`, keeping the
+        extras and the environment marker of this requirement.
+        """
+        if (not self.extras and not self.marker) or pinned.editable:
+            return pinned.raw
+        extras: List[str] = list(OrderedDict.fromkeys(pinned.extras + self.extras))
+        line: str = pinned.name + (f"[{','.join(extras)}]" if extras else "")
+        line += f" @ {pinned.url}" if pinned.url else pinned.specifier
+        marker: Optional[str] = self.marker or pinned.marker
+        if marker:
+            # PEP 508: a whitespace is needed before the ';' that follows a URL
+            line += f" ; {marker}" if pinned.url else f"; {marker}"
+        return line
+
+
+class PipFreezeIndex:
+    """
+    Index of the packages in a `pip freeze` list by PEP 503 normalized name.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self._index: Dict[str, PipRequirement] = OrderedDict()
+        for line in lines:
+            try:
+                req: Optional[PipRequirement] = PipRequirement.parse(line)
+            except UserError as e:
+                dtslogger.debug(f"Ignoring pip-freeze entry '{line}': {e}")
+                continue
+            if req is not None:
+                self._index[req.key] = req
+
+    def get(self, name: str) -> Optional[PipRequirement]:
+        return self._index.get(canonicalize_name(name))
+
+    def keys(self) -> Set[str]:
+        return set(self._index.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return canonicalize_name(name) in self._index
+
+    def __iter__(self) -> Iterator[PipRequirement]:
+        return iter(self._index.values())
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class PipResolver:
+    """
+    Resolves lists of wanted dependencies against the packages installed in an image (pinned) and
+    the ones installed in its base image (inherited). A single resolver can be used to resolve
+    many dependencies lists against the same indices.
+    """
+
+    def __init__(self, pinned: PipFreezeIndex, inherited: Optional[PipFreezeIndex] = None):
+        self._pinned: PipFreezeIndex = pinned
+        self._inherited: PipFreezeIndex = inherited if inherited is not None else PipFreezeIndex([])
+
+    def resolve(self, wanted: List[str]) -> Tuple[List[str], Set[str]]:
+        """
+        Returns the list of resolved dependencies (comments included) and the set of dependencies
+        installed in the image but neither listed in `wanted` nor inherited from the base image.
+        """
+        resolved: List[str] = []
+        matched: Set[str] = set()
+        for dep in wanted:
+            # keep comments
+            req: Optional[PipRequirement] = PipRequirement.parse(dep)
+            if req is None:
+                resolved.append(dep)
+                continue
+            # match with pinned
+            pinned: Optional[PipRequirement] = self._pinned.get(req.name)
+            # make sure we always have a match
+            if pinned is None:
+                msg: str = f"Dependency '{dep}' not found in pip freeze."
+                dtslogger.error(msg)
+                dtslogger.debug(f"pip-freeze: {[p.raw for p in self._pinned]}")
+                raise UserError(msg)
+            resolved.append(req.pinned_as(pinned))
+            matched.add(pinned.key)
+        # installed dependencies that were neither wanted nor inherited
+        unmatched: Set[str] = {
+            p.raw for p in self._pinned if p.key not in matched and p.key not in self._inherited
+        }
+        # ---
+        return resolved, unmatched
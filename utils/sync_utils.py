@@ -0,0 +1,714 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Set, Dict, Tuple, Iterable, Pattern, Union
+
+from dt_shell import dtslogger, UserError
+from dt_shell.constants import DTShellConstants
+from termcolor import colored
+
+from utils.cli_utils import check_program_dependency
+from utils.dtproject_utils import DTProject
+from utils.table_utils import format_matrix
+
+__all__ = [
+    "DEFAULT_REMOTE_USER",
+    "DEFAULT_REMOTE_PATH",
+    "SSHConnection",
+    "IgnoreRules",
+    "TransferSet",
+    "rsync_project",
+    "rsync_files",
+    "SyncWatcher",
+    "build_manifest",
+    "diff_manifests",
+    "FleetSync",
+]
+
+DEFAULT_REMOTE_USER = "duckie"
+DEFAULT_REMOTE_PATH = "/code/"
+
+# inotify events that change the content of a project
+WATCH_EVENTS = ["close_write", "create", "delete", "moved_to", "moved_from"]
+# paths that are never worth watching
+WATCH_EXCLUDE = r"(/\.git/|/__pycache__/|\.swp$|\.swx$|~$)"
+
+# file left on the remote copy of a project after a successful push, it identifies the manifest of the push
+SYNC_STAMP_FILE = ".dts-sync"
+
+# a manifest maps each path (relative to the project) to its (type, size, mtime), the type is one of
+# "f" (file), "l" (symlink) or "d" (directory, only the ones containing files are tracked)
+Manifest = Dict[str, Tuple[str, int, int]]
+
+
+class SSHConnection:
+    """
+    Persistent SSH connection (OpenSSH ControlMaster) to a remote host. Commands using `ssh` as
+    transport (e.g., rsync) can reuse it and skip the SSH handshake.
+    """
+
+    def __init__(self, hostname: str, user: str = DEFAULT_REMOTE_USER):
+        self._hostname: str = hostname
+        self._user: str = user
+        self._tmpdir: Optional[str] = None
+        self._socket: Optional[str] = None
+
+    @property
+    def destination(self) -> str:
+        return f"{self._user}@{self._hostname}"
+
+    @property
+    def is_open(self) -> bool:
+        return self._socket is not None
+
+    @property
+    def ssh_command(self) -> str:
+        if self._socket is None:
+            return "ssh"
+        return f"ssh -o ControlPath={shlex.quote(self._socket)}"
+
+    def open(self):
+        if self._socket is not None:
+            return
+        check_program_dependency("ssh")
+        self._tmpdir = tempfile.mkdtemp(prefix="dts-ssh-")
+        self._socket = os.path.join(self._tmpdir, "control.sock")
+        cmd = [
+            "ssh",
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            f"ControlPath={self._socket}",
+            "-o",
+            "ControlPersist=yes",
+            "-o",
+            "ServerAliveInterval=10",
+            self.destination,
+        ]
+        dtslogger.debug(f"$ {' '.join(cmd)}")
+        subprocess.check_call(cmd)
+
+    def run(self, command: str) -> str:
+        """
+        Runs a shell command on the remote host and returns its output.
+        """
+        cmd = ["ssh"] + (["-o", f"ControlPath={self._socket}"] if self._socket else [])
+        cmd += [self.destination, command]
+        dtslogger.debug(f"$ {' '.join(cmd)}")
+        return subprocess.check_output(cmd, stdin=subprocess.DEVNULL).decode("utf-8")
+
+    def close(self):
+        if self._socket is None:
+            return
+        cmd = ["ssh", "-o", f"ControlPath={self._socket}", "-O", "exit", self.destination]
+        dtslogger.debug(f"$ {' '.join(cmd)}")
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            os.rmdir(self._tmpdir)
+        except OSError:
+            pass
+        self._socket = self._tmpdir = None
+
+    def __enter__(self) -> "SSHConnection":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class IgnoreRules:
+    """
+    Ordered list of gitignore-style patterns (as found in .gitignore and .dockerignore files).
+    The last pattern matching a path (or any of its parents) decides whether the path is ignored.
+    """
+
+    def __init__(self, anchored: bool = False):
+        # .dockerignore patterns are always relative to the root of the context
+        self._anchored: bool = anchored
+        self._rules: List[Tuple[Pattern, bool, bool, Optional[str]]] = []
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def add_file(self, fpath: str, base: str = ""):
+        if not os.path.isfile(fpath):
+            return
+        with open(fpath, "rt") as fin:
+            self.add_patterns(fin.readlines(), base=base)
+
+    def add_patterns(self, patterns: Iterable[str], base: str = ""):
+        base = base.strip("/")
+        for pattern in patterns:
+            pattern = pattern.rstrip("\n").rstrip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negate: bool = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            if pattern.startswith("\\"):
+                pattern = pattern[1:]
+            dir_only: bool = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if self._anchored and pattern:
+                pattern = os.path.normpath(pattern).lstrip("/")
+            if pattern in ("", "."):
+                continue
+            anchored: bool = self._anchored or "/" in pattern
+            pattern = pattern.lstrip("/")
+            regex: str = self._translate(pattern)
+            prefix: str = re.escape(base + "/") if base else ""
+            if not anchored:
+                prefix += "(?:.*/)?"
+            # literal prefix of anchored negations, used to decide whether ignored dirs can be skipped
+            literal: Optional[str] = None
+            if negate:
+                literal = ((base + "/" if base else "") + re.split(r"[*?\[]", pattern)[0]) if anchored else ""
+            self._rules.append((re.compile(f"^{prefix}{regex}$"), negate, dir_only, literal))
+
+    def is_ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        parts: List[str] = rel_path.strip("/").split("/")
+        ignored: bool = False
+        for i in range(1, len(parts) + 1):
+            path: str = "/".join(parts[:i])
+            path_is_dir: bool = is_dir or i < len(parts)
+            for regex, negate, dir_only, _ in self._rules:
+                if dir_only and not path_is_dir:
+                    continue
+                if regex.match(path):
+                    ignored = not negate
+        return ignored
+
+    def may_include_under(self, rel_dir: str) -> bool:
+        """
+        Whether a negated pattern could re-include something under the given (ignored) directory.
+        """
+        rel_dir = rel_dir.strip("/") + "/"
+        for _, negate, _, literal in self._rules:
+            if negate and (literal == "" or literal.startswith(rel_dir) or rel_dir.startswith(literal)):
+                return True
+        return False
+
+    @staticmethod
+    def _translate(pattern: str) -> str:
+        regex: str = ""
+        i: int = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+                continue
+            if c == "*":
+                regex += "[^/]*"
+            elif c == "?":
+                regex += "[^/]"
+            elif c == "[":
+                j = pattern.find("]", i + 1)
+                if j < 0:
+                    regex += re.escape(c)
+                else:
+                    group = pattern[i + 1 : j]
+                    if group.startswith("!"):
+                        group = "^" + group[1:]
+                    regex += f"[{group}]"
+                    i = j
+            else:
+                regex += re.escape(c)
+            i += 1
+        return regex
+
+
+class TransferSet:
+    """
+    Files of a project that need to be pushed to a remote host for the project's containers to
+    find them, i.e., the paths the container mounts (code and launchers) minus whatever is ignored
+    by the project's .gitignore (including nested ones) and .dockerignore files.
+    A plain directory (given as a path) is transferred as a whole, minus the ignored files.
+    """
+
+    def __init__(
+        self,
+        project: Union[DTProject, str],
+        code: bool = True,
+        launchers: bool = True,
+        exclude: Optional[List[str]] = None,
+    ):
+        # paths (relative to the project) the containers mount
+        roots: List[str] = []
+        if isinstance(project, str):
+            self._path: str = os.path.abspath(project).rstrip("/")
+            self._name: str = os.path.basename(self._path)
+            roots.append(self._path)
+        else:
+            self._path: str = project.path.rstrip("/")
+            self._name: str = project.name
+            if code:
+                roots += project.code_paths()[0]
+            if launchers:
+                roots.append(project.launch_paths()[0])
+        roots = [os.path.relpath(r, self._path) for r in roots]
+        self._roots: List[str] = ["" if r == "." else r for r in roots]
+        # ignore rules
+        self._extra: IgnoreRules = IgnoreRules()
+        self._extra.add_patterns(exclude or [])
+        self.reload_ignores()
+
+    @classmethod
+    def from_path(cls, path: str, **kwargs) -> "TransferSet":
+        """
+        Transfer set of the project at the given path, or of the whole directory if it does not contain
+        a (supported) project.
+        """
+        try:
+            project: DTProject = DTProject(path)
+            project.code_paths(), project.launch_paths()
+        except (UserError, ValueError):
+            dtslogger.debug(f"The path '{path}' is not a supported project, transferring it as a directory.")
+            return cls(path, **kwargs)
+        return cls(project, **kwargs)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def remote_path(self) -> str:
+        return f"{DEFAULT_REMOTE_PATH}{self.name}/"
+
+    def is_ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        return any(rules.is_ignored(rel_path, is_dir) for rules in self._rules)
+
+    def contains(self, rel_path: str, is_dir: bool = False) -> bool:
+        rel_path = rel_path.strip("/")
+        under_root: bool = any(
+            r == ""
+            or rel_path == r
+            or rel_path.startswith(r + "/")
+            or (is_dir and r.startswith(rel_path + "/"))
+            for r in self._roots
+        )
+        return under_root and not self.is_ignored(rel_path, is_dir)
+
+    def files(self, subdir: str = "") -> List[str]:
+        """
+        Walks the transfer set (or the part of it under `subdir`) and returns the paths of the files
+        in it, relative to the project.
+        """
+        subdir = subdir.strip("/")
+        files: List[str] = []
+        for root in self._roots:
+            # restrict the walk to the intersection of `root` and `subdir`
+            if subdir and root and not (subdir.startswith(root + "/") or subdir == root):
+                if not root.startswith(subdir + "/"):
+                    continue
+                start = root
+            else:
+                start = subdir or root
+            abs_start: str = os.path.join(self._path, start)
+            if os.path.isfile(abs_start) or os.path.islink(abs_start):
+                if not self.is_ignored(start):
+                    files.append(start)
+                continue
+            for dirpath, dirs, fnames in os.walk(abs_start):
+                rel_dir: str = os.path.relpath(dirpath, self._path)
+                rel_dir = "" if rel_dir == "." else rel_dir
+                self._load_gitignore(rel_dir)
+                # prune ignored directories (unless a negated pattern can re-include their content)
+                keep: List[str] = []
+                for d in dirs:
+                    rel: str = os.path.join(rel_dir, d)
+                    if os.path.islink(os.path.join(dirpath, d)):
+                        if not self.is_ignored(rel):
+                            files.append(rel)
+                    elif not self.is_ignored(rel, is_dir=True) or any(
+                        rules.may_include_under(rel) for rules in self._rules
+                    ):
+                        keep.append(d)
+                dirs[:] = keep
+                for f in fnames:
+                    rel: str = os.path.join(rel_dir, f)
+                    if not self.is_ignored(rel):
+                        files.append(rel)
+        return sorted(set(files))
+
+    def reload_ignores(self):
+        """
+        (Re)loads the .gitignore and .dockerignore files, nested .gitignore files are loaded as the
+        project is walked.
+        """
+        self._gitignore: IgnoreRules = IgnoreRules()
+        self._gitignore.add_patterns([".git/"])
+        self._gitignore.add_file(os.path.join(self._path, ".gitignore"))
+        self._dockerignore: IgnoreRules = IgnoreRules(anchored=True)
+        self._dockerignore.add_file(os.path.join(self._path, ".dockerignore"))
+        self._seen_gitignores: Set[str] = {""}
+
+    @property
+    def _rules(self) -> List[IgnoreRules]:
+        return [self._gitignore, self._dockerignore, self._extra]
+
+    def _load_gitignore(self, rel_dir: str):
+        if rel_dir in self._seen_gitignores:
+            return
+        self._seen_gitignores.add(rel_dir)
+        self._gitignore.add_file(os.path.join(self._path, rel_dir, ".gitignore"), base=rel_dir)
+
+
+def _remote(hostname: str, path: str, user: str = DEFAULT_REMOTE_USER) -> str:
+    return f"{user}@{hostname}:{path}"
+
+
+def rsync_files(
+    tset: TransferSet,
+    files: Iterable[str],
+    hostname: str,
+    ssh: Optional[SSHConnection] = None,
+    user: str = DEFAULT_REMOTE_USER,
+):
+    """
+    Pushes the given paths (relative to the project) to the remote host. Paths that do not exist
+    anymore are deleted on the remote side.
+    """
+    files = sorted(set(files))
+    if len(files) <= 0:
+        return
+    files_from: str = "\n".join(files) + "\n"
+    # --force lets rsync delete directories that are gone locally but still have content on the remote
+    cmd = ["rsync", "--archive", "--recursive", "--relative", "--delete-missing-args", "--force"]
+    cmd += ["--files-from=-"]
+    if ssh is not None:
+        cmd += ["-e", ssh.ssh_command]
+    cmd += [f"{tset.path}/", _remote(hostname, tset.remote_path, user=user)]
+    dtslogger.debug(f"$ {' '.join(cmd)} <<< {len(files)} file(s)")
+    subprocess.run(cmd, input=files_from.encode("utf-8"), check=True)
+
+
+def rsync_project(
+    tset: TransferSet, hostname: str, ssh: Optional[SSHConnection] = None, user: str = DEFAULT_REMOTE_USER
+) -> int:
+    """
+    Pushes the whole transfer set to the remote host. Returns the number of files in the set.
+    """
+    files: List[str] = tset.files()
+    rsync_files(tset, files, hostname, ssh=ssh, user=user)
+    return len(files)
+
+
+class SyncWatcher:
+    """
+    Watches one or more projects for changes (using inotify) and pushes only the changed files to
+    the remote host. Changes are batched: a batch is pushed once no new changes are observed for
+    `debounce` seconds, or when the oldest change in the batch is older than `max_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        projects: List[TransferSet],
+        hostname: str,
+        debounce: float = 0.3,
+        max_delay: float = 2.0,
+        user: str = DEFAULT_REMOTE_USER,
+    ):
+        self._projects: List[TransferSet] = projects
+        self._hostname: str = hostname
+        self._debounce: float = debounce
+        self._max_delay: float = max_delay
+        self._user: str = user
+        self._ssh: SSHConnection = SSHConnection(hostname, user=user)
+        self._lock = threading.Condition()
+        self._changes: Dict[str, Set[str]] = {p.path: set() for p in self._projects}
+        # projects whose ignore files changed
+        self._reload: Set[str] = set()
+        self._first_change: Optional[float] = None
+        self._last_change: Optional[float] = None
+        self._watcher: Optional[subprocess.Popen] = None
+
+    def run(self):
+        check_program_dependency("rsync")
+        check_program_dependency("inotifywait")
+        with self._ssh:
+            # start watching before the initial sync so that nothing is missed
+            self._start_watcher()
+            for project in self._projects:
+                rsync_project(project, self._hostname, ssh=self._ssh, user=self._user)
+            dtslogger.info("Code synced! Watching for changes, press Ctrl-C to stop...")
+            try:
+                while True:
+                    batch, reload = self._next_batch()
+                    self._push(batch, reload)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self._stop_watcher()
+
+    def _start_watcher(self):
+        cmd = [
+            "inotifywait",
+            "--monitor",
+            "--recursive",
+            "--quiet",
+            "--format",
+            "%w%f",
+            "--exclude",
+            WATCH_EXCLUDE,
+        ]
+        for event in WATCH_EVENTS:
+            cmd += ["--event", event]
+        cmd += [p.path for p in self._projects]
+        dtslogger.debug(f"$ {' '.join(cmd)}")
+        self._watcher = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True)
+        reader = threading.Thread(target=self._read_events, daemon=True)
+        reader.start()
+
+    def _stop_watcher(self):
+        if self._watcher is not None:
+            self._watcher.terminate()
+            self._watcher.wait()
+            self._watcher = None
+
+    def _read_events(self):
+        # paths are only recorded here, the ignore rules are only ever used by the main thread
+        for line in self._watcher.stdout:
+            path: str = line.rstrip("\n")
+            for project in self._projects:
+                if not path.startswith(project.path + "/"):
+                    continue
+                rel: str = os.path.relpath(path, project.path)
+                with self._lock:
+                    self._changes[project.path].add(rel)
+                    if os.path.basename(rel) in (".gitignore", ".dockerignore"):
+                        self._reload.add(project.path)
+                    now = time.time()
+                    self._first_change = self._first_change or now
+                    self._last_change = now
+                    self._lock.notify()
+                break
+
+    def _next_batch(self) -> Tuple[Dict[str, Set[str]], Set[str]]:
+        with self._lock:
+            while True:
+                if self._watcher.poll() is not None:
+                    raise RuntimeError("The file watcher (inotifywait) exited unexpectedly.")
+                if self._last_change is None:
+                    self._lock.wait(timeout=1.0)
+                    continue
+                now = time.time()
+                quiet: float = now - self._last_change
+                waiting: float = now - self._first_change
+                if quiet >= self._debounce or waiting >= self._max_delay:
+                    break
+                self._lock.wait(timeout=min(self._debounce - quiet, self._max_delay - waiting))
+            batch, reload = self._changes, self._reload
+            self._changes = {p.path: set() for p in self._projects}
+            self._reload = set()
+            self._first_change = self._last_change = None
+        return batch, reload
+
+    @staticmethod
+    def _resolve(project: TransferSet, paths: Set[str]) -> Set[str]:
+        files: Set[str] = set()
+        for rel in paths:
+            path: str = os.path.join(project.path, rel)
+            # new directories are pushed file by file, so that ignored content stays behind
+            if os.path.isdir(path) and not os.path.islink(path):
+                files.update(project.files(rel))
+            elif project.contains(rel):
+                files.add(rel)
+        return files
+
+    def _push(self, batch: Dict[str, Set[str]], reload: Set[str]):
+        for project in self._projects:
+            stime = time.time()
+            try:
+                # what is ignored might have changed, the whole project is pushed again
+                if project.path in reload:
+                    project.reload_ignores()
+                files: Set[str] = self._resolve(project, batch[project.path])
+                if project.path in reload:
+                    files.update(project.files())
+                if len(files) <= 0:
+                    continue
+                rsync_files(project, files, self._hostname, ssh=self._ssh, user=self._user)
+            except subprocess.CalledProcessError as e:
+                dtslogger.error(f"Failed to sync {len(files)} file(s) from '{project.name}': {e}")
+                continue
+            dtslogger.info(f"Synced {len(files)} file(s) from '{project.name}' in {time.time() - stime:.2f}s")
+
+
+def build_manifest(project: TransferSet) -> Manifest:
+    """
+    Walks the transfer set of a project once and returns its manifest.
+    """
+    manifest: Manifest = {}
+    for rel in project.files():
+        try:
+            st = os.lstat(os.path.join(project.path, rel))
+        except FileNotFoundError:
+            continue
+        manifest[rel] = ("l" if stat.S_ISLNK(st.st_mode) else "f", st.st_size, st.st_mtime_ns)
+        # directories are tracked so that the ones removed locally are removed on the remote as well
+        parent: str = os.path.dirname(rel)
+        while parent and parent not in manifest:
+            manifest[parent] = ("d", 0, 0)
+            parent = os.path.dirname(parent)
+    return manifest
+
+
+def diff_manifests(old: Optional[Manifest], new: Manifest) -> Set[str]:
+    """
+    Returns the paths that need to be pushed to go from `old` to `new`, deleted paths included.
+    With no `old` manifest, all the files in `new` are returned.
+    """
+    old = old or {}
+    # directories are pushed file by file, pushing a directory would push its ignored content too
+    changed: Set[str] = {p for p, entry in new.items() if entry[0] != "d" and old.get(p) != entry}
+    deleted: Set[str] = set(old.keys()).difference(new.keys())
+    return changed | deleted
+
+
+def _manifest_cache_file(hostname: str, project: TransferSet) -> str:
+    cache_dir: str = os.path.join(os.path.expanduser(DTShellConstants.ROOT), "sync", hostname)
+    key: str = hashlib.sha1(project.path.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{project.name}-{key}.json")
+
+
+def _load_manifest(hostname: str, project: TransferSet) -> Tuple[Optional[str], Optional[Manifest]]:
+    # returns the stamp of the last push and its manifest
+    fpath: str = _manifest_cache_file(hostname, project)
+    if not os.path.isfile(fpath):
+        return None, None
+    try:
+        with open(fpath, "rt") as fin:
+            cache = json.load(fin)
+        return cache["stamp"], {p: tuple(e) for p, e in cache["manifest"].items()}
+    except (ValueError, KeyError, TypeError, OSError):
+        return None, None
+
+
+def _save_manifest(hostname: str, project: TransferSet, manifest: Manifest, stamp: str):
+    fpath: str = _manifest_cache_file(hostname, project)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath, "wt") as fout:
+        json.dump({"stamp": stamp, "manifest": manifest}, fout)
+
+
+def _forget_manifest(hostname: str, project: TransferSet):
+    try:
+        os.remove(_manifest_cache_file(hostname, project))
+    except FileNotFoundError:
+        pass
+
+
+@dataclass
+class RobotSyncResult:
+    hostname: str
+    success: bool = False
+    files: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+class FleetSync:
+    """
+    Syncs one or more projects with many robots. The projects are scanned only once, the resulting
+    manifests are compared against the manifest last pushed to each robot, and only the differences
+    are pushed, using a bounded pool of workers.
+    """
+
+    def __init__(
+        self,
+        projects: List[TransferSet],
+        hostnames: List[str],
+        workers: int = 8,
+        full: bool = False,
+        user: str = DEFAULT_REMOTE_USER,
+    ):
+        self._projects: List[TransferSet] = projects
+        self._hostnames: List[str] = hostnames
+        self._workers: int = max(1, workers)
+        self._full: bool = full
+        self._user: str = user
+        self._manifests: Dict[str, Manifest] = {}
+
+    def run(self) -> bool:
+        check_program_dependency("rsync")
+        # scan the source tree(s) once
+        for project in self._projects:
+            stime = time.time()
+            self._manifests[project.path] = build_manifest(project)
+            dtslogger.debug(
+                f"Scanned '{project.path}' ({len(self._manifests[project.path])} files) "
+                f"in {time.time() - stime:.2f}s"
+            )
+        # push to all robots
+        dtslogger.info(f"Syncing code with {len(self._hostnames)} robots ({self._workers} at a time)...")
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            results: List[RobotSyncResult] = list(pool.map(self._sync_robot, self._hostnames))
+        # report
+        header = ["Status", "Files", "Time", "Error"]
+        data = [
+            [
+                r.hostname.replace(".local", ""),
+                colored("Synced", "green") if r.success else colored("Failed", "red"),
+                str(r.files) if r.success else "-",
+                f"{r.duration:.1f}s",
+                r.error or "",
+            ]
+            for r in results
+        ]
+        print(format_matrix(header, data, "{:^{}}", "{:<{}}", "{:<{}}", "\n", " | "))
+        return all(r.success for r in results)
+
+    def _sync_robot(self, hostname: str) -> RobotSyncResult:
+        result = RobotSyncResult(hostname)
+        stime = time.time()
+        try:
+            with SSHConnection(hostname, user=self._user) as ssh:
+                for project in self._projects:
+                    manifest: Manifest = self._manifests[project.path]
+                    stamp_file: str = shlex.quote(project.remote_path + SYNC_STAMP_FILE)
+                    stamp, cached = (None, None) if self._full else _load_manifest(hostname, project)
+                    # the remote copy changed by some other route (e.g., the robot was reflashed)
+                    if (
+                        cached is not None
+                        and ssh.run(f"cat {stamp_file} 2>/dev/null || true").strip() != stamp
+                    ):
+                        dtslogger.info(
+                            f"[{hostname}] The remote copy of '{project.name}' changed, syncing all."
+                        )
+                        cached = None
+                    # with no cached manifest nothing is known about the remote copy, push everything
+                    delta: Set[str] = diff_manifests(cached, manifest)
+                    # the cached manifest is only valid again once the push succeeds
+                    _forget_manifest(hostname, project)
+                    rsync_files(project, delta, hostname, ssh=ssh, user=self._user)
+                    result.files += len(delta)
+                    stamp = uuid.uuid4().hex
+                    remote_dir: str = shlex.quote(project.remote_path)
+                    ssh.run(f"mkdir -p {remote_dir} && printf %s {stamp} > {stamp_file}")
+                    _save_manifest(hostname, project, manifest, stamp)
+            result.success = True
+        except (subprocess.CalledProcessError, OSError) as e:
+            result.error = str(e)
+        result.duration = time.time() - stime
+        return result
@@ -1,5 +1,8 @@
 import re
 import math
+import sys
+from typing import List
+
 from termcolor import colored
 
 
@@ -62,3 +65,36 @@ def fill_cell(text, width, foreground=None, background=None, text_len=None, form
     if not foreground or not background:
         return s
     return colored(s, foreground, "on_" + background)
+
+
+class LiveTable(object):
+    """
+    Renders a block of lines at the top of the terminal, redrawing only the lines that changed
+    since the last render.
+    """
+
+    def __init__(self, buf=sys.stdout):
+        self._buffer = buf
+        self._lines: List[str] = []
+        self._cleared = False
+
+    def render(self, lines: List[str]):
+        out: str = ""
+        if not self._cleared:
+            # clear the terminal once
+            out += "\x1b[2J"
+            self._cleared = True
+        for i, line in enumerate(lines):
+            if i < len(self._lines) and self._lines[i] == line:
+                continue
+            # move to the beginning of the line, write it and clear what is left of the old one
+            out += f"\x1b[{i + 1};1H{line}\x1b[K"
+        # clear lines that are not there anymore
+        for i in range(len(lines), len(self._lines)):
+            out += f"\x1b[{i + 1};1H\x1b[K"
+        if out:
+            # park the cursor below the table
+            out += f"\x1b[{len(lines) + 1};1H"
+            self._buffer.write(out)
+            self._buffer.flush()
+        self._lines = list(lines)